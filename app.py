@@ -1,13 +1,18 @@
 import streamlit as st
 import os
-import chromadb
-from PIL import Image
-import numpy as np
 import tempfile
-import shutil
 
-from model_loader import EmbeddingModel
-from utils import extract_text_with_page_numbers, move_file_to_category
+import metrics
+import db
+from db import get_collection, get_keyword_index, get_paper_registry, result_cache_stats
+from keyword_index import search_pages
+from model_loader import EmbeddingModel, DEFAULT_CACHE_PATH
+from paper_ingest import IngestProgress
+from ingest_jobs import ForegroundGate, IngestWorker, JobQueue, format_jobs
+from query_batcher import QueryBatcher
+from paper_summary import SUMMARY_COLLECTION
+from image_indexer import ImageIndexer, duplicate_counts, format_stats
+from search_filter import PageFilter, format_facets
 
 # --- 页面配置 ---
 st.set_page_config(page_title="多模态 AI 助手", layout="wide", page_icon="🤖")
@@ -16,21 +21,44 @@ st.set_page_config(page_title="多模态 AI 助手", layout="wide", page_icon="
 @st.cache_resource
 def load_models():
     """加载模型，只执行一次"""
-    return EmbeddingModel()
+    return EmbeddingModel(cache_path=DEFAULT_CACHE_PATH, lazy=False)
+
+@st.cache_resource
+def load_query_encoder(_model_handler):
+    """所有会话共享的查询合批器，并发检索合成一次前向传播"""
+    return QueryBatcher(_model_handler)
 
 @st.cache_resource
 def load_db():
     """连接数据库，只执行一次"""
-    client = chromadb.PersistentClient(path="./db")
-    paper_collection = client.get_or_create_collection(name="papers")
-    image_collection = client.get_or_create_collection(name="images")
-    return paper_collection, image_collection
+    paper_collection = get_collection("papers")
+    image_collection = get_collection("images")
+    return paper_collection, image_collection, get_keyword_index()
+
+@st.cache_resource
+def load_progress():
+    """论文导入进度记录，用于断点续传"""
+    return IngestProgress()
+
+@st.cache_resource
+def load_ingest_worker(_model_handler, _paper_collection, _keyword_index, _ingest_progress):
+    """后台导入队列与工作线程，整个 Streamlit 服务只启动一个"""
+    gate = ForegroundGate()
+    jobs = JobQueue()
+    IngestWorker(jobs, _model_handler, _paper_collection, _ingest_progress,
+                 keyword_index=_keyword_index, gate=gate,
+                 summary_collection=get_collection(SUMMARY_COLLECTION),
+                 registry=get_paper_registry()).start()
+    return jobs, gate
 
 # 初始化加载
 try:
     with st.spinner('正在加载 AI 模型 (MiniLM & CLIP)... 请稍候'):
         model_handler = load_models()
-        paper_collection, image_collection = load_db()
+        query_encoder = load_query_encoder(model_handler)
+        paper_collection, image_collection, keyword_index = load_db()
+        ingest_progress = load_progress()
+        job_queue, search_gate = load_ingest_worker(model_handler, paper_collection, keyword_index, ingest_progress)
     st.success("模型与数据库加载完毕！")
 except Exception as e:
     st.error(f"模型加载失败: {e}")
@@ -40,6 +68,22 @@ except Exception as e:
 st.sidebar.title("🤖 AI Agent 控制台")
 app_mode = st.sidebar.radio("选择功能", ["📄 论文上传与分类", "🔍 语义文献搜索", "🖼️ 以文搜图"])
 
+with st.sidebar.expander("缓存统计"):
+    # 向量库后端由 AGENT_VECTOR_STORE 选择 (chroma / mmap)
+    st.caption(f"向量库后端: {db.VECTOR_STORE}")
+    q_stats = model_handler.query_cache.stats()
+    st.caption(f"查询向量: 命中 {q_stats['hits']} / 未命中 {q_stats['misses']} ({q_stats['hit_rate']:.1%})")
+    for name, r_stats in result_cache_stats().items():
+        st.caption(f"检索结果 [{name}]: 命中 {r_stats['hits']} / 未命中 {r_stats['misses']} ({r_stats['hit_rate']:.1%})")
+    for name, b_stats in query_encoder.stats().items():
+        st.caption(f"查询合批 [{name}]: {b_stats['requests']} 次请求 / {b_stats['batches']} 批 "
+                   f"(平均 {b_stats['mean_batch']:.2f}，平均等待 {b_stats['mean_wait_ms']:.1f} ms)")
+
+# 设置 AGENT_METRICS=1 时显示各阶段耗时 (提取 / 编码 / 写库 / 查询)
+if metrics.REGISTRY.enabled:
+    with st.sidebar.expander("阶段耗时"):
+        st.code(metrics.REGISTRY.summary())
+
 # --- 功能 1: 论文上传与分类 ---
 if app_mode == "📄 论文上传与分类":
     st.title("📄 智能论文归档")
@@ -52,73 +96,69 @@ if app_mode == "📄 论文上传与分类":
     uploaded_files = st.file_uploader("上传 PDF 论文", type=["pdf"], accept_multiple_files=True)
 
     if st.button("开始处理") and uploaded_files:
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-
-        for idx, uploaded_file in enumerate(uploaded_files):
-            status_text.text(f"正在处理: {uploaded_file.name}...")
-
+        # 只把文件提交到后台队列，提取、分类、编码和写库由工作线程完成，页面不会被阻塞
+        for uploaded_file in uploaded_files:
             with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
                 tmp_file.write(uploaded_file.read())
                 tmp_path = tmp_file.name
-
-            # 1. 提取文本
-            chunks = extract_text_with_page_numbers(tmp_path)
-            
-            if not chunks:
-                st.warning(f"文件 {uploaded_file.name} 无法提取文本。")
+            try:
+                with metrics.timer("file.copy"):
+                    job_id = job_queue.submit(tmp_path, uploaded_file.name, topics_input or None)
+                st.success(f"✅ {uploaded_file.name} 已加入导入队列 (任务 #{job_id})")
+            except Exception as e:
+                st.warning(f"文件 {uploaded_file.name} 提交失败: {e}")
+            finally:
                 os.unlink(tmp_path)
-                continue
-
-            # 2. 确定分类
-            summary_text = " ".join([c["text"] for c in chunks[:3]])
-            summary_vec = model_handler.get_text_embedding(summary_text)
-
-            best_topic = "Uncategorized"
-            if topics_input:
-                t_list = topics_input.split(',')
-                t_vecs = model_handler.text_model.encode(t_list)
-                scores = [np.dot(t_v, summary_vec) for t_v in t_vecs]
-                best_topic = t_list[np.argmax(scores)]
-
-            # 3. 移动文件到真实的数据目录
-            target_dir = os.path.join("data", best_topic)
-            os.makedirs(target_dir, exist_ok=True)
-            final_path = os.path.join(target_dir, uploaded_file.name)
-
-            shutil.copy(tmp_path, final_path)
-
-            # 4. 存入数据库
-            ids, docs, vecs, metas = [], [], [], []
-            for chunk in chunks:
-                page_id = f"{uploaded_file.name}_p{chunk['page']}"
-                ids.append(page_id)
-                docs.append(chunk["text"])
-                vecs.append(model_handler.get_text_embedding(chunk["text"]))
-                metas.append({
-                    "path": final_path,
-                    "topic": best_topic,
-                    "page": chunk["page"]
-                })
-
-            paper_collection.upsert(ids=ids, embeddings=vecs, documents=docs, metadatas=metas)
-            st.success(f"✅ {uploaded_file.name} -> 归类为 **{best_topic}** (索引了 {len(chunks)} 页)")
-
-            os.unlink(tmp_path)
-            progress_bar.progress((idx + 1) / len(uploaded_files))
+
+    # 3. 任务进度 (点击刷新重新读取)
+    st.subheader("导入任务")
+    st.button("刷新进度")
+    st.markdown(format_jobs(job_queue.list()))
+
+    stats = model_handler.cache_stats()
+    if stats:
+        st.caption(f"向量缓存: 命中 {stats['hits']} / 未命中 {stats['misses']} ({stats['hit_rate']:.1%})")
 
 # --- 功能 2: 语义文献搜索 ---
 elif app_mode == "🔍 语义文献搜索":
     st.title("🔍 深度语义搜索")
     query = st.text_input("请输入问题或关键词", "How does self-attention work?")
-    top_k = st.slider("返回结果数量", 1, 10, 3)
+    top_k = st.slider("每页结果数量", 1, 50, 3)
+
+    # 分类 / 目录统计来自文件登记表，不扫描向量库
+    facets = get_paper_registry().facets()
+    with st.sidebar.expander("过滤条件", expanded=True):
+        topic_counts = {topic: papers for topic, papers, _ in facets["topics"]}
+        topics = st.multiselect("分类", list(topic_counts), format_func=lambda t: f"{t} ({topic_counts[t]} 篇)")
+        path_filter = st.text_input("论文或目录路径 (逗号分隔)")
+        pages_filter = st.text_input("页码范围", placeholder="例如: 3-10")
+    with st.sidebar.expander("分类与目录统计"):
+        st.markdown(format_facets(facets))
+
+    # 查询或过滤条件变化时回到第一页
+    search_key = (query, top_k, tuple(topics), path_filter, pages_filter)
+    if st.session_state.get("search_key") != search_key:
+        st.session_state["search_key"] = search_key
+        st.session_state["search_offset"] = 0
+    offset = st.session_state["search_offset"]
 
     if st.button("搜索") or query:
         if not query:
             st.warning("请输入查询内容")
         else:
-            query_vec = model_handler.get_text_embedding(query)
-            results = paper_collection.query(query_embeddings=[query_vec], n_results=top_k)
+            try:
+                filters = PageFilter.from_args(topics, path_filter, pages_filter)
+            except ValueError:
+                st.warning("页码范围格式应为 5、3-10、3- 或 -10")
+                st.stop()
+            if filters.empty:
+                filters = None
+            else:
+                filters.resolve(get_paper_registry())
+            # 标识符/人名类查询直接走 BM25 关键词索引，混合查询做融合排序；过滤条件下推到向量库
+            with search_gate.foreground():
+                results = search_pages(query, paper_collection, query_encoder, keyword_index, n_results=top_k,
+                                       filters=filters, offset=offset)
 
             if not results['ids'] or not results['ids'][0]:
                 st.info("没有找到相关结果。")
@@ -129,7 +169,7 @@ elif app_mode == "🔍 语义文献搜索":
                     # score = results['distances'][0][i] 
                     
                     with st.container():
-                        st.markdown(f"### 📄 结果 {i+1}: {os.path.basename(meta.get('path', 'Unknown'))}")
+                        st.markdown(f"### 📄 结果 {offset + i + 1}: {os.path.basename(meta.get('path', 'Unknown'))}")
                         col1, col2 = st.columns([1, 4])
                         with col1:
                             st.info(f"**Topic**: {meta.get('topic', 'N/A')}\n\n**Page**: {meta.get('page', 'N/A')}")
@@ -137,43 +177,44 @@ elif app_mode == "🔍 语义文献搜索":
                             st.markdown(f"> ...{snippet[:500]}...")
                         st.divider()
 
+            # 翻页：记录起点后重新运行脚本
+            col_prev, col_next = st.columns(2)
+            if offset and col_prev.button("上一页"):
+                st.session_state["search_offset"] = max(offset - top_k, 0)
+                st.rerun()
+            if results.get("next_offset") is not None and col_next.button("下一页"):
+                st.session_state["search_offset"] = results["next_offset"]
+                st.rerun()
+
 # --- 功能 3: 以文搜图 ---
 elif app_mode == "🖼️ 以文搜图":
     st.title("🖼️ 智能图片检索")
 
     if st.sidebar.button("重建图片索引 (扫描 data/ 目录)"):
         with st.spinner("正在扫描图片..."):
-            image_dir = "data"
-            valid_exts = ['.jpg', '.jpeg', '.png']
-            count = 0
-            for root, _, files in os.walk(image_dir):
-                for file in files:
-                    if any(file.lower().endswith(ext) for ext in valid_exts):
-                        full_path = os.path.join(root, file)
-                        try:
-                            img = Image.open(full_path)
-                            vec = model_handler.get_image_embedding(img)
-                            image_collection.upsert(ids=[file], embeddings=[vec], metadatas=[{"path": full_path}])
-                            count += 1
-                        except: pass
-            st.sidebar.success(f"成功索引 {count} 张图片！")
+            stats = ImageIndexer(image_collection, model_handler).sync("data")
+            st.sidebar.success(f"索引完成！{format_stats(stats)}")
 
     query = st.text_input("描述你想找的图片", "A diagram of transformer architecture")
     
     if query:
-        query_vec = model_handler.get_text_for_image_embedding(query)
-        results = image_collection.query(query_embeddings=[query_vec], n_results=4)
+        with search_gate.foreground():
+            query_vec = query_encoder.get_text_for_image_embedding(query)
+            results = image_collection.query(query_embeddings=[query_vec], n_results=4)
 
         if not results['ids'] or not results['ids'][0]:
             st.info("没有找到图片。请确保 data 目录下有图片并已点击左侧'重建索引'。")
         else:
             cols = st.columns(2)
+            # 每组近似重复只有代表图片入库，标注被合并的副本数
+            dups = duplicate_counts(results['ids'][0])
             for i, doc_id in enumerate(results['ids'][0]):
                 meta = results['metadatas'][0][i]
                 img_path = meta['path']
+                extra = f" (+{dups[doc_id]} 张近似重复)" if dups.get(doc_id) else ""
                 
                 with cols[i % 2]:
                     if os.path.exists(img_path):
-                        st.image(img_path, caption=f"{doc_id} (Path: {img_path})", use_container_width=True)
+                        st.image(img_path, caption=f"{doc_id} (Path: {img_path}){extra}", use_container_width=True)
                     else:
                         st.error(f"图片丢失: {img_path}")
\ No newline at end of file
@@ -0,0 +1,421 @@
+"""离线基准测试：在临时目录中生成合成 PDF / 图片语料，跑 add_paper、add_image、search_paper、
+search_image，输出 JSON 结果便于对比不同版本。
+
+默认使用确定性的 StubEmbeddingModel，无需模型权重和网络；加 --real 使用 models/ 下的真实模型。
+
+    python bench.py --pdfs 20 --pages 10 --images 100 --queries 200 --output bench.json
+
+--compare-stores N 只比较向量库后端：写入 N 条随机向量后，在独立子进程中分别打开 Chroma 与
+mmap (float16 / int8) 后端，测查询延迟、RSS 和相对精确 top-k 的召回率。
+
+    python bench.py --compare-stores 200000 --dim 384 --queries 200
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image, ImageDraw
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+
+# --- 合成语料 ---
+
+def make_vocabulary(rng, size=2000):
+    """生成伪词表，并混入少量论文中常见的标识符"""
+    syllables = ["ka", "lo", "mi", "ne", "ra", "to", "vi", "se", "du", "pa", "qu", "ze", "tion", "ing", "al"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    words = sorted(words)
+    words += ["ResNet-50", "BERT", "arXiv:1706.03762", "GPT-4", "ViT-B/32", "ImageNet"]
+    return words
+
+
+def make_page_text(rng, words, weights, n_words):
+    return " ".join(rng.choices(words, weights=weights, k=n_words))
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages, line_chars=90):
+    """写出一个只含 Helvetica 文本的最小 PDF，每个元素为一页的文本"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines, line = [], ""
+        for word in text.split():
+            if len(line) + len(word) + 1 > line_chars:
+                lines.append(line)
+                line = ""
+            line = f"{line} {word}" if line else word
+        lines.append(line)
+        body = "BT /F1 9 Tf 11 TL 40 800 Td " + " T* ".join(f"({_pdf_escape(l)}) Tj" for l in lines) + " ET"
+        stream = body.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_num = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_num
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for num, obj in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % num + obj + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    with open(path, "wb") as f:
+        f.write(out.getvalue())
+
+
+def write_image(path, rng, size):
+    img = Image.new("RGB", size, tuple(rng.randint(0, 255) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(rng.randint(3, 12)):
+        x0, y0 = rng.randint(0, size[0] - 1), rng.randint(0, size[1] - 1)
+        x1, y1 = rng.randint(x0, size[0]), rng.randint(y0, size[1])
+        color = tuple(rng.randint(0, 255) for _ in range(3))
+        (draw.ellipse if rng.random() < 0.5 else draw.rectangle)([x0, y0, x1, y1], fill=color)
+    img.save(path, quality=90) if path.endswith(".jpg") else img.save(path)
+
+
+def build_corpus(root, args):
+    rng = random.Random(args.seed)
+    words = make_vocabulary(rng)
+    # Zipf 式词频，使 BM25 / 向量检索的分布接近真实文本
+    weights = [1.0 / (rank + 1) for rank in range(len(words))]
+    pdf_dir = os.path.join(root, "papers")
+    img_dir = os.path.join(root, "images")
+    os.makedirs(pdf_dir)
+    os.makedirs(img_dir)
+    # 每篇论文有自己的一组主题词，页面一半取自主题词、一半取自全局词频，模拟同一论文内页面语义相近
+    topics = [rng.sample(words, 30) for _ in range(args.pdfs)]
+    for i in range(args.pdfs):
+        half = args.words_per_page // 2
+        pages = [make_page_text(rng, topics[i], None, half) + " " + make_page_text(rng, words, weights, half)
+                 for _ in range(args.pages)]
+        write_pdf(os.path.join(pdf_dir, f"paper_{i:05d}.pdf"), pages)
+    size = tuple(int(v) for v in args.image_size.split("x"))
+    for i in range(args.images):
+        ext = ".jpg" if i % 2 else ".png"
+        write_image(os.path.join(img_dir, f"image_{i:05d}{ext}"), rng, size)
+    # 查询互不相同，避免命中查询向量 / 结果缓存；多数查询针对某篇论文的主题词
+    queries = {}
+    while len(queries) < args.queries:
+        source = rng.choice(topics) if topics and rng.random() < 0.8 else words
+        queries.setdefault(make_page_text(rng, source, None if source is not words else weights, rng.randint(2, 6)), None)
+    return pdf_dir, img_dir, list(queries)
+
+
+# --- 测量工具 ---
+
+def latency_stats(samples):
+    ms = np.asarray(samples) * 1000.0
+    return {
+        "count": len(samples),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+    }
+
+
+def peak_rss_mb():
+    """本进程及已回收子进程的峰值 RSS (Linux 上 ru_maxrss 单位为 KB，macOS 为字节)"""
+    scale = 1 if platform.system() == "Darwin" else 1024
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return {"self": self_rss / 2**20, "children": child_rss / 2**20}
+
+
+def current_rss_mb():
+    """当前 RSS、其中匿名页 / 文件映射页的部分及峰值 (读 /proc，非 Linux 返回 None)
+
+    子进程的 ru_maxrss 在 exec 后沿用 fork 时父进程的值，所以子进程里用 VmHWM 作峰值。
+    """
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+    except OSError:
+        return None
+    return {key: int(fields[name].split()[0]) / 1024
+            for key, name in (("rss", "VmRSS"), ("anon", "RssAnon"), ("file", "RssFile"), ("peak", "VmHWM"))
+            if name in fields}
+
+
+def dir_size_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            with contextlib.suppress(OSError):
+                total += os.path.getsize(os.path.join(root, file))
+    return total / 2**20
+
+
+def timed(fn, *args, **kwargs):
+    """计时并丢弃被测函数的标准输出"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+    return result, elapsed
+
+
+# --- 基准流程 ---
+
+def compare_two_stage(agent, queries, candidates, k):
+    """以全库逐页 top-k 为基准，测两阶段检索的 recall@k、延迟和结果中不同论文的数量 (只计检索，不含编码)"""
+    from paper_summary import SUMMARY_COLLECTION, search_two_stage
+    papers = agent.get_collection("papers")
+    summaries = agent.get_collection(SUMMARY_COLLECTION)
+    vecs = agent.get_model().get_text_embeddings(queries)
+    flat_lat, two_lat, recalls, flat_papers, two_papers = [], [], [], [], []
+    for vec in vecs:
+        flat, t = timed(papers.query, query_embeddings=[vec], n_results=k)
+        flat_lat.append(t)
+        two, t = timed(search_two_stage, vec, papers, summaries, k, candidates=candidates)
+        two_lat.append(t)
+        truth = set(flat["ids"][0])
+        recalls.append(len(truth & set(two["ids"][0])) / len(truth) if truth else 1.0)
+        flat_papers.append(len({m["path"] for m in flat["metadatas"][0]}))
+        two_papers.append(len({m["path"] for m in two["metadatas"][0]}))
+    return {
+        "candidates": candidates,
+        "k": k,
+        "papers": summaries.count(),
+        "flat": latency_stats(flat_lat),
+        "two_stage": latency_stats(two_lat),
+        f"recall@{k}": float(np.mean(recalls)),
+        "distinct_papers_flat": float(np.mean(flat_papers)),
+        "distinct_papers_two_stage": float(np.mean(two_papers)),
+    }
+
+
+STORE_VARIANTS = [("chroma", None), ("mmap", "float16"), ("mmap", "int8")]
+
+
+def probe_store(args):
+    """子进程：打开一个后端，预热后逐条查询，输出延迟、RSS 和命中 id (JSON 写到 stdout)"""
+    import db
+    db.set_vector_store(args.store_probe, args.store_dtype)
+    queries = np.load(os.path.join(args.probe_dir, "queries.npy"))
+    rss_before = current_rss_mb()
+    start = time.perf_counter()
+    collection = db.open_collection("papers", os.path.join(args.probe_dir, f"db_{args.store_probe}_{args.store_dtype}"))
+    collection.query(query_embeddings=queries[:1], n_results=args.top_k)
+    open_seconds = time.perf_counter() - start
+    rss_open = current_rss_mb()
+    ids, lat = [], []
+    for vec in queries:
+        result, t = timed(collection.query, query_embeddings=[vec], n_results=args.top_k)
+        ids.append(result["ids"][0])
+        lat.append(t)
+    # 一次多向量查询 (批量检索的路径)
+    _, batch_seconds = timed(collection.query, query_embeddings=queries, n_results=args.top_k)
+    print(json.dumps({
+        "open_and_first_query_seconds": open_seconds,
+        "query": latency_stats(lat),
+        "batch_query_per_sec": len(queries) / batch_seconds,
+        "rss_mb_before_open": rss_before,
+        "rss_mb_after_first_query": rss_open,
+        "rss_mb_after_queries": current_rss_mb(),
+        "ids": ids,
+    }))
+
+
+def compare_stores(args):
+    """各后端写入同一批随机向量，再各用一个新进程测查询；召回率以 numpy float32 精确 top-k 为基准"""
+    import subprocess
+    import db
+    workdir = tempfile.mkdtemp(prefix="agent-store-bench-")
+    rng = np.random.default_rng(args.seed)
+    try:
+        n, dim, per_paper = args.compare_stores, args.dim, max(args.pages, 1)
+        vectors = rng.normal(size=(n, dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        # 查询取库中向量加噪声，使近邻结构接近真实检索
+        picks = rng.choice(n, size=args.queries, replace=False)
+        queries = vectors[picks] + rng.normal(scale=0.05, size=(args.queries, dim)).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        np.save(os.path.join(workdir, "queries.npy"), queries)
+        sq = (vectors * vectors).sum(axis=1)
+        truth = [set(np.argsort(sq - 2 * vectors @ q)[:args.top_k].tolist()) for q in queries]
+
+        ids = [f"paper{i // per_paper}.pdf_{i % per_paper}" for i in range(n)]
+        metas = [{"path": f"data/t{i % 5}/paper{i // per_paper}.pdf", "topic": f"t{i % 5}", "page": i % per_paper}
+                 for i in range(n)]
+        report = {"config": {"vectors": n, "dim": dim, "queries": args.queries, "top_k": args.top_k,
+                             "seed": args.seed},
+                  "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+                  "stores": {}}
+        row_of = {row_id: i for i, row_id in enumerate(ids)}
+        for backend, dtype in STORE_VARIANTS:
+            label = backend if dtype is None else f"{backend}-{dtype}"
+            path = os.path.join(workdir, f"db_{backend}_{dtype}")
+            db.set_vector_store(backend, dtype)
+            collection = db.open_collection("papers", path, backend)
+            start = time.perf_counter()
+            for s in range(0, n, 5000):
+                collection.upsert(ids=ids[s:s + 5000], embeddings=vectors[s:s + 5000],
+                                  metadatas=metas[s:s + 5000])
+            write_seconds = time.perf_counter() - start
+            cmd = [sys.executable, os.path.abspath(__file__), "--store-probe", backend, "--probe-dir", workdir,
+                   "--top-k", str(args.top_k)] + (["--store-dtype", dtype] if dtype else [])
+            out = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+            probe = json.loads(out.strip().splitlines()[-1])
+            found = probe.pop("ids")
+            probe["recall@%d" % args.top_k] = float(np.mean([
+                len(t & {row_of[i] for i in got}) / len(t) for t, got in zip(truth, found)
+            ]))
+            probe["write_vectors_per_sec"] = n / write_seconds
+            probe["db_size_mb"] = dir_size_mb(path)
+            report["stores"][label] = probe
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="agent-bench-")
+    cwd = os.getcwd()
+    # 所有数据路径 (./db、./cache 等) 都是相对路径，切到临时目录即可隔离
+    os.chdir(workdir)
+    try:
+        corpus_start = time.perf_counter()
+        pdf_dir, img_dir, queries = build_corpus(workdir, args)
+        corpus_elapsed = time.perf_counter() - corpus_start
+
+        import main as agent
+        import metrics
+        if args.store:
+            agent.db.set_vector_store(args.store, args.store_dtype)
+        # 分阶段耗时一并写入报告
+        metrics.enable()
+        from model_loader import EmbeddingModel, StubEmbeddingModel
+        if args.real:
+            agent._model_handler = EmbeddingModel(batch_size=args.batch_size)
+        else:
+            agent._model_handler = StubEmbeddingModel(batch_size=args.batch_size)
+
+        report = {
+            "config": {k: v for k, v in vars(args).items() if k != "output"},
+            "encoder": "real" if args.real else "stub",
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "corpus_build_seconds": corpus_elapsed,
+        }
+
+        # 1. 论文导入
+        pdfs = sorted(os.path.join(pdf_dir, f) for f in os.listdir(pdf_dir))
+        if args.bulk:
+            _, elapsed = timed(agent.add_papers, pdf_dir, workers=args.workers)
+        else:
+            elapsed = 0.0
+            for path in pdfs:
+                _, t = timed(agent.add_paper, path)
+                elapsed += t
+        pages = agent.get_collection("papers").count()
+        report["ingest"] = {
+            "mode": "add_papers" if args.bulk else "add_paper",
+            "papers": len(pdfs),
+            "pages": pages,
+            "seconds": elapsed,
+            "pages_per_sec": pages / elapsed if elapsed else None,
+        }
+        # 再同步一次同一目录：已登记的文件只 stat，不提取也不编码
+        _, elapsed = timed(agent.add_papers, pdf_dir, workers=args.workers)
+        report["resync"] = {"papers": len(pdfs), "seconds": elapsed}
+
+        # 2. 图片索引
+        stats, elapsed = timed(agent.add_image, img_dir)
+        images = agent.get_collection("images").count()
+        report["index_images"] = {
+            "images": images,
+            "seconds": elapsed,
+            "images_per_sec": images / elapsed if elapsed else None,
+        }
+
+        # 3. 查询延迟 (每个查询只跑一次，结果缓存不会命中)
+        for name, fn, kwargs in [
+            ("search_paper", agent.search_paper, {"mode": args.search_mode}),
+            ("search_image", agent.search_image, {}),
+        ]:
+            samples = [timed(fn, q, **kwargs)[1] for q in queries]
+            report[name] = latency_stats(samples)
+
+        # 4. 两阶段检索 (论文级向量选候选 -> 页面重排) 与全库逐页检索的对比
+        if args.candidates:
+            report["two_stage"] = compare_two_stage(agent, queries, args.candidates, args.top_k)
+
+        report["stages"] = metrics.REGISTRY.snapshot()
+        report["peak_rss_mb"] = peak_rss_mb()
+        report["db_size_mb"] = dir_size_mb(os.path.join(workdir, "db"))
+        report["workdir"] = workdir if args.keep else None
+        return report
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline ingestion / search benchmark")
+    parser.add_argument("--pdfs", type=int, default=20, help="Number of synthetic PDFs")
+    parser.add_argument("--pages", type=int, default=10, help="Pages per PDF")
+    parser.add_argument("--words-per-page", type=int, default=300, help="Words per synthetic page")
+    parser.add_argument("--images", type=int, default=50, help="Number of synthetic images")
+    parser.add_argument("--image-size", type=str, default="1024x768", help="Synthetic image size WxH")
+    parser.add_argument("--queries", type=int, default=100, help="Queries per search benchmark")
+    parser.add_argument("--search-mode", choices=["auto", "dense", "lexical", "hybrid"], default="dense")
+    parser.add_argument("--batch-size", type=int, default=32, help="Encoder batch size")
+    parser.add_argument("--candidates", type=int, default=0, help="Also compare two-stage search with this many candidate papers")
+    parser.add_argument("--top-k", type=int, default=10, help="k for the two-stage recall@k comparison")
+    parser.add_argument("--bulk", action="store_true", help="Ingest with add_papers instead of add_paper per file")
+    parser.add_argument("--workers", type=int, default=None, help="Extraction workers for --bulk")
+    parser.add_argument("--real", action="store_true", help="Use the real models under models/ instead of the stub")
+    parser.add_argument("--store", choices=["chroma", "mmap"], default=None, help="Vector store backend for the pipeline run")
+    parser.add_argument("--store-dtype", choices=["float16", "int8"], default=None, help="Precision for --store mmap")
+    parser.add_argument("--compare-stores", type=int, default=0, metavar="N",
+                        help="Only compare vector store backends on N random vectors (latency, RSS, recall)")
+    parser.add_argument("--dim", type=int, default=384, help="Vector dimension for --compare-stores")
+    parser.add_argument("--store-probe", choices=["chroma", "mmap"], default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--probe-dir", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary corpus and DB")
+    parser.add_argument("--output", type=str, default=None, help="Write JSON here instead of stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.store_probe:
+        probe_store(args)
+        sys.exit(0)
+    report = compare_stores(args) if args.compare_stores else run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
@@ -0,0 +1,140 @@
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+# 常驻进程监听的 Unix 套接字，可通过环境变量覆盖
+DEFAULT_SOCKET_PATH = os.environ.get("AGENT_SOCKET", "./db/agent.sock")
+# 会写库的命令，同一时间只执行一个；其余 (检索、统计) 命令并发执行，不被导入阻塞
+WRITE_COMMANDS = ("add_paper", "index_images")
+CONNECT_TIMEOUT = 1.0
+# 检索命令等待响应的上限 (秒)，超时后客户端回退到本进程执行；写命令一直等到完成
+QUERY_TIMEOUT = 30.0
+
+
+def request(command, args=None, socket_path=DEFAULT_SOCKET_PATH, timeout=None):
+    """把命令发给常驻进程并返回响应；守护进程未运行或在 timeout 秒内没有响应时返回 None，由调用方在本进程执行"""
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError, socket.timeout):
+        sock.close()
+        return None
+    sock.settimeout(timeout)
+    try:
+        with sock, sock.makefile("rwb") as f:
+            f.write(json.dumps({"command": command, "args": args or {}}).encode("utf-8") + b"\n")
+            f.flush()
+            line = f.readline()
+    except socket.timeout:
+        return None
+    if not line:
+        return None
+    return json.loads(line)
+
+
+class _ThreadStdout:
+    """按线程分流的 stdout：正在执行命令的线程写入自己的缓冲区，其余线程照常写到原来的 stdout"""
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def _target(self):
+        buf = getattr(self._local, "buf", None)
+        return self._default if buf is None else buf
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    @contextlib.contextmanager
+    def capture(self):
+        self._local.buf = io.StringIO()
+        try:
+            yield self._local.buf
+        finally:
+            self._local.buf = None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                req = json.loads(line)
+                resp = self.server.dispatch(req.get("command"), req.get("args") or {})
+            except ValueError as e:
+                resp = {"ok": False, "output": "", "error": f"Bad request: {e}"}
+            self.wfile.write(json.dumps(resp).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class AgentDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """保持模型和数据库常驻的本地服务，按 JSON 行协议执行 CLI 命令"""
+    daemon_threads = True
+
+    def __init__(self, socket_path, handlers):
+        self.handlers = handlers
+        self.socket_path = socket_path
+        # 每个请求的输出写入各自线程的缓冲区 (redirect_stdout 是进程级的，会让并发的命令互相串输出)
+        self._stdout = _ThreadStdout(sys.stdout)
+        sys.stdout = self._stdout
+        self._write_lock = threading.Lock()
+        super().__init__(socket_path, _Handler)
+
+    def server_close(self):
+        super().server_close()
+        if sys.stdout is self._stdout:
+            sys.stdout = self._stdout._default
+
+    def dispatch(self, command, args):
+        if command == "ping":
+            return {"ok": True, "output": ""}
+        handler = self.handlers.get(command)
+        if handler is None:
+            return {"ok": False, "output": "", "error": f"Unknown command: {command}"}
+        lock = self._write_lock if command in WRITE_COMMANDS else contextlib.nullcontext()
+        with lock, self._stdout.capture() as buf:
+            try:
+                handler(**args)
+                return {"ok": True, "output": buf.getvalue()}
+            except Exception as e:
+                return {"ok": False, "output": buf.getvalue(), "error": f"{type(e).__name__}: {e}"}
+
+
+def serve(handlers, socket_path=DEFAULT_SOCKET_PATH, warmup=None):
+    """启动常驻进程 (前台运行，Ctrl+C 退出)"""
+    if os.path.exists(socket_path):
+        if request("ping", socket_path=socket_path, timeout=CONNECT_TIMEOUT) is not None:
+            print(f"Daemon already running on {socket_path}")
+            return
+        # 上次异常退出遗留的套接字文件
+        os.unlink(socket_path)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+
+    if warmup:
+        warmup()
+    server = AgentDaemon(socket_path, handlers)
+    print(f"Daemon listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+from keyword_index import KeywordIndex
+from paper_registry import PaperRegistry
+from query_cache import CachedCollection, SqliteDataVersion
+
+DB_PATH = "./db"
+# 向量库后端：chroma (默认) 或 mmap (vector_store.MmapCollection)
+VECTOR_STORES = ("chroma", "mmap")
+VECTOR_STORE = os.environ.get("AGENT_VECTOR_STORE", "chroma")
+# mmap 后端新建 collection 时的存储精度：float16 或 int8
+MMAP_DTYPE = os.environ.get("AGENT_MMAP_DTYPE", "float16")
+
+_clients = {}
+_collections = {}
+_keyword_indexes = {}
+_registries = {}
+_lock = threading.Lock()
+# 各数据库路径的打开耗时 (秒)，用于启动时间报告
+open_times = {}
+
+def get_client(path=DB_PATH):
+    """按需导入 chromadb 并打开持久化客户端，同一路径只打开一次"""
+    with _lock:
+        if path not in _clients:
+            start = time.perf_counter()
+            import chromadb
+            _clients[path] = chromadb.PersistentClient(path=path)
+            open_times[path] = time.perf_counter() - start
+        return _clients[path]
+
+def set_vector_store(backend, dtype=None):
+    """切换之后 get_collection 打开的向量库后端 (命令行 --store 使用)"""
+    global VECTOR_STORE, MMAP_DTYPE
+    if backend not in VECTOR_STORES:
+        raise ValueError(f"Unknown vector store: {backend}")
+    VECTOR_STORE = backend
+    if dtype:
+        MMAP_DTYPE = dtype
+
+def open_collection(name, path=DB_PATH, backend=None):
+    """打开不带缓存的原始 collection；两种后端提供相同的 upsert/get/query/update/delete/count 接口"""
+    backend = backend or VECTOR_STORE
+    if backend == "mmap":
+        from vector_store import MmapCollection
+        start = time.perf_counter()
+        collection = MmapCollection(os.path.join(path, "mmap", name), name=name, dtype=MMAP_DTYPE)
+        open_times.setdefault(os.path.join(path, "mmap"), time.perf_counter() - start)
+        return collection
+    if backend != "chroma":
+        raise ValueError(f"Unknown vector store: {backend}")
+    return get_client(path).get_or_create_collection(name=name)
+
+def get_collection(name, path=DB_PATH, backend=None):
+    """返回带查询结果缓存的 collection；同名 collection 共享同一个包装对象，写入时统一失效
+
+    缓存同时跟踪库文件的 SQLite 数据版本 (Chroma 的 chroma.sqlite3 / mmap 的 meta.sqlite3)，
+    其他进程写库后下一次查询即失效。
+    """
+    key = (path, backend or VECTOR_STORE, name)
+    if key not in _collections:
+        collection = open_collection(name, path, key[1])
+        if key[1] == "mmap":
+            version = SqliteDataVersion(os.path.join(collection.path, "meta.sqlite3"))
+        else:
+            version = SqliteDataVersion(os.path.join(path, "chroma.sqlite3"))
+        with _lock:
+            _collections.setdefault(key, CachedCollection(collection, name=name, version=version))
+    return _collections[key]
+
+def copy_collection(name, src_backend, dst_backend, path=DB_PATH, batch=5000):
+    """把一个 collection 的全部行 (向量、文本、metadata) 复制到另一后端，返回行数"""
+    src = open_collection(name, path, src_backend)
+    dst = get_collection(name, path, dst_backend)
+    copied, offset = 0, 0
+    while True:
+        rows = src.get(limit=batch, offset=offset, include=["embeddings", "documents", "metadatas"])
+        if not len(rows["ids"]):
+            break
+        dst.upsert(ids=rows["ids"], embeddings=rows["embeddings"],
+                   documents=rows["documents"] if rows["documents"] and any(d is not None for d in rows["documents"]) else None,
+                   metadatas=rows["metadatas"])
+        copied += len(rows["ids"])
+        offset += len(rows["ids"])
+    return copied
+
+def get_keyword_index(path=DB_PATH):
+    """与 papers collection 同步维护的 BM25 关键词索引"""
+    with _lock:
+        if path not in _keyword_indexes:
+            _keyword_indexes[path] = KeywordIndex(os.path.join(path, "keyword_index.sqlite3"))
+        return _keyword_indexes[path]
+
+def get_paper_registry(path=DB_PATH):
+    """按内容哈希登记已导入论文的文件登记表 (paper_registry.PaperRegistry)
+
+    首次打开时为已有的库补登记，旧论文的 id 不会被新文件占用。
+    """
+    with _lock:
+        registry = _registries.get(path)
+        if registry is not None:
+            return registry
+        registry = PaperRegistry(os.path.join(path, "paper_registry.sqlite3"))
+    if not registry.count():
+        collection = get_collection("papers", path)
+        if collection.count():
+            registry.backfill(collection)
+    with _lock:
+        return _registries.setdefault(path, registry)
+
+def result_cache_stats():
+    """各 collection 的查询结果缓存统计"""
+    return {name: c.result_cache.stats() for (_, _, name), c in _collections.items()}
@@ -0,0 +1,95 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+class EmbeddingCache:
+    """基于内容哈希的持久化向量缓存 (SQLite)，超过容量时按 LRU 淘汰"""
+
+    def __init__(self, path, max_entries=200_000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, vec BLOB NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_used ON embeddings(used)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def make_key(model_id, kind, data):
+        """缓存键：模型 id + 输入类型 + 输入内容 (文本或图片字节) 的哈希"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        h = hashlib.sha256()
+        h.update(f"{model_id}\0{kind}\0".encode("utf-8"))
+        h.update(data)
+        return h.hexdigest()
+
+    def get_many(self, keys):
+        """批量查询，返回 {key: np.ndarray}，命中的条目刷新访问时间"""
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            # SQLite 单条语句的参数个数有限，分段查询
+            for start in range(0, len(unique), 500):
+                part = unique[start:start + 500]
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", part
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET used=? WHERE key=?", [(now, k) for k in found]
+                )
+                self._conn.commit()
+            hits = sum(1 for k in keys if k in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, keys, vecs):
+        """写入一批向量，必要时淘汰最久未使用的条目"""
+        now = time.time()
+        rows = [
+            (k, np.ascontiguousarray(v, dtype=np.float32).tobytes(), now)
+            for k, v in zip(keys, vecs)
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vec, used) VALUES (?, ?, ?)", rows
+            )
+            self._count += len(rows)
+            if self._count > self.max_entries:
+                self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                overflow = self._count - self.max_entries
+                if overflow > 0:
+                    self._conn.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY used LIMIT ?)", (overflow,)
+                    )
+                    self._count -= overflow
+            self._conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self._count,
+        }
@@ -1,23 +1,41 @@
 import gradio as gr
 import os
-import chromadb
-from PIL import Image
-import numpy as np
-import shutil
 
-from model_loader import EmbeddingModel
-from utils import extract_text_with_page_numbers, move_file_to_category
+import metrics
+import db
+from db import get_collection, get_keyword_index, get_paper_registry, result_cache_stats
+from keyword_index import search_pages
+from model_loader import EmbeddingModel, DEFAULT_CACHE_PATH
+from paper_ingest import IngestProgress
+from ingest_jobs import ForegroundGate, IngestWorker, JobQueue, format_jobs
+from query_batcher import QueryBatcher
+from paper_summary import SUMMARY_COLLECTION
+from image_indexer import ImageIndexer, duplicate_counts, format_stats
+from search_filter import PageFilter, format_facets
 
 # --- 全局资源加载 ---
+# Web 服务默认开启各阶段计时 (/metrics)，AGENT_METRICS=0 关闭
+metrics.enable(os.environ.get("AGENT_METRICS", "1") != "0")
 print("正在初始化模型和数据库...")
 try:
-    # 加载模型
-    model_handler = EmbeddingModel()
+    # 加载模型 (Web 服务启动时预加载，避免首个请求等待)
+    model_handler = EmbeddingModel(cache_path=DEFAULT_CACHE_PATH, lazy=False)
+    # 并发的检索请求合批编码 (AGENT_BATCH_WAIT_MS / AGENT_BATCH_MAX 调整窗口和批大小)
+    query_encoder = QueryBatcher(model_handler)
     
     # 连接数据库
-    client = chromadb.PersistentClient(path="./db")
-    paper_collection = client.get_or_create_collection(name="papers")
-    image_collection = client.get_or_create_collection(name="images")
+    paper_collection = get_collection("papers")
+    image_collection = get_collection("images")
+    ingest_progress = IngestProgress()
+    keyword_index = get_keyword_index()
+
+    # 论文导入在后台线程中排队执行，检索请求优先占用模型
+    search_gate = ForegroundGate()
+    job_queue = JobQueue()
+    IngestWorker(job_queue, model_handler, paper_collection, ingest_progress,
+                 keyword_index=keyword_index, gate=search_gate,
+                 summary_collection=get_collection(SUMMARY_COLLECTION),
+                 registry=get_paper_registry()).start()
     print("模型与数据库加载完毕！")
 except Exception as e:
     print(f"初始化失败: {e}")
@@ -25,65 +43,46 @@ except Exception as e:
 # --- 功能函数定义 ---
 
 def process_upload(file_obj, topics_str):
-    """处理论文上传"""
+    """处理论文上传：文件入队后立即返回，由后台线程提取、分类、编码并写库"""
     if file_obj is None:
-        return "请先上传文件"
+        return "请先上传文件", show_jobs()
 
     tmp_path = file_obj.name if hasattr(file_obj, 'name') else file_obj
-    
-    # 1. 提取文本
-    chunks = extract_text_with_page_numbers(tmp_path)
-    if not chunks:
-        return "无法提取文本，请检查 PDF 文件。"
-    
-    # 2. 确定分类
-    summary_text = " ".join([c["text"] for c in chunks[:3]])
-    summary_vec = model_handler.get_text_embedding(summary_text)
-
-    best_topic = "Uncategorized"
-    if topics_str:
-        t_list = topics_str.split(',')
-        t_vecs = model_handler.text_model.encode(t_list)
-        scores = [np.dot(t_v, summary_vec) for t_v in t_vecs]
-        best_topic = t_list[np.argmax(scores)]
-
-    # 3. 保存文件
-    target_dir = os.path.join("data", best_topic)
-    os.makedirs(target_dir, exist_ok=True)
-
     original_name = os.path.basename(tmp_path)
     if hasattr(file_obj, 'orig_name'):
         original_name = file_obj.orig_name
-        
-    final_path = os.path.join(target_dir, original_name)
-    shutil.copy(tmp_path, final_path)
-
-    # 4. 存入数据库
-    ids, docs, vecs, metas = [], [], [], []
-    for chunk in chunks:
-        page_id = f"{original_name}_p{chunk['page']}"
-        ids.append(page_id)
-        docs.append(chunk["text"])
-        vecs.append(model_handler.get_text_embedding(chunk["text"]))
-        metas.append({
-            "path": final_path,
-            "topic": best_topic,
-            "page": chunk["page"]
-        })
-
-    paper_collection.upsert(ids=ids, embeddings=vecs, documents=docs, metadatas=metas)
-    
-    return f"✅ 成功！归类为: {best_topic}\n已索引 {len(chunks)} 页。\n保存路径: {final_path}"
 
-def search_docs(query, top_k):
-    """语义搜索"""
-    if not query: return "请输入问题"
+    try:
+        with metrics.timer("file.copy"):
+            job_id = job_queue.submit(tmp_path, original_name, topics_str or None)
+    except Exception as e:
+        return f"提交失败: {e}", show_jobs()
+    return f"✅ 已加入导入队列 (任务 #{job_id})，可在下方查看进度。", show_jobs()
+
+def show_jobs():
+    """最近的导入任务及进度"""
+    return format_jobs(job_queue.list())
+
+def search_docs(query, top_k, topics=None, path="", pages="", offset=0):
+    """语义搜索；分类 / 路径 / 页码条件下推到向量库，offset 为分页起点。返回 (结果, 下一页起点)"""
+    if not query: return "请输入问题", None
+    offset = int(offset or 0)
+    try:
+        filters = PageFilter.from_args(topics, path, pages)
+    except ValueError:
+        return "页码范围格式应为 5、3-10、3- 或 -10", None
+    if filters.empty:
+        filters = None
+    else:
+        filters.resolve(get_paper_registry())
     
-    query_vec = model_handler.get_text_embedding(query)
-    results = paper_collection.query(query_embeddings=[query_vec], n_results=int(top_k))
+    # 标识符/人名类查询直接走 BM25 关键词索引，混合查询做融合排序
+    with search_gate.foreground():
+        results = search_pages(query, paper_collection, query_encoder, keyword_index, n_results=int(top_k),
+                               filters=filters, offset=offset)
 
     if not results['ids'] or not results['ids'][0]:
-        return "未找到相关结果"
+        return "未找到相关结果", None
     
     output = ""
     for i, _ in enumerate(results['ids'][0]):
@@ -93,45 +92,80 @@ def search_docs(query, top_k):
         topic = meta.get('topic', 'N/A')
         page = meta.get('page', 'N/A')
         
-        output += f"### 📄 结果 {i+1}: {os.path.basename(path)}\n"
+        output += f"### 📄 结果 {offset + i + 1}: {os.path.basename(path)}\n"
         output += f"**Topic**: {topic} | **Page**: {page}\n\n"
         output += f"> ...{snippet[:300]}...\n"
         output += "---\n"
-    return output
+    if results["next_offset"] is None:
+        output += "\n已是最后一页"
+    return output, results["next_offset"]
+
+def search_next_page(query, top_k, topics, path, pages, next_offset):
+    """下一页：从上次返回的 next_offset 继续"""
+    if next_offset is None:
+        return "已是最后一页", gr.update(), None
+    output, following = search_docs(query, top_k, topics, path, pages, next_offset)
+    return output, next_offset, following
+
+def search_prev_page(query, top_k, topics, path, pages, offset):
+    """上一页：起始位置 (当前页的起点) 回退一页"""
+    offset = int(offset or 0)
+    if offset <= 0:
+        return "已是第一页", 0, gr.update()
+    previous = max(offset - int(top_k), 0)
+    output, following = search_docs(query, top_k, topics, path, pages, previous)
+    return output, previous, following
+
+def show_facets():
+    """各分类 / 目录的论文数 (来自文件登记表)，同时刷新分类下拉框的选项"""
+    facets = get_paper_registry().facets()
+    return format_facets(facets), gr.update(choices=[topic for topic, _, _ in facets["topics"]])
 
 def index_local_images():
-    """索引 data 目录图片"""
-    image_dir = "data"
-    valid_exts = ['.jpg', '.jpeg', '.png']
-    count = 0
-    for root, _, files in os.walk(image_dir):
-        for file in files:
-            if any(file.lower().endswith(ext) for ext in valid_exts):
-                full_path = os.path.join(root, file)
-                try:
-                    img = Image.open(full_path)
-                    vec = model_handler.get_image_embedding(img)
-                    image_collection.upsert(ids=[file], embeddings=[vec], metadatas=[{"path": full_path}])
-                    count += 1
-                except: pass
-    return f"✅ 重建索引完成！共索引 {count} 张图片。"
+    """增量索引 data 目录图片"""
+    stats = ImageIndexer(image_collection, model_handler).sync("data")
+    return f"✅ 重建索引完成！{format_stats(stats)}"
 
 def search_imgs(query):
     """以文搜图"""
     if not query: return []
     
-    query_vec = model_handler.get_text_for_image_embedding(query)
-    results = image_collection.query(query_embeddings=[query_vec], n_results=4)
+    with search_gate.foreground():
+        query_vec = query_encoder.get_text_for_image_embedding(query)
+        results = image_collection.query(query_embeddings=[query_vec], n_results=4)
     
     images = []
     if results['ids'] and results['ids'][0]:
-        for i, _ in enumerate(results['ids'][0]):
+        # 每组近似重复只有代表图片入库，标注被合并的副本数
+        dups = duplicate_counts(results['ids'][0])
+        for i, doc_id in enumerate(results['ids'][0]):
             meta = results['metadatas'][0][i]
             img_path = meta['path']
             if os.path.exists(img_path):
-                images.append((img_path, f"Result {i+1}"))
+                extra = f" (+{dups[doc_id]} 张近似重复)" if dups.get(doc_id) else ""
+                images.append((img_path, f"Result {i+1}{extra}"))
     return images
 
+def show_cache_stats():
+    """查询缓存命中统计"""
+    lines = ["| 缓存 | 命中 | 未命中 | 命中率 | 条目数 |", "|---|---|---|---|---|"]
+    caches = {"查询向量": model_handler.query_cache.stats()}
+    if model_handler.cache_stats():
+        caches["向量缓存 (磁盘)"] = model_handler.cache_stats()
+    for name, stats in result_cache_stats().items():
+        caches[f"检索结果 [{name}]"] = stats
+    for name, stats in caches.items():
+        lines.append(f"| {name} | {stats['hits']} | {stats['misses']} | {stats['hit_rate']:.1%} | {stats['entries']} |")
+
+    lines += ["", "| 查询合批 | 请求数 | 批次数 | 平均批大小 | 最大批 | 平均等待 (ms) | 最长等待 (ms) |",
+              "|---|---|---|---|---|---|---|"]
+    for name, stats in query_encoder.stats().items():
+        lines.append(f"| {name} | {stats['requests']} | {stats['batches']} | {stats['mean_batch']:.2f} "
+                     f"| {stats['largest_batch']} | {stats['mean_wait_ms']:.2f} | {stats['max_wait_ms']:.2f} |")
+    # 向量库后端由 AGENT_VECTOR_STORE 选择 (chroma / mmap)
+    lines += ["", f"向量库后端: {db.VECTOR_STORE}"]
+    return "\n".join(lines)
+
 # --- 构建 UI ---
 with gr.Blocks(title="多模态 AI 助手") as demo:
     gr.Markdown("# 🤖 本地多模态 AI 智能助手")
@@ -143,17 +177,48 @@ with gr.Blocks(title="多模态 AI 助手") as demo:
             topics_input = gr.Textbox(label="分类主题 (逗号分隔)", value="CV,NLP,Agent,RL")
         upload_btn = gr.Button("开始处理", variant="primary")
         upload_output = gr.Textbox(label="处理结果")
+
+        with gr.Accordion("导入任务", open=True):
+            jobs_btn = gr.Button("刷新进度")
+            jobs_output = gr.Markdown()
+        jobs_btn.click(show_jobs, outputs=jobs_output)
         
-        upload_btn.click(process_upload, inputs=[file_input, topics_input], outputs=upload_output)
+        upload_btn.click(process_upload, inputs=[file_input, topics_input], outputs=[upload_output, jobs_output])
 
     with gr.Tab("🔍 语义文献搜索"):
         gr.Markdown("输入自然语言问题，搜索相关论文片段。")
         search_input = gr.Textbox(label="输入问题", placeholder="例如: How does transformer work?")
-        top_k_slider = gr.Slider(minimum=1, maximum=10, value=3, step=1, label="返回结果数量")
-        search_btn = gr.Button("搜索")
+        with gr.Row():
+            top_k_slider = gr.Slider(minimum=1, maximum=50, value=3, step=1, label="每页结果数量")
+            offset_input = gr.Number(value=0, precision=0, label="起始位置 (跳过前 N 条)")
+        with gr.Row():
+            topic_filter = gr.Dropdown(choices=[t for t, _, _ in get_paper_registry().facets()["topics"]],
+                                       multiselect=True, label="分类 (可多选，留空不限)")
+            path_filter = gr.Textbox(label="论文或目录路径 (逗号分隔，留空不限)")
+            pages_filter = gr.Textbox(label="页码范围", placeholder="例如: 3-10")
+        with gr.Row():
+            search_btn = gr.Button("搜索")
+            prev_btn = gr.Button("上一页")
+            next_btn = gr.Button("下一页")
         search_output = gr.Markdown(label="搜索结果")
-        
-        search_btn.click(search_docs, inputs=[search_input, top_k_slider], outputs=search_output)
+        next_offset = gr.State(None)
+
+        filter_inputs = [search_input, top_k_slider, topic_filter, path_filter, pages_filter]
+        search_btn.click(search_docs, inputs=filter_inputs + [offset_input], outputs=[search_output, next_offset])
+        next_btn.click(search_next_page, inputs=filter_inputs + [next_offset],
+                       outputs=[search_output, offset_input, next_offset])
+        prev_btn.click(search_prev_page, inputs=filter_inputs + [offset_input],
+                       outputs=[search_output, offset_input, next_offset])
+
+        with gr.Accordion("分类与目录统计", open=False):
+            facets_btn = gr.Button("刷新")
+            facets_output = gr.Markdown()
+        facets_btn.click(show_facets, outputs=[facets_output, topic_filter])
+
+        with gr.Accordion("缓存统计", open=False):
+            stats_btn = gr.Button("刷新")
+            stats_output = gr.Markdown()
+        stats_btn.click(show_cache_stats, outputs=stats_output)
 
     with gr.Tab("🖼️ 以文搜图"):
         gr.Markdown("输入描述搜索本地图片。请确保 data 目录下有图片。")
@@ -170,4 +235,16 @@ with gr.Blocks(title="多模态 AI 助手") as demo:
         img_btn.click(search_imgs, inputs=img_query, outputs=gallery)
 
 if __name__ == "__main__":
-    demo.launch(server_name="0.0.0.0", server_port=7860)
\ No newline at end of file
+    # 把 Gradio 挂到 FastAPI 上，额外提供 Prometheus 抓取用的 /metrics
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import PlainTextResponse
+
+    server = FastAPI()
+
+    @server.get("/metrics")
+    def prometheus_metrics():
+        return PlainTextResponse(metrics.REGISTRY.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+    server = gr.mount_gradio_app(server, demo, path="/")
+    uvicorn.run(server, host="0.0.0.0", port=7860)
\ No newline at end of file
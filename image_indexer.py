@@ -0,0 +1,461 @@
+import hashlib
+import math
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+import metrics
+from utils import file_hash
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png')
+DEFAULT_MANIFEST_PATH = "./db/image_manifest.sqlite3"
+# CLIP ViT-B/32 的输入分辨率，预处理会把短边缩放到该尺寸后中心裁剪
+CLIP_INPUT_SIZE = 224
+# 256 位 dHash (16x16 网格)：64 位版本对大色块构成的图片区分度不够，容易误合并不同图片
+HASH_SIZE = 16
+HASH_BYTES = HASH_SIZE * HASH_SIZE // 8
+# dHash 汉明距离不超过该值视为近似重复 (重新保存 / 缩放的副本多数为 0-4)；None 关闭分组
+DEFAULT_DUP_DISTANCE = 4
+# 置位数过少或过多的 dHash 来自近乎纯色的图片，不同图片也会相同，这类图片不参与分组
+_MIN_HASH_BITS = HASH_SIZE * HASH_SIZE // 16
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def image_id(path):
+    """由规范化的绝对路径派生稳定的行 id，不同目录下的同名文件不会互相覆盖"""
+    norm = os.path.normcase(os.path.abspath(path))
+    return "img_" + hashlib.sha1(norm.encode("utf-8")).hexdigest()
+
+
+@metrics.instrument("image.decode")
+def load_image(path, target=CLIP_INPUT_SIZE):
+    """按 CLIP 所需尺寸解码图片：JPEG 走 draft 模式直接低分辨率解码，其余格式解码后缩小"""
+    with Image.open(path) as img:
+        w, h = img.size
+        scale = target / min(w, h)
+        if scale < 1:
+            # draft 只会缩小到不小于请求尺寸，短边仍 >= target
+            img.draft("RGB", (math.ceil(w * scale), math.ceil(h * scale)))
+        img = img.convert("RGB")
+    w, h = img.size
+    scale = target / min(w, h)
+    if scale < 1:
+        img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BICUBIC)
+    return img
+
+
+def dhash(img, size=HASH_SIZE):
+    """差分哈希：灰度缩到 (size+1)xsize，比较左右相邻像素，返回 size*size/8 字节；对缩放、重新压缩不敏感"""
+    gray = np.asarray(img.convert("L").resize((size + 1, size), Image.BILINEAR), dtype=np.int16)
+    return np.packbits(gray[:, 1:] > gray[:, :-1]).tobytes()
+
+
+def _informative(h):
+    bits = int(_POPCOUNT[np.frombuffer(h, dtype=np.uint8)].sum())
+    return _MIN_HASH_BITS <= bits <= len(h) * 8 - _MIN_HASH_BITS
+
+
+class HashIndex:
+    """各组代表图片的 dHash，按汉明距离查找近似重复的组
+
+    多索引哈希：256 位分成 8 段，距离不超过 7 的两个哈希至少有一段完全相同，只需比较
+    段相同的候选；更大的距离阈值退回到对全部哈希的 numpy 逐字节查表计数。
+    """
+
+    CHUNKS = 8
+
+    def __init__(self):
+        self._hashes = np.zeros((64, HASH_BYTES), dtype=np.uint8)
+        self._ids = []
+        self._buckets = [{} for _ in range(self.CHUNKS)]
+
+    def _chunks(self, h):
+        step = len(h) // self.CHUNKS
+        return [h[i * step:(i + 1) * step] for i in range(self.CHUNKS)]
+
+    def add(self, h, group_id):
+        n = len(self._ids)
+        if n == len(self._hashes):
+            self._hashes = np.concatenate([self._hashes, np.zeros_like(self._hashes)])
+        self._hashes[n] = np.frombuffer(h, dtype=np.uint8)
+        self._ids.append(group_id)
+        for bucket, chunk in zip(self._buckets, self._chunks(h)):
+            bucket.setdefault(chunk, []).append(n)
+
+    def nearest(self, h, max_distance):
+        """距离不超过 max_distance 的最近组，返回 (组 id, 汉明距离)；没有时返回 (None, None)"""
+        if not self._ids:
+            return None, None
+        query = np.frombuffer(h, dtype=np.uint8)
+        if max_distance < self.CHUNKS:
+            candidates = {i for bucket, chunk in zip(self._buckets, self._chunks(h)) for i in bucket.get(chunk, ())}
+            if not candidates:
+                return None, None
+            rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        else:
+            rows = np.arange(len(self._ids))
+        dist = _POPCOUNT[self._hashes[rows] ^ query].sum(axis=1, dtype=np.int32)
+        i = int(dist.argmin())
+        if dist[i] > max_distance:
+            return None, None
+        return self._ids[rows[i]], int(dist[i])
+
+
+def duplicate_counts(row_ids, manifest_path=DEFAULT_MANIFEST_PATH):
+    """检索结果中每行代表的近似重复文件数 (不含代表图片本身)，用于在结果中标注"""
+    if not row_ids or not os.path.exists(manifest_path):
+        return {}
+    conn = sqlite3.connect(manifest_path)
+    try:
+        marks = ",".join("?" * len(row_ids))
+        rows = conn.execute(
+            f"SELECT group_id, COUNT(*) FROM manifest WHERE group_id IN ({marks}) AND id != group_id"
+            " GROUP BY group_id", list(row_ids)
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # 旧版清单没有 group_id 列
+        return {}
+    finally:
+        conn.close()
+    return dict(rows)
+
+
+def iter_decoded(items, load, workers=4, max_in_flight=64):
+    """在线程池中解码，按提交顺序产出 (item, image, error)；在途图片数不超过 max_in_flight"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = deque()
+        for item in items:
+            if len(futures) >= max_in_flight:
+                yield _collect(futures.popleft())
+            futures.append((item, pool.submit(load, item["path"])))
+        while futures:
+            yield _collect(futures.popleft())
+
+
+def _collect(entry):
+    item, future = entry
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        return item, None, e
+
+
+class ImageIndexer:
+    """增量图片索引：用 (路径, 大小, mtime[, 内容哈希]) 清单只处理新增/修改/删除的文件
+
+    近似重复的图片 (dHash 距离 <= dup_distance) 归为一组，只有组内第一张 (代表) 送入 CLIP 并写入
+    collection；其余成员只记在清单中，group_id 指向代表的行 id，检索结果因此每组只出现一次。
+    """
+
+    def __init__(self, collection, model_handler, manifest_path=DEFAULT_MANIFEST_PATH,
+                 use_hash=False, batch_size=32, decode_workers=4, max_in_flight=64,
+                 dup_distance=DEFAULT_DUP_DISTANCE):
+        self.collection = collection
+        self.model_handler = model_handler
+        self.use_hash = use_hash
+        self.dup_distance = dup_distance
+        # 每批送入 CLIP 的图片数 (同时也是每次 upsert 的行数)
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        # 已提交解码但尚未编码的图片上限，决定峰值内存
+        self.max_in_flight = max_in_flight
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+        self._conn = sqlite3.connect(manifest_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            " abspath TEXT PRIMARY KEY, id TEXT NOT NULL, size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL, hash TEXT)"
+        )
+        # 旧版清单补上近似重复分组所需的列；group_id 为空的行视为自成一组
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(manifest)")}
+        for column in ("phash", "group_id"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE manifest ADD COLUMN {column} TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS manifest_group ON manifest (group_id)")
+        self._conn.commit()
+
+    def _scan(self, image_dir):
+        """遍历目录，只做 stat，不打开图片"""
+        found = {}
+        for root, _, files in os.walk(image_dir):
+            for file in files:
+                if file.lower().endswith(IMAGE_EXTS):
+                    path = os.path.join(root, file)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    found[os.path.abspath(path)] = (path, st.st_size, st.st_mtime_ns)
+        return found
+
+    def _load_manifest(self, image_dir):
+        prefix = os.path.join(os.path.abspath(image_dir), "")
+        rows = self._conn.execute(
+            "SELECT abspath, id, size, mtime_ns, hash FROM manifest WHERE substr(abspath, 1, ?) = ?",
+            (len(prefix), prefix)
+        ).fetchall()
+        return {r[0]: r[1:] for r in rows}
+
+    def _drop_legacy_rows(self, image_dir):
+        """清理旧版本以裸文件名为 id 写入的行，避免与新的路径 id 重复"""
+        prefix = os.path.join(os.path.abspath(image_dir), "")
+        rows = self.collection.get(include=["metadatas"])
+        legacy = []
+        for row_id, meta in zip(rows["ids"], rows["metadatas"]):
+            path = (meta or {}).get("path")
+            if path and os.path.abspath(path).startswith(prefix) and row_id != image_id(path):
+                legacy.append(row_id)
+        if legacy:
+            self.collection.delete(ids=legacy)
+        return len(legacy)
+
+    def _commit(self, pending):
+        """写入一批向量，成功后再更新清单，保证中断时清单不超前于数据库"""
+        if not pending:
+            return
+        canonical = [p for p in pending if p["group_id"] == p["id"]]
+        if canonical:
+            self.collection.upsert(
+                ids=[p["id"] for p in canonical],
+                embeddings=np.stack([p["vec"] for p in canonical]),
+                metadatas=[{"path": p["path"]} for p in canonical]
+            )
+        members = [p["id"] for p in pending if p["group_id"] != p["id"]]
+        if members:
+            # 成员以前可能单独有一行 (分组之前建的索引)，并入组后删除
+            self.collection.delete(ids=members)
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO manifest (abspath, id, size, mtime_ns, hash, phash, group_id)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(p["abspath"], p["id"], p["size"], p["mtime_ns"], p["hash"], p["phash"], p["group_id"])
+             for p in pending]
+        )
+        self._conn.commit()
+        pending.clear()
+
+    def _embed_and_commit(self, pending, images, stats, verbose):
+        if not pending:
+            return
+        canonical = [p for p in pending if p["group_id"] == p["id"]]
+        if canonical:
+            vecs = self.model_handler.get_image_embeddings(images, batch_size=self.batch_size)
+            for item, vec in zip(canonical, vecs):
+                item["vec"] = vec
+        for item in pending:
+            stats["added" if item["is_new"] else "updated"] += 1
+            if verbose:
+                suffix = "" if item["group_id"] == item["id"] else " (near-duplicate, not embedded)"
+                print(f"Indexed image: {item['path']}{suffix}")
+        stats["embedded"] += len(canonical)
+        self._commit(pending)
+        images.clear()
+
+    def _detach(self, abspaths, paths):
+        """把文件移出所在的组 (删除或修改前调用)：代表被移出时由组内下一张接替，沿用原向量不重新编码
+
+        paths: abspath -> 目录扫描得到的路径，写入接替者的 metadata。
+        """
+        orphaned = []
+        for abspath in abspaths:
+            row = self._conn.execute(
+                "SELECT id, COALESCE(group_id, id) FROM manifest WHERE abspath=?", (abspath,)
+            ).fetchone()
+            self._conn.execute("DELETE FROM manifest WHERE abspath=?", (abspath,))
+            if row is None or row[0] != row[1]:
+                continue
+            members = self._conn.execute(
+                "SELECT abspath, id FROM manifest WHERE group_id=? ORDER BY abspath", (row[0],)
+            ).fetchall()
+            if not members:
+                orphaned.append(row[0])
+                continue
+            heir_abspath, heir_id = members[0]
+            old = self.collection.get(ids=[row[0]], include=["embeddings"])
+            if len(old["ids"]):
+                self.collection.upsert(ids=[heir_id], embeddings=old["embeddings"],
+                                       metadatas=[{"path": paths.get(heir_abspath, heir_abspath)}])
+            self.collection.delete(ids=[row[0]])
+            self._conn.execute("UPDATE manifest SET group_id=? WHERE group_id=?", (heir_id, row[0]))
+        if orphaned:
+            self.collection.delete(ids=orphaned)
+        self._conn.commit()
+
+    def _hash_index(self):
+        """由清单中各组的代表图片建立 dHash 索引 (旧版清单中没有 phash 的行不参与)
+
+        只比较代表图片，不把成员的哈希加入索引，避免 A~B~C 链式地把不相似的图片并成一组。
+        """
+        index = HashIndex()
+        for row_id, phash in self._conn.execute(
+            "SELECT id, phash FROM manifest WHERE phash IS NOT NULL AND group_id = id"
+        ):
+            h = bytes.fromhex(phash)
+            if len(h) == HASH_BYTES and _informative(h):
+                index.add(h, row_id)
+        return index
+
+    def manifest_rows(self):
+        """导出清单 (快照用)，每行附带相对当前目录的路径，新节点按它在自己的目录下找回文件"""
+        rows = []
+        for abspath, row_id, size, mtime_ns, digest, phash, group_id in self._conn.execute(
+            "SELECT abspath, id, size, mtime_ns, hash, phash, group_id FROM manifest ORDER BY abspath"
+        ):
+            try:
+                path = os.path.relpath(abspath)
+            except ValueError:
+                # Windows 上不同盘符之间没有相对路径
+                path = abspath
+            rows.append({"path": path, "abspath": abspath, "id": row_id, "size": size, "mtime_ns": mtime_ns,
+                         "hash": digest, "phash": phash, "group_id": group_id})
+        return rows
+
+    def restore(self, rows, batch=5000, log=print):
+        """导入快照后写回清单，下次 sync 不再重新编码快照中已有的图片；返回找回的文件数
+
+        先按相对路径 (项目目录整体搬迁的情况)、再按原绝对路径找文件：找到且内容一致 (有内容哈希时比较哈希，
+        否则比较大小) 时按本机的 stat 登记，行 id 随路径变化时同时改写向量行的 id 与 path。
+        找不到的文件按原样登记，之后同步原目录时作为已删除处理；内容不一致的保留原 (大小, mtime)，
+        同步时按修改过的文件重新编码。
+        """
+        found, renamed, entries = 0, {}, []
+        for row in rows:
+            path = next((p for p in (row["path"], row["abspath"]) if os.path.exists(p)), None)
+            entry = dict(row)
+            if path is not None:
+                entry["path"], entry["abspath"], entry["id"] = path, os.path.abspath(path), image_id(path)
+                st = os.stat(path)
+                size, mtime_ns = st.st_size, st.st_mtime_ns
+                if row["hash"] is not None:
+                    same = file_hash(path) == row["hash"]
+                else:
+                    same = size == row["size"]
+                if same:
+                    entry["size"], entry["mtime_ns"] = size, mtime_ns
+                    found += 1
+                if entry["id"] != row["id"]:
+                    renamed[row["id"]] = entry["id"]
+            entries.append(entry)
+        for entry in entries:
+            if entry["group_id"] is not None:
+                entry["group_id"] = renamed.get(entry["group_id"], entry["group_id"])
+
+        # 代表图片的向量行换成新路径的 id
+        paths = {entry["id"]: entry["path"] for entry in entries}
+        canonical = {entry["id"] for entry in entries if entry["group_id"] in (None, entry["id"])}
+        old_ids = [old for old, new in renamed.items() if new in canonical]
+        for start in range(0, len(old_ids), batch):
+            chunk = old_ids[start:start + batch]
+            old = self.collection.get(ids=chunk, include=["embeddings", "metadatas"])
+            if not len(old["ids"]):
+                continue
+            new_ids = [renamed[row_id] for row_id in old["ids"]]
+            self.collection.upsert(ids=new_ids, embeddings=old["embeddings"],
+                                   metadatas=[{**(meta or {}), "path": paths[new_id]}
+                                              for new_id, meta in zip(new_ids, old["metadatas"])])
+            self.collection.delete(ids=list(old["ids"]))
+
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO manifest (abspath, id, size, mtime_ns, hash, phash, group_id)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(e["abspath"], e["id"], e["size"], e["mtime_ns"], e["hash"], e["phash"], e["group_id"])
+             for e in entries]
+        )
+        self._conn.commit()
+        if entries:
+            log(f"Restored {len(entries)} image manifest entries ({found} files found on this node)")
+        return found
+
+    def sync(self, image_dir, verbose=False):
+        """同步目录与索引，返回统计信息"""
+        start = time.perf_counter()
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "failed": 0,
+                 "embedded": 0, "duplicates": 0}
+
+        manifest = self._load_manifest(image_dir)
+        if not manifest:
+            stats["removed"] += self._drop_legacy_rows(image_dir)
+        found = self._scan(image_dir)
+
+        # 1. 删除已不存在的文件对应的行
+        paths = {abspath: entry[0] for abspath, entry in found.items()}
+        removed = [p for p in manifest if p not in found]
+        if removed:
+            self._detach(removed, paths)
+            stats["removed"] += len(removed)
+
+        # 2. 找出新增或修改过的文件
+        todo = []
+        for abspath, (path, size, mtime_ns) in found.items():
+            old = manifest.get(abspath)
+            if old is not None and old[1] == size and old[2] == mtime_ns:
+                stats["unchanged"] += 1
+                continue
+
+            digest = None
+            if self.use_hash:
+                try:
+                    digest = file_hash(path)
+                except OSError:
+                    stats["failed"] += 1
+                    continue
+                if old is not None and old[3] == digest:
+                    # 仅 mtime 变化、内容未变：只更新清单
+                    self._conn.execute(
+                        "UPDATE manifest SET size=?, mtime_ns=? WHERE abspath=?",
+                        (size, mtime_ns, abspath)
+                    )
+                    stats["unchanged"] += 1
+                    continue
+
+            todo.append({
+                "abspath": abspath, "id": image_id(path), "path": path,
+                "size": size, "mtime_ns": mtime_ns, "hash": digest, "is_new": old is None
+            })
+
+        # 修改过的文件先移出原来的组，再按新内容重新分组
+        self._detach([item["abspath"] for item in todo if not item["is_new"]], paths)
+
+        # 3. 多线程缩小解码，按 dHash 归入已有的组或新建一组；只有新组的代表按批送入 CLIP
+        embed_start = time.perf_counter()
+        hashes = self._hash_index() if self.dup_distance is not None and todo else None
+        pending, images = [], []
+        for item, img, err in iter_decoded(todo, load_image, self.decode_workers, self.max_in_flight):
+            if err is not None:
+                print(f"Failed to index {item['path']}: {err}")
+                stats["failed"] += 1
+                continue
+            h = dhash(img) if hashes is not None else None
+            item["phash"] = h.hex() if h is not None else None
+            item["group_id"] = item["id"]
+            if h is not None and _informative(h):
+                group_id, _ = hashes.nearest(h, self.dup_distance)
+                if group_id is not None:
+                    item["group_id"] = group_id
+                    stats["duplicates"] += 1
+                else:
+                    hashes.add(h, item["id"])
+            pending.append(item)
+            if item["group_id"] == item["id"]:
+                images.append(img)
+            if len(images) >= self.batch_size or len(pending) >= 4 * self.batch_size:
+                self._embed_and_commit(pending, images, stats, verbose)
+
+        self._embed_and_commit(pending, images, stats, verbose)
+        embed_elapsed = time.perf_counter() - embed_start
+        # 只计真正送入 CLIP 的图片，归入已有组的近似重复图片不算吞吐
+        embedded = stats["embedded"]
+        stats["images_per_sec"] = embedded / embed_elapsed if embedded and embed_elapsed > 0 else 0.0
+        self._conn.commit()
+        stats["elapsed"] = time.perf_counter() - start
+        return stats
+
+
+def format_stats(stats):
+    return (f"新增 {stats['added']} / 更新 {stats['updated']} / 删除 {stats['removed']} / "
+            f"未变 {stats['unchanged']} / 失败 {stats['failed']}，耗时 {stats['elapsed']:.1f}s "
+            f"(编码 {stats['images_per_sec']:.1f} 张/秒)；近似重复 {stats['duplicates']} 张未编码，"
+            f"实际编码 {stats['embedded']} 张")
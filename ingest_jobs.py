@@ -0,0 +1,288 @@
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pypdf import PdfReader
+
+from paper_ingest import index_pdf
+from utils import file_hash, unique_path
+
+DEFAULT_JOBS_PATH = "./db/ingest_jobs.sqlite3"
+# 上传文件在入队时复制到这里，服务重启后任务仍能找到原文件
+DEFAULT_STAGING_DIR = "./db/uploads"
+# 后台任务的窗口较小，前台检索最多等待一个小窗口的编码
+BACKGROUND_WINDOW = 16
+
+STATUS_LABELS = {"queued": "排队中", "running": "处理中", "done": "完成", "failed": "失败"}
+# 处理中的任务每个窗口都会更新进度；超过这么久没有更新的视为失联 (其他主机上的进程只能这样判断)
+STALE_AFTER = 600.0
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ForegroundGate:
+    """前台请求 (检索) 优先：后台任务在每个窗口编码前等待所有前台请求结束"""
+
+    def __init__(self, max_wait=2.0):
+        # 持续有检索时最多让出 max_wait 秒，避免后台任务饿死
+        self.max_wait = max_wait
+        self._active = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def foreground(self):
+        with self._cond:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def wait_idle(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._active == 0, timeout=self.max_wait)
+
+
+class JobQueue:
+    """SQLite 持久化的论文导入任务队列，重启后未完成的任务重新排队
+
+    两个 Web 界面可以同时运行并共用同一个队列：领取任务是带条件的 UPDATE (只有仍在排队时才成功)，
+    处理中的任务记录领取者 (主机名:pid:随机串)，只有领取者已退出或长时间没有进度的任务才会重新排队。
+    """
+
+    def __init__(self, path=DEFAULT_JOBS_PATH, staging_dir=DEFAULT_STAGING_DIR):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        os.makedirs(staging_dir, exist_ok=True)
+        self.staging_dir = staging_dir
+        # 随机串区分重启后复用了同一 pid 的进程 (容器中很常见)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, staged_path TEXT NOT NULL,"
+            " file_hash TEXT NOT NULL, topics TEXT, status TEXT NOT NULL, pages_done INTEGER NOT NULL DEFAULT 0,"
+            " pages_total INTEGER, topic TEXT, final_path TEXT, message TEXT,"
+            " created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        # 旧版任务表补上领取者
+        if "owner" not in {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        self._conn.commit()
+
+    def submit(self, src_path, name, topics=None):
+        """复制文件到暂存目录并入队，返回任务 id；同一文件已在排队/处理中时返回已有任务"""
+        key = file_hash(src_path)
+        with self._lock:
+            # 查重与插入在同一个写事务中，另一个进程同时提交同一文件时不会入队两次
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT id FROM jobs WHERE file_hash=? AND status IN ('queued', 'running')", (key,)
+            ).fetchone()
+            if row:
+                self._conn.rollback()
+                return row[0]
+            staged_path = os.path.join(self.staging_dir, f"{key[:12]}_{name}")
+            shutil.copy(src_path, staged_path)
+            now = time.time()
+            job_id = self._conn.execute(
+                "INSERT INTO jobs (name, staged_path, file_hash, topics, status, created, updated)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?)", (name, staged_path, key, topics, now, now)
+            ).lastrowid
+            self._conn.commit()
+        self._wakeup.set()
+        return job_id
+
+    def update(self, job_id, **fields):
+        fields["updated"] = time.time()
+        cols = ", ".join(f"{k}=?" for k in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {cols} WHERE id=?", (*fields.values(), job_id))
+            self._conn.commit()
+
+    def claim(self):
+        """取出最早的排队任务并标记为由本进程处理，没有时返回 None
+
+        多个进程同时领取同一个任务时只有一个 UPDATE 生效 (rowcount 为 1)，其余的继续尝试下一个。
+        """
+        with self._lock:
+            while True:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status='queued' ORDER BY id LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                claimed = self._conn.execute(
+                    "UPDATE jobs SET status='running', owner=?, updated=? WHERE id=? AND status='queued'",
+                    (self.owner, time.time(), row[0])
+                ).rowcount
+                self._conn.commit()
+                if claimed:
+                    break
+        return self.get(row[0])
+
+    def _stale(self, owner, updated):
+        if owner == self.owner:
+            return False
+        # 旧版没有领取者的任务、长时间没有进度的任务，以及本机上已退出的进程领取的任务
+        parts = (owner or "").split(":")
+        if len(parts) != 3 or not parts[1].isdigit() or time.time() - updated > STALE_AFTER:
+            return True
+        return parts[0] == socket.gethostname() and not _pid_alive(int(parts[1]))
+
+    def requeue_stale(self):
+        """领取者已退出的处理中任务重新排队 (其他仍在运行的进程的任务不动)；已写入的页由 IngestProgress 跳过"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, owner, updated FROM jobs WHERE status='running'").fetchall()
+            n = 0
+            for job_id, owner, updated in rows:
+                if not self._stale(owner, updated):
+                    continue
+                # 领取者未变时才改回排队，避免与其他进程同时接管
+                n += self._conn.execute(
+                    "UPDATE jobs SET status='queued', owner=NULL, updated=? WHERE id=? AND status='running'"
+                    " AND owner IS ?", (time.time(), job_id, owner)
+                ).rowcount
+            self._conn.commit()
+        return n
+
+    def get(self, job_id):
+        with self._lock:
+            cur = self._conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,))
+            row = cur.fetchone()
+            cols = [d[0] for d in cur.description]
+        return dict(zip(cols, row)) if row else None
+
+    def list(self, limit=20):
+        """最近的任务，最新的在前"""
+        with self._lock:
+            cur = self._conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+            cols = [d[0] for d in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def wait(self, timeout):
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+
+class IngestWorker(threading.Thread):
+    """单个后台线程按提交顺序处理导入任务，编码前让出给前台检索"""
+
+    def __init__(self, jobs, model_handler, collection, progress, keyword_index=None,
+                 gate=None, data_dir="data", window=BACKGROUND_WINDOW, poll_interval=5.0,
+                 summary_collection=None, registry=None):
+        super().__init__(daemon=True, name="ingest-worker")
+        self.jobs = jobs
+        self.model_handler = model_handler
+        self.collection = collection
+        self.progress = progress
+        self.keyword_index = keyword_index
+        self.summary_collection = summary_collection
+        self.registry = registry
+        self.gate = gate
+        self.data_dir = data_dir
+        self.window = window
+        self.poll_interval = poll_interval
+
+    def run(self):
+        self.jobs.requeue_stale()
+        while True:
+            job = self.jobs.claim()
+            if job is None:
+                # 空闲时顺带接管已退出的其他进程留下的任务
+                self.jobs.wait(self.poll_interval)
+                self.jobs.requeue_stale()
+                continue
+            try:
+                self._process(job)
+            except Exception as e:
+                self.jobs.update(job["id"], status="failed", message=str(e))
+
+    def _process(self, job):
+        job_id, staged_path = job["id"], job["staged_path"]
+        if not os.path.exists(staged_path):
+            self.jobs.update(job_id, status="failed", message="暂存文件丢失，请重新上传")
+            return
+        key, known = self.registry.find(staged_path) if self.registry is not None else (None, None)
+        if known is not None:
+            self._process_known(job, key, known)
+            return
+        doc_id = None
+        if self.registry is not None:
+            self.registry.drop_replaced(staged_path, key, self.collection, self.summary_collection,
+                                        self.keyword_index)
+            doc_id = self.registry.assign_doc_id(key, job["name"])
+        self.jobs.update(job_id, pages_total=len(PdfReader(staged_path).pages))
+
+        def before_window(indexed):
+            self.jobs.update(job_id, pages_done=indexed)
+            if self.gate is not None:
+                self.gate.wait_idle()
+
+        topic_list = job["topics"].split(',') if job["topics"] else None
+        result = index_pdf(
+            staged_path, self.model_handler, self.collection, topic_list,
+            place=lambda topic: unique_path(os.path.join(self.data_dir, topic, job["name"])),
+            window=self.window, progress=self.progress, log=lambda msg: None,
+            keyword_index=self.keyword_index, before_window=before_window,
+            summary_collection=self.summary_collection, doc_id=doc_id
+        )
+        if result is None:
+            os.remove(staged_path)
+            self.jobs.update(job_id, status="failed", message="无法提取文本，请检查 PDF 文件。")
+            return
+
+        # 先复制再标记完成，最后删除暂存文件：任一步中断后重启都能得到一致的结果
+        final_path = result["final_path"]
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        shutil.copy(staged_path, final_path)
+        if self.registry is not None:
+            self.registry.record(key, final_path, result["topic"], result["pages"], result["last_page"])
+        self.jobs.update(job_id, status="done", pages_done=result["pages"], topic=result["topic"],
+                         final_path=final_path, message=None)
+        self.progress.done(result["key"])
+        os.remove(staged_path)
+
+    def _process_known(self, job, key, known):
+        """已导入过的内容：不提取也不编码；原文件已不在登记的位置时复制到分类目录并只更新 path"""
+        job_id, staged_path = job["id"], job["staged_path"]
+        final_path, message = known["path"], "内容与已导入的论文相同，未重复导入"
+        if not os.path.exists(final_path):
+            final_path = unique_path(os.path.join(self.data_dir, known["topic"] or "Uncategorized", job["name"]))
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            shutil.copy(staged_path, final_path)
+            self.registry.relocate(key, final_path, self.collection, self.summary_collection)
+            message = "已导入过，仅更新了文件路径"
+        self.jobs.update(job_id, status="done", pages_total=known["pages"], pages_done=known["pages"],
+                         topic=known["topic"], final_path=final_path, message=message)
+        os.remove(staged_path)
+
+
+def format_jobs(jobs):
+    """任务列表的 Markdown 表格 (两个 Web 界面共用)"""
+    if not jobs:
+        return "暂无导入任务"
+    lines = ["| # | 文件 | 状态 | 进度 | 分类 | 说明 |", "|---|---|---|---|---|---|"]
+    for job in jobs:
+        total = job["pages_total"]
+        pages = f"{job['pages_done']}/{total} 页" if total else f"{job['pages_done']} 页"
+        lines.append(
+            f"| {job['id']} | {job['name']} | {STATUS_LABELS.get(job['status'], job['status'])} | {pages} "
+            f"| {job['topic'] or ''} | {job['message'] or ''} |"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,344 @@
+import heapq
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+
+import metrics
+from paper_summary import dedupe_per_paper, search_two_stage
+
+# 标识符类词元：字母数字串，允许中间出现 - _ . : / (如 ResNet-50、arXiv:1706.03762)
+_TOKEN_RE = re.compile(r"[A-Za-z0-9]+(?:[-_.:/][A-Za-z0-9]+)*")
+_PART_RE = re.compile(r"[A-Za-z0-9]+")
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "do", "does", "for", "from", "how", "in",
+    "is", "it", "of", "on", "or", "that", "the", "this", "to", "what", "when", "which", "why",
+    "with",
+}
+
+
+def tokenize(text):
+    """小写化后产出完整标识符及其组成部分，例如 resnet-50 -> resnet-50, resnet, 50"""
+    tokens = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        token = match.group()
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(_PART_RE.findall(token))
+    return tokens
+
+
+def _is_identifier(word):
+    # 含数字、内部标点 (连字符除外，self-attention 这类仍是普通词)、驼峰或全大写缩写，
+    # 例如 ResNet-50、GPT4、arXiv:1706.03762、BERT
+    word = word.strip("?,!;\"'()")
+    return (any(ch.isdigit() for ch in word)
+            or bool(re.search(r"[A-Za-z0-9][_.:/][A-Za-z0-9]", word))
+            or bool(re.search(r"[a-z][A-Z]", word))
+            or (len(word) >= 2 and word.isalpha() and word.isupper()))
+
+
+def _is_exact_identifier(word):
+    # 只能按字面匹配的标识符：含数字、内部标点，或带大写部分的连字符词
+    # (ResNet-50、arXiv:1706.03762、ViT-B/32、BERT-base)；BERT、ResNet 这类单词仍交给混合检索
+    word = word.strip("?,!;\"'()")
+    return (any(ch.isdigit() for ch in word)
+            or bool(re.search(r"[A-Za-z0-9][_.:/][A-Za-z0-9]", word))
+            or ("-" in word.strip("-") and not word.islower()))
+
+
+def query_mode(query):
+    """判断查询类型：lexical (引号短语或纯标识符)、hybrid (含标识符、人名或首字母大写的主题) 或 dense
+
+    只有引号短语和全部由精确标识符组成的短查询只走 BM25；"Vision Transformer"、"Yann LeCun"
+    这类首字母大写的主题或人名仍需要语义排序，走混合检索。
+    """
+    stripped = query.strip()
+    if len(stripped) > 1 and stripped[0] == stripped[-1] == '"':
+        return "lexical"
+    words = stripped.split()
+    if not words:
+        return "dense"
+    content = [w for w in words if w.lower().strip("?,.!") not in _STOPWORDS]
+    if len(words) <= 4 and content and all(_is_exact_identifier(w) for w in content):
+        return "lexical"
+    title_case = content and all(w[:1].isupper() for w in content)
+    if title_case or any(_is_identifier(w) for w in words):
+        return "hybrid"
+    return "dense"
+
+
+class KeywordIndex:
+    """SQLite 上的 BM25 倒排索引，按页面行 id 增量维护，与 paper_collection 的 id 一致"""
+
+    def __init__(self, path, k1=1.2, b=0.75, max_df_ratio=0.5):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.k1 = k1
+        self.b = b
+        self.max_df_ratio = max_df_ratio
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS terms ("
+            " term_id INTEGER PRIMARY KEY, term TEXT UNIQUE NOT NULL, df INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS docs ("
+            " doc_key INTEGER PRIMARY KEY, doc_id TEXT UNIQUE NOT NULL, length INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term_id INTEGER NOT NULL, doc_key INTEGER NOT NULL, tf INTEGER NOT NULL,"
+            " PRIMARY KEY (term_id, doc_key)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS idx_postings_doc ON postings(doc_key);"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);"
+            "INSERT OR IGNORE INTO meta VALUES ('n_docs', 0), ('total_len', 0);"
+        )
+        self._conn.commit()
+
+    def _meta(self):
+        return dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+
+    def _remove(self, ids):
+        removed_docs, removed_len = 0, 0
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            marks = ",".join("?" * len(part))
+            rows = self._conn.execute(
+                f"SELECT doc_key, length FROM docs WHERE doc_id IN ({marks})", part
+            ).fetchall()
+            if not rows:
+                continue
+            keys = [r[0] for r in rows]
+            key_marks = ",".join("?" * len(keys))
+            df_dec = self._conn.execute(
+                f"SELECT term_id, COUNT(*) FROM postings WHERE doc_key IN ({key_marks}) GROUP BY term_id", keys
+            ).fetchall()
+            self._conn.executemany("UPDATE terms SET df = df - ? WHERE term_id = ?", [(c, t) for t, c in df_dec])
+            self._conn.execute(f"DELETE FROM postings WHERE doc_key IN ({key_marks})", keys)
+            self._conn.execute(f"DELETE FROM docs WHERE doc_key IN ({key_marks})", keys)
+            removed_docs += len(rows)
+            removed_len += sum(r[1] for r in rows)
+        if removed_docs:
+            self._conn.execute("UPDATE meta SET value = value - ? WHERE key = 'n_docs'", (removed_docs,))
+            self._conn.execute("UPDATE meta SET value = value - ? WHERE key = 'total_len'", (removed_len,))
+
+    @metrics.instrument("bm25.add", batch=1)
+    def add(self, ids, texts):
+        """写入 (或覆盖) 一批页面；只涉及这些页面，代价与整个库的大小无关"""
+        # 同一批中重复的 id 只保留最后一次出现
+        latest = dict(zip(ids, texts))
+        ids = list(latest)
+        counts = [Counter(tokenize(t)) for t in latest.values()]
+        with self._lock:
+            self._remove(ids)
+            vocab = set()
+            for c in counts:
+                vocab.update(c)
+            self._conn.executemany("INSERT OR IGNORE INTO terms (term, df) VALUES (?, 0)", [(t,) for t in vocab])
+            term_ids = {}
+            vocab = list(vocab)
+            for start in range(0, len(vocab), 500):
+                part = vocab[start:start + 500]
+                marks = ",".join("?" * len(part))
+                term_ids.update(self._conn.execute(
+                    f"SELECT term, term_id FROM terms WHERE term IN ({marks})", part
+                ).fetchall())
+
+            postings, df_inc, total_len = [], Counter(), 0
+            for doc_id, c in zip(ids, counts):
+                length = sum(c.values())
+                total_len += length
+                doc_key = self._conn.execute(
+                    "INSERT INTO docs (doc_id, length) VALUES (?, ?)", (doc_id, length)
+                ).lastrowid
+                for term, tf in c.items():
+                    postings.append((term_ids[term], doc_key, tf))
+                    df_inc[term_ids[term]] += 1
+            self._conn.executemany("INSERT INTO postings (term_id, doc_key, tf) VALUES (?, ?, ?)", postings)
+            self._conn.executemany("UPDATE terms SET df = df + ? WHERE term_id = ?", [(c, t) for t, c in df_inc.items()])
+            self._conn.execute("UPDATE meta SET value = value + ? WHERE key = 'n_docs'", (len(ids),))
+            self._conn.execute("UPDATE meta SET value = value + ? WHERE key = 'total_len'", (total_len,))
+            self._conn.commit()
+
+    def remove(self, ids):
+        with self._lock:
+            self._remove(list(ids))
+            self._conn.commit()
+
+    def count(self):
+        with self._lock:
+            return self._meta()["n_docs"]
+
+    def _query_terms(self, query, n_docs):
+        """查询词元及其 (term_id, idf)：去掉停用词，并在还有更少见的词时跳过出现在过多页面里的词
+
+        这两类词对排序几乎没有贡献，却各自对应覆盖全库的倒排表，是长查询耗时的主要来源。
+        """
+        terms = set(tokenize(query))
+        terms = (terms - _STOPWORDS) or terms
+        if not terms:
+            return []
+        marks = ",".join("?" * len(terms))
+        rows = [(term_id, df) for term_id, df in self._conn.execute(
+            f"SELECT term_id, df FROM terms WHERE term IN ({marks})", list(terms)
+        ) if df > 0]
+        rare = [(term_id, df) for term_id, df in rows if df <= self.max_df_ratio * n_docs]
+        return [(term_id, math.log(1 + (n_docs - df + 0.5) / (df + 0.5))) for term_id, df in (rare or rows)]
+
+    @metrics.instrument("bm25.search")
+    def search(self, query, k=10, accept=None):
+        """BM25 检索，返回 [(doc_id, score)]，按得分降序；accept(doc_id) 为 False 的页面不参与排序
+
+        打分、累加和取前 k 都在 SQLite 中一条语句完成，过滤条件以 SQL 函数的形式对每个候选页面只调用一次。
+        """
+        with self._lock:
+            meta = self._meta()
+            n_docs = meta["n_docs"]
+            if not n_docs:
+                return []
+            terms = self._query_terms(query, n_docs)
+            if not terms:
+                return []
+            avgdl = meta["total_len"] / n_docs
+            having = ""
+            if accept is not None:
+                self._conn.create_function("bm25_accept", 1, lambda doc_id: bool(accept(doc_id)),
+                                           deterministic=True)
+                having = " HAVING bm25_accept(d.doc_id)"
+            values = ",".join("(?, ?)" for _ in terms)
+            rows = self._conn.execute(
+                f"WITH q(term_id, idf) AS (VALUES {values})"
+                " SELECT d.doc_id, SUM(q.idf * p.tf * ? / (p.tf + ? * (? + ? * d.length))) AS score"
+                " FROM q JOIN postings p ON p.term_id = q.term_id JOIN docs d ON d.doc_key = p.doc_key"
+                f" GROUP BY p.doc_key{having} ORDER BY score DESC, p.doc_key LIMIT ?",
+                [x for term in terms for x in term]
+                + [self.k1 + 1, self.k1, 1 - self.b, self.b / avgdl, k]
+            ).fetchall()
+        return [(doc_id, score) for doc_id, score in rows]
+
+
+# 按论文过滤后候选页面不超过这个数时，按 id 取回向量在本地精确排序，不走向量库的带 where 查询
+# (Chroma 带 where 的 query 在 10 万页的库上约 90 ms，按 id 取回 500 页约 30 ms)
+NARROW_PAGES = 500
+
+
+def dense_query(collection, query_embeddings, n_results, filters=None, include=("documents", "metadatas", "distances")):
+    """带过滤条件的向量检索，返回与 collection.query 相同结构的结果 (可多个查询)
+
+    过滤范围很窄 (已知论文的少量页面) 且向量库的带 where 查询不快时，按页面 id 取回向量，
+    用与库相同的 l2 距离在本地精确排序；否则把 where 下推给 collection.query。
+    """
+    include = list(include)
+    where = filters.where() if filters is not None else None
+    if filters is not None and filters.no_match:
+        return {key: [[] for _ in query_embeddings] for key in ["ids"] + include}
+    ids = None
+    if filters is not None and not getattr(collection, "fast_where", False):
+        ids = filters.page_ids(NARROW_PAGES)
+    if ids is None:
+        return collection.query(query_embeddings=query_embeddings, n_results=n_results, include=include,
+                                **({"where": where} if where else {}))
+
+    queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+    rows = collection.get(ids=ids, include=["embeddings"]) if ids else {"ids": []}
+    out = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+    if not len(rows["ids"]):
+        return {key: [[] for _ in queries] for key in ["ids"] + include}
+    vecs = np.asarray(rows["embeddings"], dtype=np.float32)
+    dist = ((vecs * vecs).sum(axis=1)[None, :] - 2.0 * (queries @ vecs.T) + (queries * queries).sum(axis=1)[:, None])
+    tops = [np.argsort(row, kind="stable")[:n_results] for row in dist]
+    # 命中行的文本和 metadata 一次取回
+    wanted = sorted({rows["ids"][i] for top in tops for i in top})
+    detail = collection.get(ids=wanted, include=["documents", "metadatas"]) if wanted else {"ids": []}
+    by_id = {row_id: (doc, meta) for row_id, doc, meta in zip(detail["ids"], detail.get("documents") or [],
+                                                              detail.get("metadatas") or [])}
+    for qi, top in enumerate(tops):
+        hit_ids = [rows["ids"][i] for i in top]
+        out["ids"].append(hit_ids)
+        out["documents"].append([by_id[i][0] for i in hit_ids])
+        out["metadatas"].append([by_id[i][1] for i in hit_ids])
+        out["distances"].append([float(max(dist[qi, i], 0.0)) for i in top])
+    return {key: value for key, value in out.items() if key == "ids" or key in include}
+
+
+def _page(results, offset, n_results):
+    """截取排名 [offset, offset + n_results) 的一页，next_offset 为下一页的起点 (没有更多结果时为 None)"""
+    keys = ("ids", "documents", "metadatas", "distances", "scores")
+    page = {**results, **{key: [results[key][0][offset:offset + n_results]] for key in keys if results.get(key)}}
+    page["offset"] = offset
+    page["next_offset"] = offset + n_results if len(results["ids"][0]) > offset + n_results else None
+    return page
+
+
+def search_pages(query, collection, model_handler, keyword_index, n_results=3, mode="auto", rrf_k=60,
+                 summary_collection=None, candidates=0, per_paper=None, filters=None, offset=0):
+    """论文页面检索：lexical 查询只走 BM25 (不调用模型)，dense 只走向量，hybrid 用 RRF 融合
+
+    candidates > 0 且提供了论文级 summary_collection 时，dense 查询走两阶段检索 (先选候选论文，
+    再重排其页面)；per_paper 限制每篇论文最多返回的页数。
+    filters 为已 resolve 的 search_filter.PageFilter：向量检索转成 where 在库内过滤 (范围很窄时见 dense_query)，
+    BM25 在打分时过滤，不是取回大量结果后再筛。offset 为分页起点 (跳过排名靠前的 offset 条)。
+    返回与 collection.query 相同结构的结果 (单个查询)，并附带实际使用的 mode、offset 与 next_offset。
+    """
+    if filters is not None and filters.empty:
+        filters = None
+    where = filters.where() if filters is not None else None
+    # 多取一条用于判断是否还有下一页
+    total = offset + n_results + 1
+
+    if mode == "auto":
+        mode = query_mode(query)
+        if mode != "dense" and keyword_index.count() == 0:
+            mode = "dense"
+    if filters is not None and filters.no_match:
+        # 分类 / 路径没有匹配的论文：不调用模型也不查库
+        return {"ids": [[]], "documents": [[]], "metadatas": [[]], "distances": [[]], "mode": mode,
+                "offset": offset, "next_offset": None}
+
+    if mode == "dense":
+        query_vec = model_handler.get_text_embedding(query)
+        if candidates and summary_collection is not None and summary_collection.count():
+            results = search_two_stage(query_vec, collection, summary_collection, total,
+                                       candidates=candidates, per_paper=per_paper, where=where,
+                                       paper_where=filters.paper_where() if filters is not None else None)
+            return _page({**results, "mode": "two_stage"}, offset, n_results)
+        # 按论文去重时多取一些，去重后仍能凑满 n_results
+        fetch = total * 4 if per_paper else total
+        results = dense_query(collection, [query_vec], fetch, filters)
+        if per_paper:
+            results = dedupe_per_paper(results, total, per_paper)
+        return _page({**results, "mode": mode}, offset, n_results)
+    fetch = total * 4 if per_paper else total
+
+    accept = filters.accepts if filters is not None else None
+    lexical = keyword_index.search(query.strip().strip('"'), k=fetch if mode == "lexical" else total * 4,
+                                   accept=accept)
+    if mode == "lexical":
+        ranked = [(doc_id, score) for doc_id, score in lexical]
+    else:
+        query_vec = model_handler.get_text_embedding(query)
+        dense = dense_query(collection, [query_vec], total * 4, filters, include=[])
+        fused = defaultdict(float)
+        for rank, doc_id in enumerate(dense["ids"][0]):
+            fused[doc_id] += 1 / (rrf_k + rank + 1)
+        for rank, (doc_id, _) in enumerate(lexical):
+            fused[doc_id] += 1 / (rrf_k + rank + 1)
+        ranked = heapq.nlargest(fetch, fused.items(), key=lambda item: item[1])
+
+    ids = [doc_id for doc_id, _ in ranked]
+    rows = collection.get(ids=ids, include=["documents", "metadatas"]) if ids else {"ids": [], "documents": [], "metadatas": []}
+    # get 不保证顺序，按排名重新排列；索引与库不同步时丢弃缺失的行
+    by_id = {row_id: (doc, meta) for row_id, doc, meta in zip(rows["ids"], rows["documents"], rows["metadatas"])}
+    ranked = [(doc_id, score) for doc_id, score in ranked if doc_id in by_id]
+    results = {
+        "ids": [[doc_id for doc_id, _ in ranked]],
+        "documents": [[by_id[doc_id][0] for doc_id, _ in ranked]],
+        "metadatas": [[by_id[doc_id][1] for doc_id, _ in ranked]],
+        # 非向量检索没有距离，这里给出的是 BM25 / RRF 得分
+        "scores": [[score for _, score in ranked]],
+        "mode": mode,
+    }
+    if per_paper:
+        results = dedupe_per_paper(results, total, per_paper)
+    return _page(results, offset, n_results)
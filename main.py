@@ -1,94 +1,351 @@
 import argparse
+import json
 import os
-import chromadb
-from PIL import Image
-from model_loader import EmbeddingModel
-from utils import extract_text_with_page_numbers, move_file_to_category
+import queue
+import threading
+import sys
+import time
+_START = time.perf_counter()
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+import daemon
+import metrics
+import db
+from db import copy_collection, get_collection, get_keyword_index, get_paper_registry, open_times, result_cache_stats
+from keyword_index import dense_query, search_pages, query_mode
+from model_loader import EmbeddingModel, DEFAULT_CACHE_PATH, compare_quantization
+from utils import extract_text_with_page_numbers, move_file_to_category, category_path
+from paper_ingest import IngestProgress, index_pdf, pick_topic, reclassify_library
+from paper_registry import page_id
+from search_filter import PageFilter, parse_pages
+from paper_summary import SUMMARY_COLLECTION, rebuild_summaries, upsert_summaries
+from image_indexer import DEFAULT_DUP_DISTANCE, ImageIndexer, duplicate_counts
+from snapshot import (DEFAULT_SHARD_ROWS, SNAPSHOT_COLLECTIONS, check_model_ids, export_snapshot,
+                      import_snapshot, read_image_manifest, read_manifest)
 import numpy as np
 
 # --- 初始化 ---
-client = chromadb.PersistentClient(path="./db")
-paper_collection = client.get_or_create_collection(name="papers")
-image_collection = client.get_or_create_collection(name="images")
-model_handler = EmbeddingModel()
+# 模型和数据库都按需加载：--help 和只用文本模型的命令不会加载 CLIP / torch / chromadb
+_IMPORTS_DONE = time.perf_counter()
+_model_handler = None
+# 由 CLI 全局参数 (--quantize / --threads) 填充
+_model_options = {}
+
+def get_model():
+    global _model_handler
+    if _model_handler is None:
+        _model_handler = EmbeddingModel(cache_path=DEFAULT_CACHE_PATH, **_model_options)
+    return _model_handler
+
+def print_startup_report():
+    """输出启动耗时 (stderr)，不影响脚本对标准输出的解析"""
+    parts = [f"imports {_IMPORTS_DONE - _START:.2f}s"]
+    load_times = _model_handler.load_times if _model_handler else {}
+    for key, label in [("torch_import", "torch"), ("text_model", "text model"), ("clip_model", "CLIP")]:
+        if key in load_times:
+            parts.append(f"{label} {load_times[key]:.2f}s")
+    if open_times:
+        parts.append(f"db {sum(open_times.values()):.2f}s")
+    if "clip_model" not in load_times:
+        parts.append("CLIP not loaded")
+    print(f"Startup: {', '.join(parts)}; wall {time.perf_counter() - _START:.2f}s", file=sys.stderr)
 
 # --- 核心功能函数 ---
 
+def _format_cache_line(label, stats):
+    return (f"{label}: {stats['hits']} hits / {stats['misses']} misses "
+            f"({stats['hit_rate']:.1%} hit rate, {stats['entries']} entries)")
+
+def print_cache_stats():
+    if _model_handler is None:
+        return
+    stats = _model_handler.cache_stats()
+    if stats:
+        print(_format_cache_line("Embedding cache", stats))
+
+def show_cache_stats():
+    """输出所有缓存的命中统计；在守护进程中执行时反映的是常驻进程的累计值"""
+    if _model_handler is not None:
+        print_cache_stats()
+        print(_format_cache_line("Query embedding cache", _model_handler.query_cache.stats()))
+    for name, stats in result_cache_stats().items():
+        print(_format_cache_line(f"Result cache [{name}]", stats))
+
+def _handle_known(file_path, key, known, topic_list, registry):
+    """已导入过的文件：不提取也不编码，文件换了位置时只更新 path；返回 unchanged / duplicate / moved"""
+    old_path = known["path"]
+    if os.path.abspath(old_path) == os.path.abspath(file_path):
+        return "unchanged"
+    if os.path.exists(old_path):
+        # 同一内容的另一份拷贝，库中保留原来的路径
+        print(f"Skipping {file_path}: identical to already indexed {old_path}")
+        return "duplicate"
+    new_path = move_file_to_category(file_path, known["topic"]) if topic_list and known["topic"] else file_path
+    rows = registry.relocate(key, new_path, get_collection("papers"), get_collection(SUMMARY_COLLECTION))
+    print(f"Moved: {old_path} -> {new_path} (path updated on {rows} pages, nothing re-embedded)")
+    return "moved"
+
+def _prepare_new(file_path, key, registry):
+    """为新文件分配 doc_id；同一路径上的旧内容 (文件被修改过) 先从库中删除"""
+    dropped = registry.drop_replaced(file_path, key, get_collection("papers"),
+                                     get_collection(SUMMARY_COLLECTION), get_keyword_index())
+    if dropped:
+        print(f"{file_path} changed since it was indexed; removed {dropped} stale pages")
+    return registry.assign_doc_id(key, os.path.basename(file_path))
+
 def add_paper(file_path, topics=None):
     if not os.path.exists(file_path):
         print(f"File not found: {file_path}")
         return
 
+    topic_list = topics.split(',') if topics else None
+    registry = get_paper_registry()
+    key, known = registry.find(file_path)
+    if known is not None:
+        if _handle_known(file_path, key, known, topic_list, registry) == "unchanged":
+            print(f"Already indexed: {file_path} ({known['pages']} pages), skipping.")
+        return
+    doc_id = _prepare_new(file_path, key, registry)
+
     print(f"Processing {file_path}...")
-    
-    # 1. 按页提取文本 (获取 chunks)
-    chunks = extract_text_with_page_numbers(file_path)
-    if not chunks:
+
+    # 按窗口流式提取、分类、编码并写库；中断后再次运行会从最后提交的页继续
+    progress = IngestProgress()
+    try:
+        result = index_pdf(
+            file_path, get_model(), get_collection("papers"), topic_list,
+            place=lambda topic: category_path(file_path, topic) if topic_list else file_path,
+            progress=progress, keyword_index=get_keyword_index(),
+            summary_collection=get_collection(SUMMARY_COLLECTION), doc_id=doc_id
+        )
+    except Exception as e:
+        print(f"Error reading {file_path}: {e}")
+        return
+    if result is None:
+        # 同样登记 (0 页)，再次同步时不会重复提取
+        registry.record(key, file_path, None, 0)
         print("No readable text found in PDF.")
         return
 
-    # 2. 确定分类 (用前3页的内容来做整体分类)
-    summary_text = " ".join([c["text"] for c in chunks[:3]])
-    summary_embedding = model_handler.get_text_embedding(summary_text)
+    # 所有页面写入后再移动文件，登记最终路径
+    final_path = move_file_to_category(file_path, result["topic"]) if topic_list else file_path
+    registry.record(key, final_path, result["topic"], result["pages"], result["last_page"])
+    progress.done(result["key"])
+    print("Paper indexed successfully.")
+    print_cache_stats()
 
-    best_topic = "Uncategorized"
-    final_path = file_path
+def _collect_pdfs(pdf_dir):
+    """递归收集目录下的 PDF 文件"""
+    pdfs = []
+    for root, _, files in os.walk(pdf_dir):
+        for file in sorted(files):
+            if file.lower().endswith(".pdf"):
+                pdfs.append(os.path.join(root, file))
+    return pdfs
 
-    if topics:
-        topic_list = topics.split(',')
-        topic_embeddings = model_handler.text_model.encode(topic_list)
-        
-        # 计算相似度
-        similarities = np.dot(topic_embeddings, summary_embedding) / (
-            np.linalg.norm(topic_embeddings, axis=1) * np.linalg.norm(summary_embedding)
-        )
-        best_topic = topic_list[np.argmax(similarities)]
-        print(f"Detected Topic: {best_topic}")
-        
-        # 移动文件
-        final_path = move_file_to_category(file_path, best_topic)
-
-    # 3. 存入数据库
-    ids = []
-    embeddings = []
-    documents = []
-    metadatas = []
-    
-    filename = os.path.basename(final_path)
+def _timed_extract(path):
+    """在子进程中提取并计时；子进程里记录的指标不会回到主进程，所以把耗时带回来"""
+    start = time.perf_counter()
+    chunks = extract_text_with_page_numbers(path)
+    return chunks, time.perf_counter() - start
 
-    print(f"Indexing {len(chunks)} pages...")
-    for chunk in chunks:
-        page_id = f"{filename}_p{chunk['page']}"
-        
-        ids.append(page_id)
-        documents.append(chunk["text"]) 
-        embeddings.append(model_handler.get_text_embedding(chunk["text"]))
-        
-        metadatas.append({
-            "path": final_path,
-            "topic": best_topic,
-            "page": chunk["page"]
-        })
+def _extract_producer(pdfs, workers, out_queue, stats):
+    """在进程池中并行提取 PDF 文本，结果按完成顺序放入有界队列"""
+    try:
+        max_in_flight = workers * 2
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+            path_iter = iter(pdfs)
+            while True:
+                # 控制在途任务数，避免提取结果在内存中堆积
+                for path in path_iter:
+                    pending[pool.submit(_timed_extract, path)] = path
+                    if len(pending) >= max_in_flight:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    try:
+                        chunks, elapsed = future.result()
+                        metrics.observe("pdf.extract", elapsed, len(chunks))
+                    except Exception as e:
+                        print(f"Failed to extract {path}: {e}")
+                        chunks = []
+                    # 队列满时阻塞，由消费者的速度反压提取端
+                    out_queue.put((path, chunks))
+    finally:
+        # 无论提取端是否出错都发送结束标记，避免消费者永久阻塞
+        stats["extract_done"] = time.perf_counter()
+        out_queue.put(None)
+
+def _flush_paper_batch(batch, topic_list, topic_embeddings, stats, doc_ids, registry):
+    """跨文档批量编码一组论文，完成分类后一次性写入数据库；doc_ids: {路径: (内容哈希, doc_id)}"""
+    texts = []
+    for _, chunks in batch:
+        texts.append(" ".join([c["text"] for c in chunks[:3]]))
+        texts.extend(c["text"] for c in chunks)
+    vecs = get_model().get_text_embeddings(texts)
+
+    ids, embeddings, documents, metadatas = [], [], [], []
+    summaries, placed = [], []
+    offset = 0
+    for file_path, chunks in batch:
+        summary_embedding = vecs[offset]
+        page_rows = slice(offset + 1, offset + 1 + len(chunks))
+        offset = page_rows.stop
 
-    paper_collection.upsert(
+        best_topic = "Uncategorized"
+        final_path = file_path
+        if topic_list:
+            best_topic = pick_topic(summary_embedding, topic_list, topic_embeddings)
+            final_path = move_file_to_category(file_path, best_topic)
+
+        key, doc_id = doc_ids[file_path]
+        placed.append((key, final_path, best_topic, len(chunks), chunks[-1]["page"]))
+        for chunk in chunks:
+            ids.append(page_id(doc_id, chunk["page"]))
+            documents.append(chunk["text"])
+            metadatas.append({
+                "path": final_path,
+                "topic": best_topic,
+                "page": chunk["page"]
+            })
+        embeddings.append(vecs[page_rows])
+        paper_vec = vecs[page_rows].mean(axis=0)
+        summaries.append((doc_id, final_path, best_topic, len(chunks),
+                          paper_vec / (np.linalg.norm(paper_vec) or 1.0)))
+    embeddings = np.concatenate(embeddings)
+
+    get_collection("papers").upsert(
         ids=ids,
         embeddings=embeddings,
         documents=documents,
         metadatas=metadatas
     )
-    print("Paper indexed successfully.")
+    get_keyword_index().add(ids, documents)
+    upsert_summaries(get_collection(SUMMARY_COLLECTION), summaries)
+    # 写库之后才登记，中断时未登记的文件下次会重新导入 (沿用同一 doc_id 覆盖)
+    for key, final_path, topic, pages, last_page in placed:
+        registry.record(key, final_path, topic, pages, last_page)
+    stats["files"] += len(batch)
+    stats["pages"] += len(ids)
+    print(f"Indexed {stats['files']} files / {stats['pages']} pages so far...")
+
+def add_papers(pdf_dir, topics=None, workers=None, batch_pages=512, queue_size=64):
+    """批量导入目录下的全部 PDF：多进程提取文本，单一消费者跨文档批量编码并写库"""
+    if not os.path.isdir(pdf_dir):
+        print(f"Directory not found: {pdf_dir}")
+        return
+
+    pdfs = _collect_pdfs(pdf_dir)
+    if not pdfs:
+        print("No PDF files found.")
+        return
+
+    stats = {"files": 0, "pages": 0, "empty": 0, "start": time.perf_counter(),
+             "unchanged": 0, "duplicate": 0, "moved": 0}
+    topic_list = topics.split(',') if topics else None
+
+    # 先查文件登记：已导入的文件不提取不编码，位置变了只更新 path；未变化的文件只 stat 不读内容
+    registry = get_paper_registry()
+    new_pdfs, doc_ids, seen = [], {}, {}
+    for path in pdfs:
+        key, known = registry.find(path)
+        if known is not None:
+            stats[_handle_known(path, key, known, topic_list, registry)] += 1
+        elif key in seen:
+            print(f"Skipping {path}: identical to {seen[key]}")
+            stats["duplicate"] += 1
+        else:
+            seen[key] = path
+            doc_ids[path] = (key, _prepare_new(path, key, registry))
+            new_pdfs.append(path)
+    stats["scan_done"] = time.perf_counter()
+    print(f"Found {len(pdfs)} PDFs: {len(new_pdfs)} new, {stats['unchanged']} already indexed, "
+          f"{stats['moved']} moved, {stats['duplicate']} duplicates "
+          f"(scanned in {stats['scan_done'] - stats['start']:.1f}s)")
+    if not new_pdfs:
+        return
+
+    workers = workers or os.cpu_count() or 1
+    print(f"Ingesting {len(new_pdfs)} PDFs with {workers} extraction workers...")
+
+    topic_embeddings = None
+    if topic_list:
+        # 主题向量只计算一次，所有文档共用
+        topic_embeddings = get_model().get_text_embeddings(topic_list)
 
-def search_paper(query):
+    page_queue = queue.Queue(maxsize=queue_size)
+    producer = threading.Thread(
+        target=_extract_producer, args=(new_pdfs, workers, page_queue, stats), daemon=True
+    )
+    producer.start()
+
+    batch, batch_page_count = [], 0
+    while True:
+        item = page_queue.get()
+        if item is None:
+            break
+        file_path, chunks = item
+        if not chunks:
+            # 没有文本的文件也登记 (0 页)，再次同步时不会重复提取
+            registry.record(doc_ids[file_path][0], file_path, None, 0)
+            stats["empty"] += 1
+            continue
+        batch.append((file_path, chunks))
+        batch_page_count += len(chunks)
+        if batch_page_count >= batch_pages:
+            _flush_paper_batch(batch, topic_list, topic_embeddings, stats, doc_ids, registry)
+            batch, batch_page_count = [], 0
+    if batch:
+        _flush_paper_batch(batch, topic_list, topic_embeddings, stats, doc_ids, registry)
+    producer.join()
+
+    elapsed = time.perf_counter() - stats["start"]
+    extract_elapsed = stats.get("extract_done", time.perf_counter()) - stats["start"]
+    print("\n" + "="*50)
+    print(" Bulk Ingestion Summary")
+    print("="*50)
+    print(f"• Files indexed: {stats['files']} (skipped without text: {stats['empty']})")
+    print(f"• Already indexed: {stats['unchanged']} unchanged, {stats['moved']} moved (path only), "
+          f"{stats['duplicate']} duplicate copies")
+    print(f"• Pages indexed: {stats['pages']}")
+    print(f"• Extraction time: {extract_elapsed:.1f}s")
+    print(f"• Total time: {elapsed:.1f}s")
+    if elapsed > 0:
+        print(f"• Throughput: {stats['files'] / elapsed:.2f} files/s, {stats['pages'] / elapsed:.1f} pages/s")
+    print_cache_stats()
+
+def _search_filter(topic=None, path=None, pages=None):
+    """由命令行参数构造检索过滤条件，分类 / 路径用文件登记表展开成具体论文；没有条件时返回 None"""
+    filters = PageFilter.from_args(topic, path, pages)
+    if filters.empty:
+        return None
+    filters.resolve(get_paper_registry())
+    return filters
+
+def search_paper(query, mode="auto", candidates=0, per_paper=None, top_k=3, offset=0,
+                 topic=None, path=None, pages=None):
     print(f"Searching for: {query}")
-    query_vec = model_handler.get_text_embedding(query)
-    
-    results = paper_collection.query(
-        query_embeddings=[query_vec],
-        n_results=3 
+    try:
+        filters = _search_filter(topic, path, pages)
+    except ValueError as e:
+        print(f"Error: invalid --pages: {e}")
+        return
+    # 标识符/人名类查询直接走 BM25 关键词索引，不调用模型；candidates > 0 时语义查询先选候选论文再重排页面
+    # 分类 / 路径 / 页码条件作为 where 下推到向量库，只在匹配的页面中排序
+    results = search_pages(
+        query, get_collection("papers"), get_model(), get_keyword_index(), n_results=top_k, mode=mode,
+        summary_collection=get_collection(SUMMARY_COLLECTION), candidates=candidates, per_paper=per_paper,
+        filters=filters, offset=offset
     )
     
     print("\n" + "="*50)
-    print(f" Search Results for: '{query}'")
+    print(f" Search Results for: '{query}' ({results['mode']})")
+    if filters is not None:
+        print(f" Filter: {filters.describe()}")
     print("="*50)
     
     if not results['ids'][0]:
@@ -99,7 +356,7 @@ def search_paper(query):
         meta = results['metadatas'][0][i]
         snippet = results['documents'][0][i]
         
-        print(f"\n📄 Result {i+1}")
+        print(f"\n📄 Result {offset + i + 1}")
         print(f"• File: {os.path.basename(meta['path'])}")
         print(f"• Page: {meta['page']}")
         print(f"• Topic: {meta['topic']}")
@@ -107,34 +364,44 @@ def search_paper(query):
         preview = snippet.replace('\n', ' ')[:300] 
         print(f"💡 Snippet: \"...{preview}...\"")
         print("-" * 30)
+    if results["next_offset"] is not None:
+        print(f"\nMore results: add --offset {results['next_offset']}")
+
+def show_facets():
+    """各分类 / 目录的论文数与页数 (来自文件登记表，不扫描向量库)"""
+    facets = get_paper_registry().facets()
+    if not facets["topics"]:
+        print("No papers indexed.")
+        return
+    print(f"{'Topic':<30} {'Papers':>8} {'Pages':>10}")
+    for topic, papers, pages in facets["topics"]:
+        print(f"{topic:<30} {papers:>8} {pages:>10}")
+    print(f"\n{'Folder':<50} {'Papers':>8} {'Pages':>10}")
+    for folder, papers, pages in facets["folders"]:
+        print(f"{folder:<50} {papers:>8} {pages:>10}")
+
+def add_image(image_dir, dup_distance=DEFAULT_DUP_DISTANCE):
+    """增量索引目录下的图片：只编码新增/修改的文件，并清理已删除文件的行；近似重复的图片只编码一次"""
+    indexer = ImageIndexer(get_collection("images"), get_model(),
+                           dup_distance=dup_distance if dup_distance is None or dup_distance >= 0 else None)
+    stats = indexer.sync(image_dir, verbose=True)
+    print(f"Images: {stats['added']} added, {stats['updated']} updated, "
+          f"{stats['removed']} removed, {stats['unchanged']} unchanged, "
+          f"{stats['failed']} failed ({stats['elapsed']:.1f}s, {stats['images_per_sec']:.1f} embedded images/s)")
+    processed = stats["added"] + stats["updated"]
+    if processed:
+        print(f"Near-duplicates: {stats['duplicates']} of {processed} images grouped without a CLIP pass "
+              f"({stats['duplicates'] / processed:.1%} of embedding work skipped; {stats['embedded']} embedded)")
+    print_cache_stats()
 
-def add_image(image_dir):
-    """批量索引目录下的图片"""
-    valid_exts = ['.jpg', '.jpeg', '.png']
-    for root, _, files in os.walk(image_dir):
-        for file in files:
-            if any(file.lower().endswith(ext) for ext in valid_exts):
-                full_path = os.path.join(root, file)
-                try:
-                    img = Image.open(full_path)
-                    vec = model_handler.get_image_embedding(img)
-                    image_collection.upsert(
-                        ids=[file],
-                        embeddings=[vec],
-                        metadatas=[{"path": full_path}]
-                    )
-                    print(f"Indexed image: {file}")
-                except Exception as e:
-                    print(f"Failed to index {file}: {e}")
-
-def search_image(query):
+def search_image(query, top_k=3):
     """以文搜图"""
     print(f"Searching image for: {query}")
-    query_vec = model_handler.get_text_for_image_embedding(query)
+    query_vec = get_model().get_text_for_image_embedding(query)
     
-    results = image_collection.query(
+    results = get_collection("images").query(
         query_embeddings=[query_vec],
-        n_results=3
+        n_results=top_k
     )
     
     print("\n--- Image Results ---")
@@ -142,13 +409,266 @@ def search_image(query):
         print("No images found.")
         return
 
+    dups = duplicate_counts(results['ids'][0])
     for i, doc_id in enumerate(results['ids'][0]):
         meta = results['metadatas'][0][i]
-        print(f"[{i+1}] {doc_id} (Path: {meta['path']})")
+        extra = f" +{dups[doc_id]} near-duplicates" if dups.get(doc_id) else ""
+        print(f"[{i+1}] {os.path.basename(meta['path'])} (Path: {meta['path']}){extra}")
+
+def _read_queries(path):
+    """逐行读取 JSONL 查询：{"query": ..., "id": 可选} 或直接是 JSON 字符串；"-" 表示标准输入"""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"query": item}
+            item.setdefault("id", line_no)
+            yield item
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def _chunked(items, size):
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _rows_from_query(results, i, key="distances"):
+    """collection.query 结果中第 i 个查询的命中列表"""
+    values = results.get(key)
+    values = values[i] if values else [None] * len(results["ids"][i])
+    hits = []
+    for row_id, meta, value in zip(results["ids"][i], results["metadatas"][i], values):
+        # 论文行带 page / topic，图片行只有 path
+        hit = {"id": row_id, **{k: meta[k] for k in ("path", "page", "topic") if k in meta}}
+        hit[key[:-1]] = value
+        hits.append(hit)
+    return hits
+
+def _run_batch(input_path, output_path, batch_size, search_chunk):
+    """分块读取查询、调用 search_chunk 批量检索，结果逐行写出 JSONL；统计输出到 stderr"""
+    out = sys.stdout if output_path in (None, "-") else open(output_path, "w", encoding="utf-8")
+    start, total = time.perf_counter(), 0
+    try:
+        for chunk in _chunked(_read_queries(input_path), batch_size):
+            for record in search_chunk(chunk):
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            total += len(chunk)
+            if total // 1000 != (total - len(chunk)) // 1000:
+                print(f"{total} queries done", file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed if elapsed else 0.0
+    print(f"Searched {total} queries in {elapsed:.1f}s ({rate:.1f} queries/s)", file=sys.stderr)
+
+def search_paper_batch(input_path, output_path=None, mode="auto", top_k=3, batch_size=256,
+                       candidates=0, per_paper=None, filters=None):
+    """批量论文检索：每块查询一次批量编码、一次多向量 collection.query；lexical/hybrid 查询逐条走 BM25
+
+    两阶段检索或按论文去重时，dense 查询复用批量编码结果逐条检索。filters (PageFilter) 作用于全部查询。
+    """
+    collection, keyword_index, model_handler = get_collection("papers"), get_keyword_index(), get_model()
+    summary_collection = get_collection(SUMMARY_COLLECTION)
+    has_keywords = keyword_index.count() > 0
+    vectorized = not candidates and not per_paper
+
+    def search_chunk(chunk):
+        modes = []
+        for item in chunk:
+            m = query_mode(item["query"]) if mode == "auto" else mode
+            modes.append("dense" if m != "dense" and mode == "auto" and not has_keywords else m)
+        need_vec = [i for i, m in enumerate(modes) if m != "lexical"]
+        vecs = (model_handler.get_text_embeddings([chunk[i]["query"] for i in need_vec], persist=False)
+                if need_vec else [])
+        for i, vec in zip(need_vec, vecs):
+            # hybrid 查询复用这里的批量编码结果，search_pages 不会再逐条调用模型
+            model_handler.query_cache.put(("text", chunk[i]["query"]), vec.tolist())
+
+        dense = [i for i in need_vec if modes[i] == "dense"] if vectorized else []
+        dense_hits = {}
+        if dense:
+            results = dense_query(collection, vecs[[need_vec.index(i) for i in dense]], top_k, filters)
+            dense_hits = {i: _rows_from_query(results, j) for j, i in enumerate(dense)}
+
+        for i, item in enumerate(chunk):
+            if i in dense_hits:
+                hits = dense_hits[i]
+            else:
+                results = search_pages(item["query"], collection, model_handler, keyword_index,
+                                       n_results=top_k, mode=modes[i], summary_collection=summary_collection,
+                                       candidates=candidates, per_paper=per_paper, filters=filters)
+                hits = _rows_from_query(results, 0, key="distances" if "distances" in results else "scores")
+                modes[i] = results["mode"]
+            yield {"id": item["id"], "query": item["query"], "mode": modes[i], "results": hits}
+
+    _run_batch(input_path, output_path, batch_size, search_chunk)
+
+def search_image_batch(input_path, output_path=None, top_k=3, batch_size=256):
+    """批量以文搜图：每块查询一次 CLIP 批量编码、一次多向量 collection.query"""
+    collection, model_handler = get_collection("images"), get_model()
+
+    def search_chunk(chunk):
+        vecs = model_handler.get_text_for_image_embeddings([item["query"] for item in chunk], persist=False)
+        results = collection.query(query_embeddings=vecs, n_results=top_k)
+        for i, item in enumerate(chunk):
+            yield {"id": item["id"], "query": item["query"], "results": _rows_from_query(results, i)}
+
+    _run_batch(input_path, output_path, batch_size, search_chunk)
+
+def rebuild_keyword_index(batch=5000):
+    """从 papers collection 中已存的页面文本重建 BM25 索引 (用于已有的库)"""
+    collection = get_collection("papers")
+    keyword_index = get_keyword_index()
+    offset, total = 0, 0
+    while True:
+        rows = collection.get(limit=batch, offset=offset, include=["documents"])
+        if not rows["ids"]:
+            break
+        keyword_index.add(rows["ids"], [doc or "" for doc in rows["documents"]])
+        offset += len(rows["ids"])
+        total += len(rows["ids"])
+        print(f"Indexed {total} pages...")
+    print(f"Keyword index now holds {keyword_index.count()} pages.")
+
+def rebuild_paper_summaries():
+    """由已存的页面向量重建论文级向量 (两阶段检索的第一阶段)，用于升级前导入的库"""
+    start = time.perf_counter()
+    papers = rebuild_summaries(get_collection("papers"), get_collection(SUMMARY_COLLECTION))
+    print(f"Rebuilt {papers} paper summary vectors in {time.perf_counter() - start:.1f}s.")
+
+def reclassify(topics, move=False):
+    """用已存的页面向量按新的主题列表重新分类全部论文"""
+    topic_list = topics.split(',')
+    start = time.perf_counter()
+    stats = reclassify_library(get_collection("papers"), get_model(), topic_list, move=move,
+                               summary_collection=get_collection(SUMMARY_COLLECTION), registry=get_paper_registry())
+    print(f"Reclassified {stats['papers']} papers in {time.perf_counter() - start:.1f}s: "
+          f"{stats['changed']} changed topic, {stats['moved']} files moved, "
+          f"{stats['rows_updated']} page rows updated")
+
+def convert_store(src, dst):
+    """把 papers / images / 论文级向量三个 collection 从一个向量库后端复制到另一个"""
+    for name in ("papers", "images", SUMMARY_COLLECTION):
+        start = time.perf_counter()
+        rows = copy_collection(name, src, dst)
+        print(f"Copied {rows} rows of '{name}' from {src} to {dst} in {time.perf_counter() - start:.1f}s.")
+    print(f"Use --store {dst} (or AGENT_VECTOR_STORE={dst}) to search the converted store.")
+
+def _snapshot_model_ids():
+    model_handler = get_model()
+    return {"text": model_handler.text_model_id, "clip": model_handler.clip_model_id}
+
+def export_index(snapshot_dir, compress=True, half=False, shard_rows=DEFAULT_SHARD_ROWS):
+    """把 papers / images / 论文级向量导出为分片的 npz 快照，新节点导入后无需重新编码"""
+    start = time.perf_counter()
+    manifest = export_snapshot(
+        snapshot_dir, {name: get_collection(name) for name in SNAPSHOT_COLLECTIONS}, _snapshot_model_ids(),
+        shard_rows=shard_rows, compress=compress, dtype="float16" if half else "float32",
+        image_manifest=ImageIndexer(get_collection("images"), get_model()).manifest_rows()
+    )
+    total = sum(shard["bytes"] for entry in manifest["collections"].values() for shard in entry["shards"])
+    rows = ", ".join(f"{entry['rows']} {name}" for name, entry in manifest["collections"].items())
+    print(f"Exported {rows} to {snapshot_dir} ({total / 2**20:.1f} MB) in {time.perf_counter() - start:.1f}s.")
+
+def import_index(snapshot_dir, force=False, verify=True):
+    """导入 export_index 生成的快照；模型与快照不一致时拒绝导入 (--force 跳过检查)"""
+    try:
+        manifest = read_manifest(snapshot_dir)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    mismatched = check_model_ids(manifest, _snapshot_model_ids())
+    for name, snap_model, our_model in mismatched:
+        print(f"Model mismatch for '{name}': snapshot {snap_model}, this node {our_model}")
+    if mismatched and not force:
+        print("Refusing to import vectors from a different model; re-run with --force to import anyway.")
+        return
+    start = time.perf_counter()
+    try:
+        imported = import_snapshot(
+            snapshot_dir, {name: get_collection(name) for name in SNAPSHOT_COLLECTIONS},
+            keyword_index=get_keyword_index(), verify=verify
+        )
+        image_rows = read_image_manifest(snapshot_dir, verify=verify)
+    except ValueError as e:
+        # 已导入的分片保留在库中，修复快照后重新导入即可 (upsert 幂等)
+        print(f"Error: {e}")
+        return
+    rows = ", ".join(f"{n} {name}" for name, n in imported.items())
+    print(f"Imported {rows} in {time.perf_counter() - start:.1f}s.")
+    # 快照中的论文补登记到文件登记表 (检索过滤与分类统计依赖它)
+    get_paper_registry().backfill(get_collection("papers"))
+    # 图片清单一并恢复，index_images 不会把快照中已编码的图片当作新文件重新编码
+    ImageIndexer(get_collection("images"), get_model()).restore(image_rows)
+
+def check_quantization(samples=200, k=10):
+    """用库中已有的页面文本对比 fp32 与 int8 量化的吞吐和检索一致性"""
+    rows = get_collection("papers").get(limit=samples, include=["documents"])
+    texts = [doc for doc in rows["documents"] if doc]
+    if len(texts) < 2:
+        print("Need at least 2 indexed pages in 'papers' to run the check.")
+        return
+
+    print(f"Comparing fp32 vs int8 on {len(texts)} sample pages...")
+    report = compare_quantization(texts, k=k)
+    for name, r in report.items():
+        recall_key = next(key for key in r if key.startswith("recall@"))
+        print(f"\n[{name}]")
+        print(f"• fp32: {r['fp32_per_sec']:.1f} texts/s | int8: {r['int8_per_sec']:.1f} texts/s "
+              f"({r['speedup']:.2f}x)")
+        print(f"• Mean cosine(fp32, int8): {r['mean_cosine']:.4f}")
+        print(f"• Neighbor {recall_key} vs fp32: {r[recall_key]:.3f}")
+
+# --- 常驻进程 ---
+# 这些命令在守护进程运行时会转发给它执行，否则在本进程执行
+DAEMON_COMMANDS = {
+    "add_paper": add_paper,
+    "search_paper": search_paper,
+    "index_images": add_image,
+    "search_image": search_image,
+    "cache_stats": show_cache_stats,
+}
+
+def _warmup():
+    """守护进程启动时预加载两个模型和数据库"""
+    model_handler = get_model()
+    model_handler.text_model
+    model_handler.clip_model
+    get_collection("papers")
+    get_collection("images")
+
+def forward_to_daemon(command, kwargs):
+    """转发给守护进程；返回 False 表示守护进程未运行 (或检索超时)，由调用方在本进程执行"""
+    resp = daemon.request(command, kwargs,
+                          timeout=None if command in daemon.WRITE_COMMANDS else daemon.QUERY_TIMEOUT)
+    if resp is None:
+        return False
+    print(resp["output"], end="")
+    if not resp["ok"]:
+        print(f"Daemon error: {resp['error']}", file=sys.stderr)
+        sys.exit(1)
+    return True
 
 # --- CLI 入口 ---
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Local Multimodal AI Agent")
+    parser.add_argument("--no-daemon", action="store_true", help="Always run in-process, even if the daemon is running")
+    parser.add_argument("--quantize", action="store_true", help="CPU performance mode: int8 dynamic quantization of linear layers")
+    parser.add_argument("--threads", type=int, default=None, help="Torch intra-op threads on CPU (default: available CPUs)")
+    parser.add_argument("--profile", action="store_true", help="Print per-stage timing (extract / encode / upsert / query) to stderr; runs in-process")
+    parser.add_argument("--store", choices=db.VECTOR_STORES, default=None,
+                        help="Vector store backend (default: $AGENT_VECTOR_STORE or chroma); runs in-process")
+    parser.add_argument("--store-dtype", choices=("float16", "int8"), default=None,
+                        help="Storage precision for new mmap collections (default: float16)")
     subparsers = parser.add_subparsers(dest="command")
 
     # Command: add_paper
@@ -156,27 +676,166 @@ if __name__ == "__main__":
     parser_add.add_argument("path", type=str, help="Path to the PDF file")
     parser_add.add_argument("--topics", type=str, help="Comma separated topics")
 
+    # Command: add_papers
+    parser_add_many = subparsers.add_parser("add_papers", help="Bulk add and classify all PDFs in a folder")
+    parser_add_many.add_argument("path", type=str, help="Folder path containing PDF files")
+    parser_add_many.add_argument("--topics", type=str, help="Comma separated topics")
+    parser_add_many.add_argument("--workers", type=int, default=None, help="Number of PDF extraction processes (default: CPU count)")
+    parser_add_many.add_argument("--batch-pages", type=int, default=512, help="Pages per embedding batch / upsert")
+
     # Command: search_paper
     parser_search = subparsers.add_parser("search_paper", help="Semantic search for papers")
-    parser_search.add_argument("query", type=str, help="Search query")
+    parser_search.add_argument("query", type=str, nargs="?", help="Search query")
+    parser_search.add_argument("--mode", choices=["auto", "dense", "lexical", "hybrid"], default="auto",
+                               help="auto: exact identifiers/names use BM25 only, mixed queries are fused")
+    parser_search.add_argument("--candidates", type=int, default=0,
+                               help="Two-stage search: shortlist this many papers by summary vector, then rank their pages (0 = flat page search)")
+    parser_search.add_argument("--per-paper", type=int, default=None, help="Return at most this many pages per paper")
+    parser_search.add_argument("--batch", type=str, help="JSONL file of queries ({\"query\": ..., \"id\": ...} per line, - for stdin)")
+    parser_search.add_argument("--output", type=str, help="JSONL results file for --batch (default: stdout)")
+    parser_search.add_argument("--top-k", type=int, default=3, help="Results per query (per page of results)")
+    parser_search.add_argument("--offset", type=int, default=0, help="Skip this many top results (next page of results)")
+    parser_search.add_argument("--topic", type=str, help="Only search papers in these topics (comma separated)")
+    parser_search.add_argument("--path", type=str, help="Only search these papers or folders (comma separated)")
+    parser_search.add_argument("--pages", type=str, help="Page range, e.g. 5, 3-10, 3- or -10")
+    parser_search.add_argument("--batch-size", type=int, default=256, help="Queries encoded / searched together in --batch mode")
 
     # Command: index_images
     parser_idx_img = subparsers.add_parser("index_images", help="Index a folder of images")
     parser_idx_img.add_argument("path", type=str, help="Folder path containing images")
+    parser_idx_img.add_argument("--dup-distance", type=int, default=DEFAULT_DUP_DISTANCE,
+                                help="Max dHash Hamming distance for near-duplicate grouping (-1 disables)")
 
     # Command: search_image
     parser_img_search = subparsers.add_parser("search_image", help="Text-to-Image search")
-    parser_img_search.add_argument("query", type=str, help="Description of the image")
+    parser_img_search.add_argument("query", type=str, nargs="?", help="Description of the image")
+    parser_img_search.add_argument("--batch", type=str, help="JSONL file of queries ({\"query\": ..., \"id\": ...} per line, - for stdin)")
+    parser_img_search.add_argument("--output", type=str, help="JSONL results file for --batch (default: stdout)")
+    parser_img_search.add_argument("--top-k", type=int, default=3, help="Results per query")
+    parser_img_search.add_argument("--batch-size", type=int, default=256, help="Queries encoded / searched together in --batch mode")
+
+    # Command: facets
+    subparsers.add_parser("facets", help="Show paper and page counts per topic and folder")
+
+    # Command: cache_stats
+    subparsers.add_parser("cache_stats", help="Show embedding / query / result cache hit rates")
+
+    # Command: rebuild_keyword_index
+    subparsers.add_parser("rebuild_keyword_index", help="Rebuild the BM25 keyword index from indexed pages")
+
+    # Command: rebuild_summaries
+    subparsers.add_parser("rebuild_summaries", help="Rebuild paper-level summary vectors used by --candidates")
+
+    # Command: reclassify
+    parser_reclass = subparsers.add_parser("reclassify", help="Re-topic all indexed papers from stored vectors")
+    parser_reclass.add_argument("--topics", type=str, required=True, help="Comma separated topics")
+    parser_reclass.add_argument("--move", action="store_true", help="Also move files into the new topic folders")
+
+    # Command: check_quantization
+    parser_quant = subparsers.add_parser("check_quantization", help="Compare int8 vs fp32 throughput and recall on indexed pages")
+    parser_quant.add_argument("--samples", type=int, default=200, help="Number of indexed pages to sample")
+    parser_quant.add_argument("--k", type=int, default=10, help="Neighbors used for recall@k")
+
+    # Command: convert_store
+    parser_convert = subparsers.add_parser("convert_store", help="Copy all vectors and metadata to another vector store backend")
+    parser_convert.add_argument("--to", dest="to_store", choices=db.VECTOR_STORES, required=True, help="Target backend")
+    parser_convert.add_argument("--from", dest="from_store", choices=db.VECTOR_STORES, default="chroma", help="Source backend")
+
+    # Command: export_index
+    parser_export = subparsers.add_parser("export_index", help="Write papers/images vectors and metadata to a snapshot directory")
+    parser_export.add_argument("path", type=str, help="Snapshot directory to create")
+    parser_export.add_argument("--no-compress", action="store_true", help="Store shards uncompressed (faster, larger)")
+    parser_export.add_argument("--float16", action="store_true", help="Store vectors as float16 (half the size)")
+    parser_export.add_argument("--shard-rows", type=int, default=DEFAULT_SHARD_ROWS, help="Rows per shard file")
+
+    # Command: import_index
+    parser_import = subparsers.add_parser("import_index", help="Load a snapshot written by export_index")
+    parser_import.add_argument("path", type=str, help="Snapshot directory")
+    parser_import.add_argument("--force", action="store_true", help="Import even if the snapshot was made with other models")
+    parser_import.add_argument("--no-verify", action="store_true", help="Skip sha256 verification of shards")
+
+    # Command: serve
+    subparsers.add_parser("serve", help="Run a resident daemon that keeps models and DB warm")
 
     args = parser.parse_args()
+    if args.quantize:
+        _model_options["quantize"] = True
+    if args.threads:
+        _model_options["num_threads"] = args.threads
+    if args.profile:
+        metrics.enable()
+    if args.store or args.store_dtype:
+        db.set_vector_store(args.store or db.VECTOR_STORE, args.store_dtype)
 
-    if args.command == "add_paper":
+    # 路径转成绝对路径，守护进程的工作目录可能与当前不同
+    daemon_kwargs = {
+        "add_paper": lambda: {"file_path": os.path.abspath(args.path), "topics": args.topics},
+        "search_paper": lambda: {"query": args.query, "mode": args.mode,
+                                 "candidates": args.candidates, "per_paper": args.per_paper,
+                                 "top_k": args.top_k, "offset": args.offset, "topic": args.topic,
+                                 "path": ",".join(os.path.abspath(p) for p in args.path.split(",")) if args.path else None,
+                                 "pages": args.pages},
+        "index_images": lambda: {"image_dir": os.path.abspath(args.path), "dup_distance": args.dup_distance},
+        "search_image": lambda: {"query": args.query, "top_k": args.top_k},
+        "cache_stats": lambda: {},
+    }
+    # --profile 统计的是本进程内的各阶段耗时，因此不转发给守护进程
+    batch_mode = getattr(args, "batch", None) is not None
+    if args.command in ("search_paper", "search_image") and not batch_mode and not args.query:
+        parser.error(f"{args.command}: a query or --batch FILE is required")
+    if args.command == "search_paper" and args.pages:
+        # 在转发给守护进程之前校验，单条与批量模式同样以参数错误退出
+        try:
+            parse_pages(args.pages)
+        except ValueError as e:
+            parser.error(f"invalid --pages: {e}")
+    # 批量模式在本进程执行，结果直接写文件，不经过守护进程；显式指定 --store 时守护进程的后端可能不同，也在本进程执行
+    if args.command in DAEMON_COMMANDS and not args.no_daemon and not args.profile and not batch_mode and not args.store:
+        if forward_to_daemon(args.command, daemon_kwargs[args.command]()):
+            sys.exit(0)
+
+    if args.command == "serve":
+        daemon.serve(DAEMON_COMMANDS, warmup=_warmup)
+    elif args.command == "add_paper":
         add_paper(args.path, args.topics)
+        print_startup_report()
+    elif args.command == "add_papers":
+        add_papers(args.path, args.topics, workers=args.workers, batch_pages=args.batch_pages)
+        print_startup_report()
+    elif args.command == "search_paper" and batch_mode:
+        search_paper_batch(args.batch, args.output, args.mode, args.top_k, args.batch_size,
+                           args.candidates, args.per_paper, _search_filter(args.topic, args.path, args.pages))
     elif args.command == "search_paper":
-        search_paper(args.query)
+        search_paper(args.query, args.mode, args.candidates, args.per_paper, args.top_k, args.offset,
+                     args.topic, args.path, args.pages)
+        print_startup_report()
     elif args.command == "index_images":
-        add_image(args.path)
+        add_image(args.path, args.dup_distance)
+    elif args.command == "search_image" and batch_mode:
+        search_image_batch(args.batch, args.output, args.top_k, args.batch_size)
     elif args.command == "search_image":
-        search_image(args.query)
+        search_image(args.query, args.top_k)
+    elif args.command == "cache_stats":
+        show_cache_stats()
+    elif args.command == "facets":
+        show_facets()
+    elif args.command == "rebuild_keyword_index":
+        rebuild_keyword_index()
+    elif args.command == "rebuild_summaries":
+        rebuild_paper_summaries()
+    elif args.command == "reclassify":
+        reclassify(args.topics, args.move)
+    elif args.command == "check_quantization":
+        check_quantization(args.samples, args.k)
+    elif args.command == "export_index":
+        export_index(args.path, compress=not args.no_compress, half=args.float16, shard_rows=args.shard_rows)
+    elif args.command == "import_index":
+        import_index(args.path, force=args.force, verify=not args.no_verify)
+    elif args.command == "convert_store":
+        convert_store(args.from_store, args.to_store)
     else:
-        parser.print_help()
\ No newline at end of file
+        parser.print_help()
+
+    if args.profile:
+        print("\nProfile (per stage; encode.* includes nested forward.* and cache lookups):", file=sys.stderr)
+        print(metrics.REGISTRY.summary(), file=sys.stderr)
\ No newline at end of file
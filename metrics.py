@@ -0,0 +1,227 @@
+import bisect
+import functools
+import os
+import random
+import threading
+import time
+
+# 延迟直方图桶 (秒)：Prometheus 客户端的默认值前面补上亚毫秒级的桶 (缓存命中、BM25、mmap 查询都在这个量级)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 批大小直方图桶 (页数 / 图片数 / 文本数)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class Histogram:
+    """累计分桶直方图，附带总和、计数、最大值和原始样本的蓄水池抽样 (用于 --profile 与基准测试的分位数)"""
+
+    def __init__(self, buckets, reservoir=2048):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.reservoir = reservoir
+        self.samples = []
+        self._rng = random.Random(0)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+        # 样本数不超过 reservoir，每个观测值被保留的概率相同
+        if len(self.samples) < self.reservoir:
+            self.samples.append(value)
+        else:
+            slot = self._rng.randrange(self.count)
+            if slot < self.reservoir:
+                self.samples[slot] = value
+
+    def quantile(self, q):
+        """分位数：由原始样本线性插值计算 (与 numpy.percentile 默认方式相同)"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        pos = q * (len(ordered) - 1)
+        lower = int(pos)
+        upper = min(lower + 1, len(ordered) - 1)
+        return ordered[lower] + (ordered[upper] - ordered[lower]) * (pos - lower)
+
+    def bucket_quantile(self, q):
+        """按桶内线性插值估计分位数 (与 PromQL 的 histogram_quantile 相同)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen, lower = 0, 0.0
+        for upper, n in zip(self.buckets, self.counts):
+            if n and seen + n >= rank:
+                # 不超过实际观测到的最大值，避免快速阶段被桶宽放大
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+            lower = upper
+        return self.max
+
+
+class Registry:
+    """各阶段的调用次数、延迟、批大小和错误数；关闭时 observe 直接返回"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def observe(self, stage, seconds, items=None, error=False):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = {
+                    "latency": Histogram(LATENCY_BUCKETS), "batch": Histogram(BATCH_BUCKETS), "errors": 0,
+                }
+            entry["latency"].observe(seconds)
+            if items is not None:
+                entry["batch"].observe(items)
+            if error:
+                entry["errors"] += 1
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+    def snapshot(self):
+        """{stage: {"count", "errors", "total", "mean", "p50", "p95", "max", "items", "mean_batch"}}"""
+        with self._lock:
+            result = {}
+            for stage, entry in sorted(self._stages.items()):
+                lat, batch = entry["latency"], entry["batch"]
+                result[stage] = {
+                    "count": lat.count,
+                    "errors": entry["errors"],
+                    "total": lat.sum,
+                    "mean": lat.sum / lat.count if lat.count else 0.0,
+                    "p50": lat.quantile(0.5),
+                    "p95": lat.quantile(0.95),
+                    "max": lat.max,
+                    "items": int(batch.sum),
+                    "mean_batch": batch.sum / batch.count if batch.count else None,
+                }
+            return result
+
+    def render_prometheus(self, prefix="agent"):
+        """Prometheus 文本格式 (exposition format 0.0.4)"""
+        lines = []
+        with self._lock:
+            stages = sorted(self._stages.items())
+            for name, key, help_text in [
+                ("stage_seconds", "latency", "Latency of instrumented pipeline stages in seconds."),
+                ("stage_batch_size", "batch", "Items (pages, images, texts) handled per stage call."),
+            ]:
+                metric = f"{prefix}_{name}"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for stage, entry in stages:
+                    hist = entry[key]
+                    if not hist.count:
+                        continue
+                    cumulative = 0
+                    for upper, n in zip(hist.buckets + ("+Inf",), hist.counts):
+                        cumulative += n
+                        lines.append(f'{metric}_bucket{{stage="{stage}",le="{upper}"}} {cumulative}')
+                    lines.append(f'{metric}_sum{{stage="{stage}"}} {hist.sum}')
+                    lines.append(f'{metric}_count{{stage="{stage}"}} {hist.count}')
+            metric = f"{prefix}_stage_errors_total"
+            lines.append(f"# HELP {metric} Calls of a stage that raised an exception.")
+            lines.append(f"# TYPE {metric} counter")
+            for stage, entry in stages:
+                lines.append(f'{metric}{{stage="{stage}"}} {entry["errors"]}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """--profile 使用的文本表格，按总耗时降序"""
+        stats = self.snapshot()
+        if not stats:
+            return "No stages recorded."
+        header = f"{'stage':<22}{'calls':>7}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'batch':>8}{'err':>5}"
+        lines = [header, "-" * len(header)]
+        for stage, s in sorted(stats.items(), key=lambda item: -item[1]["total"]):
+            batch = f"{s['mean_batch']:.1f}" if s["mean_batch"] is not None else "-"
+            lines.append(
+                f"{stage:<22}{s['count']:>7}{s['total']:>10.3f}{s['mean'] * 1000:>10.1f}"
+                f"{s['p50'] * 1000:>10.1f}{s['p95'] * 1000:>10.1f}{s['max'] * 1000:>10.1f}{batch:>8}{s['errors']:>5}"
+            )
+        return "\n".join(lines)
+
+
+REGISTRY = Registry(enabled=os.environ.get("AGENT_METRICS", "").lower() in ("1", "true", "yes", "on"))
+
+
+def enable(flag=True):
+    REGISTRY.enabled = flag
+
+
+def observe(stage, seconds, items=None, error=False):
+    REGISTRY.observe(stage, seconds, items, error)
+
+
+class _Timer:
+    __slots__ = ("stage", "items", "start")
+
+    def __init__(self, stage, items):
+        self.stage = stage
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        REGISTRY.observe(self.stage, time.perf_counter() - self.start, self.items, exc_type is not None)
+
+
+class _NullTimer:
+    # 允许 with 块内设置 items (写到共享对象上，无副作用)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return None
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(stage, items=None):
+    """计时代码块：with metrics.timer("file.copy"): ...；关闭时返回共享的空对象"""
+    if not REGISTRY.enabled:
+        return _NULL_TIMER
+    return _Timer(stage, items)
+
+
+def instrument(stage, batch=None):
+    """函数计时装饰器
+
+    batch 为整数时取 len(args[batch]) 作为批大小，为 "result" 时取 len(返回值)。
+    关闭时只多一次属性判断。
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not REGISTRY.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                REGISTRY.observe(stage, time.perf_counter() - start, error=True)
+                raise
+            items = None
+            if batch == "result":
+                items = len(result) if result is not None else 0
+            elif batch is not None and len(args) > batch and hasattr(args[batch], "__len__"):
+                items = len(args[batch])
+            REGISTRY.observe(stage, time.perf_counter() - start, items)
+            return result
+        return wrapper
+    return decorator
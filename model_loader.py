@@ -1,36 +1,320 @@
-from sentence_transformers import SentenceTransformer, models
+import hashlib
 import os
-import torch
+import threading
+import time
+import numpy as np
+
+import metrics
+from embedding_cache import EmbeddingCache
+from query_cache import LRUCache
+
+TEXT_MODEL_ID = "all-MiniLM-L6-v2"
+CLIP_MODEL_ID = "clip-ViT-B-32"
+# 前端默认使用的向量缓存位置
+DEFAULT_CACHE_PATH = "./cache/embeddings.sqlite3"
+
+def _available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _env_flag(name):
+    return os.environ.get(name, "").lower() in ("1", "true", "yes")
 
 class EmbeddingModel:
-    def __init__(self):
-        # 1. 自动检测设备
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        print(f"🚀 Using Device: {self.device.upper()}") 
+    def __init__(self, batch_size=32, cache_path=None, cache_max_entries=200_000, lazy=True,
+                 query_cache_size=1024, quantize=None, num_threads=None):
+        # 批量编码时每次前向传播的样本数
+        self.batch_size = batch_size
+        # CPU 性能模式：线性层动态 int8 量化 (默认读取环境变量 AGENT_QUANTIZE)
+        self.quantize = _env_flag("AGENT_QUANTIZE") if quantize is None else quantize
+        # torch 的 intra-op 线程数 (默认读取 AGENT_THREADS，未设置时取本进程可用的 CPU 数)
+        self.num_threads = num_threads or int(os.environ.get("AGENT_THREADS", 0)) or None
+        # 可选的持久化向量缓存，命中时完全跳过模型
+        self.cache = EmbeddingCache(cache_path, cache_max_entries) if cache_path else None
+        # 查询向量的内存 LRU 缓存，重复查询 (轮询、Streamlit 重跑) 不再编码
+        self.query_cache = LRUCache(query_cache_size)
+        # 各阶段加载耗时 (秒)，用于启动时间报告
+        self.load_times = {}
 
         base_path = os.path.dirname(os.path.abspath(__file__))
-        text_model_path = os.path.join(base_path, "models/all-MiniLM-L6-v2")
-        clip_model_path = os.path.join(base_path, "models/clip-ViT-B-32")
+        self.text_model_path = os.path.join(base_path, "models", TEXT_MODEL_ID)
+        self.clip_model_path = os.path.join(base_path, "models", CLIP_MODEL_ID)
+
+        # 模型在第一次使用时才加载；torch / sentence_transformers 也推迟到那时导入
+        self._device = None
+        self._text_model = None
+        self._clip_model = None
+        self._load_lock = threading.Lock()
+        if not lazy:
+            self.text_model
+            self.clip_model
+
+    @property
+    def device(self):
+        # 1. 自动检测设备
+        if self._device is None:
+            start = time.perf_counter()
+            import torch
+            self.load_times["torch_import"] = time.perf_counter() - start
+            self._device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            print(f"🚀 Using Device: {self._device.upper()}")
+            if self._device == 'cpu':
+                threads = self.num_threads or _available_cpus()
+                torch.set_num_threads(threads)
+                print(f"CPU threads: {threads}" + (" | int8 dynamic quantization" if self.quantize else ""))
+            elif self.quantize:
+                # 动态量化只支持 CPU 推理
+                print("Quantization is CPU-only; using fp32 on CUDA.")
+                self.quantize = False
+        return self._device
+
+    def _model_suffix(self):
+        # 量化后的向量与 fp32 不同，缓存键需区分；CUDA 上量化会被关闭，先确定设备
+        if self.quantize:
+            self.device
+        return "-int8" if self.quantize else ""
+
+    @property
+    def text_model_id(self):
+        return TEXT_MODEL_ID + self._model_suffix()
 
+    @property
+    def clip_model_id(self):
+        return CLIP_MODEL_ID + self._model_suffix()
+
+    def _maybe_quantize(self, model):
+        if not self.quantize:
+            return model
+        import torch
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    @property
+    def text_model(self):
         # 2. 加载文本模型
-        print(f"Loading Text Model from: {text_model_path} ...")
-        self.text_model = SentenceTransformer(text_model_path, device=self.device)
+        if self._text_model is None:
+            with self._load_lock:
+                if self._text_model is None:
+                    device = self.device
+                    start = time.perf_counter()
+                    from sentence_transformers import SentenceTransformer
+                    print(f"Loading Text Model from: {self.text_model_path} ...")
+                    self._text_model = self._maybe_quantize(SentenceTransformer(self.text_model_path, device=device))
+                    self.load_times["text_model"] = time.perf_counter() - start
+        return self._text_model
 
+    @property
+    def clip_model(self):
         # 3. 加载 CLIP 模型
-        print(f"Loading CLIP Model from: {clip_model_path} ...")
-        try:
-            # 显式加载 CLIP 模块
-            clip_module = models.CLIPModel(clip_model_path)
-            self.clip_model = SentenceTransformer(modules=[clip_module], device=self.device)
-        except Exception as e:
-            print(f"标准加载失败，尝试备用方案: {e}")
-            self.clip_model = SentenceTransformer(clip_model_path, device=self.device)
+        if self._clip_model is None:
+            with self._load_lock:
+                if self._clip_model is None:
+                    device = self.device
+                    start = time.perf_counter()
+                    from sentence_transformers import SentenceTransformer, models
+                    print(f"Loading CLIP Model from: {self.clip_model_path} ...")
+                    try:
+                        # 显式加载 CLIP 模块
+                        clip_module = models.CLIPModel(self.clip_model_path)
+                        self._clip_model = SentenceTransformer(modules=[clip_module], device=device)
+                    except Exception as e:
+                        print(f"标准加载失败，尝试备用方案: {e}")
+                        self._clip_model = SentenceTransformer(self.clip_model_path, device=device)
+                    self._clip_model = self._maybe_quantize(self._clip_model)
+                    self.load_times["clip_model"] = time.perf_counter() - start
+        return self._clip_model
+
+    def _encode(self, model_attr, inputs, batch_size=None):
+        # 通过属性名取模型，只有真正需要前向传播时才触发加载
+        model = getattr(self, model_attr)
+        with metrics.timer(f"forward.{model_attr}", len(inputs)):
+            vecs = model.encode(
+                inputs,
+                batch_size=batch_size or self.batch_size,
+                convert_to_numpy=True,
+                show_progress_bar=False
+            )
+        return np.ascontiguousarray(vecs, dtype=np.float32)
+
+    def _encode_cached(self, model_attr, keys, inputs, batch_size=None):
+        """先查缓存，只把未命中的输入送入模型，再按原顺序拼回结果；keys 为 None 时不使用持久化缓存"""
+        if not inputs:
+            # 空输入不为取维度而加载模型；模型已加载时返回正确的列数
+            model = getattr(self, f"_{model_attr}")
+            dim = model.get_sentence_embedding_dimension() if model is not None else 0
+            return np.zeros((0, dim or 0), dtype=np.float32)
+        if keys is None:
+            return self._encode(model_attr, inputs, batch_size)
+        found = self.cache.get_many(keys)
+        miss_idx = [i for i, k in enumerate(keys) if k not in found]
+        if miss_idx:
+            # 同一批中重复的输入只编码一次
+            miss_keys = list(dict.fromkeys(keys[i] for i in miss_idx))
+            first = {}
+            for i in miss_idx:
+                first.setdefault(keys[i], i)
+            new_vecs = self._encode(model_attr, [inputs[first[k]] for k in miss_keys], batch_size)
+            self.cache.put_many(miss_keys, new_vecs)
+            found.update(zip(miss_keys, new_vecs))
+        return np.ascontiguousarray(np.stack([found[k] for k in keys]), dtype=np.float32)
+
+    @staticmethod
+    def _image_bytes(image):
+        return f"{image.mode}{image.size}".encode("utf-8") + image.tobytes()
 
+    @metrics.instrument("encode.query")
     def get_text_embedding(self, text):
-        return self.text_model.encode(text).tolist()
+        key = ("text", text)
+        vec = self.query_cache.get(key)
+        if vec is None:
+            vec = self.get_text_embeddings([text], persist=False)[0].tolist()
+            self.query_cache.put(key, vec)
+        return vec
+
+    @metrics.instrument("encode.text", batch=1)
+    def get_text_embeddings(self, texts, batch_size=None, persist=True):
+        """批量文本编码，返回 (N, dim) 的连续 float32 数组，可直接传给 upsert
+
+        persist=False 用于检索查询：不读写持久化缓存 (查询只进内存的 query_cache)，
+        避免每次检索都提交一次磁盘写入，并把导入时的页面向量挤出 LRU。
+        """
+        texts = list(texts)
+        keys = None
+        if self.cache is not None and persist:
+            keys = [EmbeddingCache.make_key(self.text_model_id, "text", t) for t in texts]
+        return self._encode_cached("text_model", keys, texts, batch_size)
 
     def get_image_embedding(self, image):
-        return self.clip_model.encode(image).tolist()
+        return self.get_image_embeddings([image])[0].tolist()
+
+    @metrics.instrument("encode.image", batch=1)
+    def get_image_embeddings(self, images, batch_size=None):
+        """批量图片编码，一次前向传播处理一批图片，返回 (N, dim) float32 数组"""
+        images = list(images)
+        keys = None
+        if self.cache is not None:
+            keys = [EmbeddingCache.make_key(self.clip_model_id, "image", self._image_bytes(img)) for img in images]
+        return self._encode_cached("clip_model", keys, images, batch_size)
     
+    @metrics.instrument("encode.clip_query")
     def get_text_for_image_embedding(self, text):
-        return self.clip_model.encode(text).tolist()
\ No newline at end of file
+        key = ("clip_text", text)
+        vec = self.query_cache.get(key)
+        if vec is None:
+            vec = self.get_text_for_image_embeddings([text], persist=False)[0].tolist()
+            self.query_cache.put(key, vec)
+        return vec
+
+    @metrics.instrument("encode.clip_text", batch=1)
+    def get_text_for_image_embeddings(self, texts, batch_size=None, persist=True):
+        """批量编码 CLIP 文本侧向量 (以文搜图的查询)，返回 (N, dim) float32 数组；persist 同 get_text_embeddings"""
+        texts = list(texts)
+        keys = None
+        if self.cache is not None and persist:
+            keys = [EmbeddingCache.make_key(self.clip_model_id, "text", t) for t in texts]
+        return self._encode_cached("clip_model", keys, texts, batch_size)
+
+    def cache_stats(self):
+        """返回缓存命中统计，未启用缓存时为 None"""
+        return self.cache.stats() if self.cache is not None else None
+
+
+class StubEmbeddingModel:
+    """确定性的替身编码器，接口与 EmbeddingModel 一致，无需模型权重、torch 或网络
+
+    文本向量为词元的特征哈希 (带符号) 后归一化，词面相近的文本向量也相近；
+    图片向量为 8x8 缩略图经固定随机投影得到。用于基准测试和离线调试。
+    """
+
+    def __init__(self, batch_size=32, text_dim=384, clip_dim=512, query_cache_size=1024):
+        self.batch_size = batch_size
+        self.text_dim = text_dim
+        self.clip_dim = clip_dim
+        self.cache = None
+        self.quantize = False
+        self.query_cache = LRUCache(query_cache_size)
+        self.load_times = {}
+        self.text_model_id = "stub-text"
+        self.clip_model_id = "stub-clip"
+        self._projection = np.random.default_rng(0).standard_normal((8 * 8 * 3, clip_dim)).astype(np.float32)
+
+    def _hash_text(self, text, dim):
+        from keyword_index import tokenize
+        vec = np.zeros(dim, dtype=np.float32)
+        for token in tokenize(text):
+            h = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+            vec[h % dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def get_text_embeddings(self, texts, batch_size=None, persist=True):
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.text_dim), dtype=np.float32)
+        return np.ascontiguousarray(np.stack([self._hash_text(t, self.text_dim) for t in texts]))
+
+    def get_text_embedding(self, text):
+        return self.get_text_embeddings([text])[0].tolist()
+
+    def get_image_embeddings(self, images, batch_size=None):
+        images = list(images)
+        if not images:
+            return np.zeros((0, self.clip_dim), dtype=np.float32)
+        pixels = np.stack([
+            np.asarray(img.convert("RGB").resize((8, 8)), dtype=np.float32).reshape(-1) / 255.0 - 0.5
+            for img in images
+        ])
+        vecs = pixels @ self._projection
+        return np.ascontiguousarray(vecs / np.linalg.norm(vecs, axis=1, keepdims=True), dtype=np.float32)
+
+    def get_image_embedding(self, image):
+        return self.get_image_embeddings([image])[0].tolist()
+
+    def get_text_for_image_embedding(self, text):
+        return self._hash_text(text, self.clip_dim).tolist()
+
+    def get_text_for_image_embeddings(self, texts, batch_size=None, persist=True):
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.clip_dim), dtype=np.float32)
+        return np.ascontiguousarray(np.stack([self._hash_text(t, self.clip_dim) for t in texts]))
+
+    def cache_stats(self):
+        return None
+
+
+def _timed_encode(model_handler, model_attr, texts):
+    # 先用少量样本预热，避免把首次调用的初始化开销算进吞吐
+    model_handler._encode(model_attr, texts[:model_handler.batch_size])
+    start = time.perf_counter()
+    vecs = model_handler._encode(model_attr, texts)
+    elapsed = time.perf_counter() - start
+    vecs = vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs, len(texts) / elapsed if elapsed > 0 else float("inf")
+
+def _neighbors(vecs, k):
+    sims = vecs @ vecs.T
+    np.fill_diagonal(sims, -np.inf)
+    return np.argpartition(-sims, k - 1, axis=1)[:, :k]
+
+def compare_quantization(texts, batch_size=32, k=10):
+    """在样本文本上对比 fp32 与 int8 量化模型：吞吐提升、向量余弦相似度、近邻 recall@k"""
+    texts = list(texts)
+    k = max(1, min(k, len(texts) - 1))
+    fp32 = EmbeddingModel(batch_size, quantize=False)
+    int8 = EmbeddingModel(batch_size, quantize=True)
+    report = {}
+    for name, attr in [("text", "text_model"), ("clip_text", "clip_model")]:
+        ref, ref_rate = _timed_encode(fp32, attr, texts)
+        quant, quant_rate = _timed_encode(int8, attr, texts)
+        ref_nn, quant_nn = _neighbors(ref, k), _neighbors(quant, k)
+        overlap = [len(set(a) & set(b)) / k for a, b in zip(ref_nn, quant_nn)]
+        report[name] = {
+            "fp32_per_sec": ref_rate,
+            "int8_per_sec": quant_rate,
+            "speedup": quant_rate / ref_rate,
+            "mean_cosine": float(np.mean(np.sum(ref * quant, axis=1))),
+            f"recall@{k}": float(np.mean(overlap)),
+        }
+    return report
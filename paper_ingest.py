@@ -0,0 +1,234 @@
+import os
+import sqlite3
+import threading
+from itertools import islice
+import numpy as np
+
+import metrics
+from paper_registry import doc_id_of, page_id
+from paper_summary import PageVectorSum, paper_vector_from_store, upsert_summaries
+from utils import iter_pages, file_hash, move_file_to_category
+
+DEFAULT_PROGRESS_PATH = "./db/ingest_progress.sqlite3"
+# 每个窗口的页数：提取、编码、写库都以窗口为单位，峰值内存与文档长度无关
+DEFAULT_WINDOW = 64
+
+
+class IngestProgress:
+    """记录每个文件 (按内容哈希) 已写入数据库的最后一页，用于中断后续传"""
+
+    def __init__(self, path=DEFAULT_PROGRESS_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS progress ("
+            " file_hash TEXT PRIMARY KEY, final_path TEXT NOT NULL, topic TEXT NOT NULL,"
+            " last_page INTEGER NOT NULL, pages INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT final_path, topic, last_page, pages FROM progress WHERE file_hash=?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"final_path": row[0], "topic": row[1], "last_page": row[2], "pages": row[3]}
+
+    def save(self, key, final_path, topic, last_page, pages):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO progress (file_hash, final_path, topic, last_page, pages)"
+                " VALUES (?, ?, ?, ?, ?)", (key, final_path, topic, last_page, pages)
+            )
+            self._conn.commit()
+
+    def done(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM progress WHERE file_hash=?", (key,))
+            self._conn.commit()
+
+
+@metrics.instrument("topic.score")
+def pick_topic(summary_embedding, topic_list, topic_embeddings):
+    """按余弦相似度选出最匹配的主题"""
+    similarities = np.dot(topic_embeddings, summary_embedding) / (
+        np.linalg.norm(topic_embeddings, axis=1) * np.linalg.norm(summary_embedding)
+    )
+    return topic_list[int(np.argmax(similarities))]
+
+
+def index_pdf(pdf_path, model_handler, collection, topic_list=None, place=None,
+              window=DEFAULT_WINDOW, progress=None, log=print, keyword_index=None, before_window=None,
+              summary_collection=None, doc_id=None):
+    """流式索引一篇 PDF：按窗口提取、编码并写库，每个窗口提交后记录进度
+
+    keyword_index 不为 None 时，同步把每个窗口的页面写入 BM25 关键词索引。
+    before_window(indexed) 在每个窗口提取前调用，indexed 为已写入的页数；后台任务用它上报进度并让出模型。
+    summary_collection 不为 None 时，结束后写入论文级向量 (全部页面向量的均值)，供两阶段检索使用。
+    place(topic) 返回文件最终保存的路径 (只计算路径，不移动文件)，写入 metadata 的 path；
+    文件的实际移动/复制由调用方在返回后完成，之后再调用 progress.done(result["key"])。
+    doc_id 为页面 id 的前缀 (由 PaperRegistry.assign_doc_id 分配)，None 时取最终路径的文件名。
+    返回 {"topic", "final_path", "pages", "key", "doc_id", "last_page"}，没有可读文本时返回 None。
+    """
+    place = place or (lambda topic: pdf_path)
+    key = file_hash(pdf_path)
+    record = progress.get(key) if progress else None
+
+    if record:
+        # 断点续传：沿用上次确定的分类和路径，从最后提交的页之后继续
+        topic, final_path = record["topic"], record["final_path"]
+        start_page, indexed = record["last_page"], record["pages"]
+        log(f"Resuming after page {start_page} ({indexed} pages already indexed)")
+    else:
+        topic, final_path, start_page, indexed = None, None, 0, 0
+
+    pages = iter_pages(pdf_path, start_page=start_page)
+    last_page = start_page
+    page_sum = PageVectorSum()
+    while True:
+        if before_window is not None:
+            before_window(indexed)
+        with metrics.timer("pdf.extract") as t:
+            chunks = list(islice(pages, window))
+            t.items = len(chunks)
+        if not chunks:
+            break
+
+        texts = [c["text"] for c in chunks]
+        if topic is None:
+            # 第一个窗口：用前3页确定分类，摘要与本窗口各页一次批量编码
+            summary_text = " ".join(texts[:3])
+            vecs = model_handler.get_text_embeddings([summary_text] + texts)
+            summary_embedding, page_embeddings = vecs[0], vecs[1:]
+            topic = "Uncategorized"
+            if topic_list:
+                topic_embeddings = model_handler.get_text_embeddings(topic_list)
+                topic = pick_topic(summary_embedding, topic_list, topic_embeddings)
+                log(f"Detected Topic: {topic}")
+            final_path = place(topic)
+        else:
+            page_embeddings = model_handler.get_text_embeddings(texts)
+
+        doc_id = doc_id or os.path.basename(final_path)
+        ids = [page_id(doc_id, c["page"]) for c in chunks]
+        collection.upsert(
+            ids=ids,
+            embeddings=page_embeddings,
+            documents=texts,
+            metadatas=[{"path": final_path, "topic": topic, "page": c["page"]} for c in chunks]
+        )
+        if keyword_index is not None:
+            keyword_index.add(ids, texts)
+        page_sum.add(page_embeddings)
+        indexed += len(chunks)
+        last_page = chunks[-1]["page"]
+        if progress:
+            progress.save(key, final_path, topic, chunks[-1]["page"], indexed)
+        log(f"Indexed pages {chunks[0]['page']}-{chunks[-1]['page']} ({indexed} total)")
+
+    if topic is None:
+        return None
+    if summary_collection is not None:
+        if record:
+            # 续传时之前窗口的向量不在累加值里，从库中已写入的页面重新计算
+            vec, _ = paper_vector_from_store(collection, final_path)
+        else:
+            vec = page_sum.vector()
+        upsert_summaries(summary_collection, [(doc_id, final_path, topic, indexed, vec)])
+    return {"topic": topic, "final_path": final_path, "pages": indexed, "key": key, "doc_id": doc_id,
+            "last_page": last_page}
+
+
+def _iter_rows(collection, include, batch=5000):
+    """分页读取 collection 的全部行，避免一次性载入"""
+    offset = 0
+    while True:
+        rows = collection.get(limit=batch, offset=offset, include=include)
+        if not rows["ids"]:
+            break
+        yield rows
+        offset += len(rows["ids"])
+
+
+def reclassify_library(collection, model_handler, topic_list, move=False,
+                       summary_pages=3, batch=5000, log=print, summary_collection=None, registry=None):
+    """用库中已存的页面向量重新分类全部论文，不对页面文本做任何模型调用
+
+    每篇论文的摘要向量取其前 summary_pages 页 (按页码) 向量的均值，与导入时的分类方式一致；
+    所有论文与所有主题一次矩阵乘法打分，然后批量更新 topic (可选同时移动文件并更新 path)。
+    registry 不为 None 时同步更新文件登记中的路径和分类。
+    """
+    # 1. 主题向量只编码一次
+    topic_embeddings = model_handler.get_text_embeddings(topic_list)
+    topic_embeddings = topic_embeddings / np.linalg.norm(topic_embeddings, axis=1, keepdims=True)
+
+    # 2. 按 path 聚合页面：保留页码最小的若干页向量，以及每行的 id / metadata
+    firsts, rows_by_path = {}, {}
+    for rows in _iter_rows(collection, ["embeddings", "metadatas"], batch):
+        for row_id, vec, meta in zip(rows["ids"], rows["embeddings"], rows["metadatas"]):
+            path = meta.get("path")
+            if path is None:
+                continue
+            rows_by_path.setdefault(path, []).append((row_id, meta))
+            pages = firsts.setdefault(path, [])
+            pages.append((meta.get("page", 0), np.asarray(vec, dtype=np.float32)))
+            if len(pages) > summary_pages:
+                pages.sort(key=lambda p: p[0])
+                pages.pop()
+    if not firsts:
+        return {"papers": 0, "changed": 0, "moved": 0, "rows_updated": 0}
+
+    # 3. 一次矩阵乘法给所有论文打分
+    paths = list(firsts)
+    summaries = np.stack([np.mean([v for _, v in firsts[p]], axis=0) for p in paths])
+    summaries /= np.linalg.norm(summaries, axis=1, keepdims=True)
+    best = np.argmax(summaries @ topic_embeddings.T, axis=1)
+    del firsts, summaries
+
+    # 4. 只更新分类发生变化的论文
+    stats = {"papers": len(paths), "changed": 0, "moved": 0, "rows_updated": 0}
+    ids, metadatas = [], []
+    summaries = {}
+    for path, topic_idx in zip(paths, best):
+        topic = topic_list[topic_idx]
+        old_rows = rows_by_path[path]
+        old_topic = old_rows[0][1].get("topic")
+        if old_topic == topic:
+            continue
+        stats["changed"] += 1
+
+        new_path = path
+        if move:
+            if os.path.exists(path):
+                # 文件位于旧分类目录下时，移动到同级的新分类目录
+                base_dir = os.path.dirname(path)
+                if os.path.basename(base_dir) == old_topic:
+                    base_dir = os.path.dirname(base_dir)
+                new_path = move_file_to_category(path, topic, base_dir)
+                stats["moved"] += 1
+            else:
+                log(f"File not found, metadata only: {path}")
+
+        if registry is not None:
+            registry.rename_path(path, new_path, topic)
+        for row_id, meta in old_rows:
+            ids.append(row_id)
+            metadatas.append({**meta, "topic": topic, "path": new_path})
+        summaries[doc_id_of(old_rows[0][0])] = {"path": new_path, "topic": topic, "pages": len(old_rows)}
+        if len(ids) >= batch:
+            collection.update(ids=ids, metadatas=metadatas)
+            stats["rows_updated"] += len(ids)
+            ids, metadatas = [], []
+    if ids:
+        collection.update(ids=ids, metadatas=metadatas)
+        stats["rows_updated"] += len(ids)
+
+    # 5. 论文级向量行同步新的分类和路径 (两阶段检索按 path 过滤页面)
+    if summary_collection is not None and summaries:
+        existing = summary_collection.get(ids=list(summaries), include=[])["ids"]
+        if existing:
+            summary_collection.update(ids=existing, metadatas=[summaries[i] for i in existing])
+    return stats
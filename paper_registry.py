@@ -0,0 +1,237 @@
+import os
+import sqlite3
+import threading
+import time
+
+from utils import file_hash
+
+DEFAULT_REGISTRY_PATH = "./db/paper_registry.sqlite3"
+
+
+def page_id(doc_id, page):
+    """页面行 id：{doc_id}_p{页码}"""
+    return f"{doc_id}_p{page}"
+
+
+def doc_id_of(row_id):
+    """由页面行 id 取回所属论文的 doc_id"""
+    return row_id.rsplit("_p", 1)[0]
+
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+class PaperRegistry:
+    """按内容哈希登记已导入的论文：doc_id、当前路径、分类、页数及路径的 (大小, mtime)
+
+    - doc_id 是页面行 id 与论文级向量行 id 的前缀。默认取文件名 (与旧版 id 一致)，
+      不同内容的同名文件取 "文件名#哈希前 8 位"，不会互相覆盖。
+    - 已导入的文件再次导入时只更新路径 metadata，不提取也不编码；路径与 (大小, mtime)
+      都未变时连哈希都不用计算，重复同步大目录的开销只与新文件数有关。
+    """
+
+    def __init__(self, path=DEFAULT_REGISTRY_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # status: indexing (已分配 doc_id，尚未导入完成) / done / missing (旧库中文件已不在磁盘上)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS papers ("
+            " file_hash TEXT PRIMARY KEY, doc_id TEXT UNIQUE NOT NULL, status TEXT NOT NULL,"
+            " path TEXT, abspath TEXT, size INTEGER, mtime_ns INTEGER, topic TEXT, pages INTEGER,"
+            " updated REAL NOT NULL)"
+        )
+        # 旧版登记表补上最后一页的页码 (按论文过滤的检索据此直接构造页面 id)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(papers)")}
+        if "last_page" not in columns:
+            self._conn.execute("ALTER TABLE papers ADD COLUMN last_page INTEGER")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS papers_abspath ON papers (abspath)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS papers_topic ON papers (topic)")
+        self._conn.commit()
+
+    def _row(self, sql, params):
+        cur = self._conn.execute(sql, params)
+        row = cur.fetchone()
+        return dict(zip([d[0] for d in cur.description], row)) if row else None
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+
+    def find(self, path):
+        """返回 (内容哈希, 已导入完成的记录或 None)；路径和 (大小, mtime) 都匹配时不读取文件内容"""
+        size, mtime_ns = _stat(path)
+        with self._lock:
+            rec = self._row(
+                "SELECT * FROM papers WHERE abspath=? AND size=? AND mtime_ns=? AND status='done'",
+                (os.path.abspath(path), size, mtime_ns)
+            )
+        if rec:
+            return rec["file_hash"], rec
+        key = file_hash(path)
+        with self._lock:
+            rec = self._row("SELECT * FROM papers WHERE file_hash=? AND status='done'", (key,))
+        return key, rec
+
+    def assign_doc_id(self, key, filename):
+        """为新文件分配 doc_id 并占用；同一内容再次调用 (如中断后续传) 返回同一个 doc_id"""
+        with self._lock:
+            row = self._conn.execute("SELECT doc_id FROM papers WHERE file_hash=?", (key,)).fetchone()
+            if row:
+                return row[0]
+            doc_id = filename
+            if self._conn.execute("SELECT 1 FROM papers WHERE doc_id=?", (doc_id,)).fetchone():
+                doc_id = f"{filename}#{key[:8]}"
+            self._conn.execute(
+                "INSERT INTO papers (file_hash, doc_id, status, updated) VALUES (?, ?, 'indexing', ?)",
+                (key, doc_id, time.time())
+            )
+            self._conn.commit()
+            return doc_id
+
+    def record(self, key, path, topic, pages, last_page=None):
+        """导入完成 (文件已在最终位置) 后记录路径、分类、页数和最后一页的页码 (None 时保留原值)"""
+        size, mtime_ns = _stat(path)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE papers SET status='done', path=?, abspath=?, size=?, mtime_ns=?, topic=?, pages=?,"
+                " last_page=COALESCE(?, last_page), updated=? WHERE file_hash=?",
+                (path, os.path.abspath(path), size, mtime_ns, topic, pages, last_page, time.time(), key)
+            )
+            self._conn.commit()
+
+    def relocate(self, key, new_path, collection, summary_collection=None, batch=5000):
+        """已导入的文件换了位置：只改页面和论文级向量行的 path，返回更新的页面行数"""
+        with self._lock:
+            rec = self._row("SELECT * FROM papers WHERE file_hash=?", (key,))
+        updated = 0
+        while rec["path"] != new_path:
+            rows = collection.get(where={"path": rec["path"]}, limit=batch, include=["metadatas"])
+            if not len(rows["ids"]):
+                break
+            collection.update(ids=rows["ids"], metadatas=[{**m, "path": new_path} for m in rows["metadatas"]])
+            updated += len(rows["ids"])
+        if summary_collection is not None:
+            row = summary_collection.get(ids=[rec["doc_id"]], include=["metadatas"])
+            if len(row["ids"]):
+                summary_collection.update(ids=row["ids"], metadatas=[{**row["metadatas"][0], "path": new_path}])
+        self.record(key, new_path, rec["topic"], rec["pages"])
+        return updated
+
+    def drop_replaced(self, path, key, collection, summary_collection=None, keyword_index=None):
+        """同一路径上的文件内容已改变：删除旧内容的页面行、论文行和登记，返回删除的页面行数"""
+        with self._lock:
+            rec = self._row("SELECT * FROM papers WHERE abspath=? AND file_hash!=?",
+                            (os.path.abspath(path), key))
+        if rec is None:
+            return 0
+        ids = collection.get(where={"path": rec["path"]}, include=[])["ids"]
+        if ids:
+            collection.delete(ids=ids)
+            if keyword_index is not None:
+                keyword_index.remove(ids)
+        if summary_collection is not None:
+            summary_collection.delete(ids=[rec["doc_id"]])
+        with self._lock:
+            self._conn.execute("DELETE FROM papers WHERE file_hash=?", (rec["file_hash"],))
+            self._conn.commit()
+        return len(ids)
+
+    def rename_path(self, old_path, new_path, topic=None):
+        """metadata 中的路径/分类已由调用方更新 (如 reclassify)，同步文件登记
+
+        文件不在磁盘上 (如只导入了快照的节点) 时同样更新路径和分类，分类过滤与 facets 依赖这里的 topic；
+        文件存在时顺带刷新 (大小, mtime)，下次同步仍走快速路径。
+        """
+        size = mtime_ns = None
+        if os.path.exists(new_path):
+            size, mtime_ns = _stat(new_path)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE papers SET path=?, abspath=?, topic=COALESCE(?, topic),"
+                " size=COALESCE(?, size), mtime_ns=COALESCE(?, mtime_ns), updated=? WHERE path=?",
+                (new_path, os.path.abspath(new_path), topic, size, mtime_ns, time.time(), old_path)
+            )
+            self._conn.commit()
+
+    def select(self, topics=None, paths=None):
+        """按分类和路径 (文件或目录，目录取其下全部论文) 选出已导入的论文，返回 {doc_id: (path, 页数, 最后一页)}"""
+        sql, params = ["SELECT doc_id, path, pages, last_page FROM papers"
+                       " WHERE status IN ('done', 'missing') AND pages > 0"], []
+        if topics:
+            sql.append(f"AND topic IN ({','.join('?' * len(topics))})")
+            params.extend(topics)
+        if paths:
+            clauses = []
+            for path in paths:
+                full = os.path.abspath(path)
+                prefix = os.path.join(full, "")
+                clauses.append("abspath = ? OR substr(abspath, 1, ?) = ?")
+                params.extend([full, len(prefix), prefix])
+            sql.append("AND (" + " OR ".join(clauses) + ")")
+        with self._lock:
+            return {doc_id: (path, pages, last_page)
+                    for doc_id, path, pages, last_page in self._conn.execute(" ".join(sql), params)}
+
+    def facets(self):
+        """各分类与各目录的论文数和页数：{"topics": [(分类, 论文数, 页数)], "folders": [...]}，按论文数降序"""
+        with self._lock:
+            topics = self._conn.execute(
+                "SELECT topic, COUNT(*), SUM(pages) FROM papers WHERE status IN ('done', 'missing') AND pages > 0"
+                " GROUP BY topic ORDER BY COUNT(*) DESC, topic"
+            ).fetchall()
+            rows = self._conn.execute(
+                "SELECT path, pages FROM papers WHERE status IN ('done', 'missing') AND pages > 0"
+            ).fetchall()
+        folders = {}
+        for path, pages in rows:
+            entry = folders.setdefault(os.path.dirname(path) or ".", [0, 0])
+            entry[0] += 1
+            entry[1] += pages
+        return {
+            "topics": [(topic or "Uncategorized", papers, pages) for topic, papers, pages in topics],
+            "folders": sorted(((d, n, p) for d, (n, p) in folders.items()), key=lambda f: (-f[1], f[0])),
+        }
+
+    def backfill(self, collection, batch=5000, log=print):
+        """为旧库登记已导入的论文 (按页面行 id 的前缀和 metadata 的 path)，返回登记的论文数
+
+        文件仍在磁盘上的按内容哈希登记；已不存在的只占用 doc_id，避免新文件与旧行的 id 冲突。
+        """
+        papers, offset = {}, 0
+        while True:
+            rows = collection.get(limit=batch, offset=offset, include=["metadatas"])
+            if not len(rows["ids"]):
+                break
+            for row_id, meta in zip(rows["ids"], rows["metadatas"]):
+                entry = papers.setdefault(doc_id_of(row_id), {"path": meta.get("path"), "topic": meta.get("topic"),
+                                                               "pages": 0, "last_page": 0})
+                entry["pages"] += 1
+                entry["last_page"] = max(entry["last_page"], meta.get("page") or 0)
+            offset += len(rows["ids"])
+        registered = 0
+        for doc_id, entry in papers.items():
+            path = entry["path"]
+            with self._lock:
+                if self._conn.execute("SELECT 1 FROM papers WHERE doc_id=?", (doc_id,)).fetchone():
+                    continue
+            if path and os.path.exists(path):
+                key = file_hash(path)
+                size, mtime_ns = _stat(path)
+                status = "done"
+            else:
+                key, size, mtime_ns, status = f"missing:{doc_id}", None, None, "missing"
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO papers (file_hash, doc_id, status, path, abspath, size, mtime_ns,"
+                    " topic, pages, last_page, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, doc_id, status, path, os.path.abspath(path) if path else None, size, mtime_ns,
+                     entry["topic"], entry["pages"], entry["last_page"] or None, time.time())
+                )
+                self._conn.commit()
+            registered += 1
+        if registered:
+            log(f"Registered {registered} previously indexed papers")
+        return registered
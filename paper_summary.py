@@ -0,0 +1,116 @@
+import numpy as np
+
+from paper_registry import doc_id_of
+
+# 论文级向量所在的 collection：每篇论文一行，向量为全部页面向量的归一化均值
+SUMMARY_COLLECTION = "paper_summaries"
+DEFAULT_CANDIDATES = 20
+
+
+class PageVectorSum:
+    """流式导入时累加页面向量，结束时得到论文级向量"""
+
+    def __init__(self):
+        self.total = None
+        self.count = 0
+
+    def add(self, vecs):
+        vecs = np.asarray(vecs, dtype=np.float32)
+        if not len(vecs):
+            return
+        part = vecs.sum(axis=0)
+        self.total = part if self.total is None else self.total + part
+        self.count += len(vecs)
+
+    def vector(self):
+        if not self.count:
+            return None
+        vec = self.total / self.count
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+
+def upsert_summaries(summary_collection, rows):
+    """rows: [(doc_id, path, topic, pages, vector)]；论文行 id 与页面 id 的前缀 (doc_id) 一致，移动文件后不变"""
+    rows = [r for r in rows if r[4] is not None]
+    if not rows:
+        return
+    summary_collection.upsert(
+        ids=[doc_id for doc_id, _, _, _, _ in rows],
+        embeddings=np.stack([vec for _, _, _, _, vec in rows]),
+        metadatas=[{"path": path, "topic": topic, "pages": pages} for _, path, topic, pages, _ in rows],
+    )
+
+
+def paper_vector_from_store(collection, path):
+    """从已写入的页面向量计算论文级向量 (断点续传时累加值不完整)"""
+    rows = collection.get(where={"path": path}, include=["embeddings"])
+    acc = PageVectorSum()
+    if rows["ids"]:
+        acc.add(rows["embeddings"])
+    return acc.vector(), acc.count
+
+
+def rebuild_summaries(collection, summary_collection, batch=5000):
+    """由 papers collection 中已存的页面向量重建全部论文级向量，用于已有的库"""
+    sums, metas = {}, {}
+    offset = 0
+    while True:
+        rows = collection.get(limit=batch, offset=offset, include=["embeddings", "metadatas"])
+        if not rows["ids"]:
+            break
+        for row_id, vec, meta in zip(rows["ids"], rows["embeddings"], rows["metadatas"]):
+            if meta.get("path") is None:
+                continue
+            # 按页面 id 的前缀分组：同名的不同文件各有自己的论文行
+            doc_id = doc_id_of(row_id)
+            sums.setdefault(doc_id, PageVectorSum()).add([vec])
+            metas[doc_id] = (meta["path"], meta.get("topic"))
+        offset += len(rows["ids"])
+    items = list(sums.items())
+    for start in range(0, len(items), batch):
+        upsert_summaries(summary_collection, [
+            (doc_id, *metas[doc_id], acc.count, acc.vector()) for doc_id, acc in items[start:start + batch]
+        ])
+    return len(items)
+
+
+def search_two_stage(query_vec, collection, summary_collection, n_results=3,
+                     candidates=DEFAULT_CANDIDATES, per_paper=None, where=None, paper_where=None):
+    """两阶段检索：先在论文级向量中取 candidates 篇候选，再只在这些论文的页面中检索
+
+    第二阶段用 path 过滤的 collection.query，由 Chroma 在候选页面内排序 (比取回页面向量在本地重排快)。
+    per_paper 限制每篇论文最多返回的页数 (None 不限制)。paper_where 限定第一阶段的候选论文 (分类 / 路径)，
+    where 为页面行的过滤条件，与候选论文的 path 条件一起下推到第二阶段。返回与 collection.query 相同结构的结果。
+    """
+    papers = summary_collection.query(query_embeddings=[query_vec], n_results=candidates, include=["metadatas"],
+                                      **({"where": paper_where} if paper_where else {}))
+    paths = [meta["path"] for meta in papers["metadatas"][0]]
+    if not paths:
+        return {"ids": [[]], "documents": [[]], "metadatas": [[]], "distances": [[]]}
+    candidate_where = {"path": paths[0]} if len(paths) == 1 else {"path": {"$in": paths}}
+    where = {"$and": [candidate_where, where]} if where else candidate_where
+    # 按论文去重时多取一些，去重后仍能凑满 n_results
+    fetch = n_results * 4 if per_paper else n_results
+    results = collection.query(query_embeddings=[query_vec], n_results=fetch, where=where)
+    if per_paper:
+        results = dedupe_per_paper(results, n_results, per_paper)
+    return results
+
+
+def dedupe_per_paper(results, n_results, per_paper):
+    """单阶段结果的按论文去重：保留每篇论文排名靠前的 per_paper 页"""
+    keep, per_path = [], {}
+    for i, meta in enumerate(results["metadatas"][0]):
+        path = meta.get("path")
+        if per_path.get(path, 0) >= per_paper:
+            continue
+        per_path[path] = per_path.get(path, 0) + 1
+        keep.append(i)
+        if len(keep) == n_results:
+            break
+    return {
+        **results,
+        **{key: [[results[key][0][i] for i in keep]]
+           for key in ("ids", "documents", "metadatas", "distances", "scores") if results.get(key)},
+    }
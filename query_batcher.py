@@ -0,0 +1,138 @@
+import functools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+# 默认的合批等待窗口与最大批大小，可用环境变量调整
+DEFAULT_MAX_WAIT_MS = float(os.environ.get("AGENT_BATCH_WAIT_MS", "4"))
+DEFAULT_MAX_BATCH = int(os.environ.get("AGENT_BATCH_MAX", "32"))
+
+
+class _Lane:
+    """一个模型的合批队列：单个调度线程把并发到达的查询合成一次前向传播"""
+
+    def __init__(self, name, encode_batch, max_batch, max_wait):
+        self.name = name
+        self.encode_batch = encode_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        # 上一批是否有多个请求：单用户时不等待，出现并发后才按窗口收集
+        self._contended = False
+        self.requests = 0
+        self.batches = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+        self.largest_batch = 0
+
+    def submit(self, text):
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True, name=f"batcher-{self.name}")
+                    self._thread.start()
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        # 已在队列中的请求 (模型忙时积压的) 直接并入本批
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if self._contended or len(batch) > 1:
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        self._contended = len(batch) > 1
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            try:
+                vecs = self.encode_batch([text for text, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            metrics.observe(f"microbatch.{self.name}", time.perf_counter() - start, len(batch))
+            with self._lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+                for _, _, submitted in batch:
+                    wait = start - submitted
+                    self.total_wait += wait
+                    self.max_wait_seen = max(self.max_wait_seen, wait)
+            for (_, future, _), vec in zip(batch, vecs):
+                future.set_result(vec.tolist())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "mean_batch": self.requests / self.batches if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+                "mean_wait_ms": self.total_wait / self.requests * 1000 if self.requests else 0.0,
+                "max_wait_ms": self.max_wait_seen * 1000,
+            }
+
+
+class QueryBatcher:
+    """包装 EmbeddingModel：并发的单条查询编码在 max_wait_ms 内合成一批，每个模型一次前向传播
+
+    只替换 get_text_embedding / get_text_for_image_embedding，其余属性和方法转发给原模型，
+    可以直接传给 search_pages 等接受 model_handler 的函数。查询向量缓存命中时不进入队列。
+    """
+
+    def __init__(self, model_handler, max_batch=DEFAULT_MAX_BATCH, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+        self._model_handler = model_handler
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        # 查询向量只进内存的 query_cache，不写持久化缓存
+        text = functools.partial(model_handler.get_text_embeddings, persist=False)
+        clip_text = functools.partial(model_handler.get_text_for_image_embeddings, persist=False)
+        self._lanes = {
+            "text": _Lane("text", text, max_batch, max_wait_ms / 1000),
+            "clip_text": _Lane("clip_text", clip_text, max_batch, max_wait_ms / 1000),
+        }
+
+    def __getattr__(self, name):
+        return getattr(self._model_handler, name)
+
+    def _embed(self, kind, text):
+        key = (kind, text)
+        query_cache = self._model_handler.query_cache
+        vec = query_cache.get(key)
+        if vec is None:
+            vec = self._lanes[kind].submit(text).result()
+            query_cache.put(key, vec)
+        return vec
+
+    def get_text_embedding(self, text):
+        return self._embed("text", text)
+
+    def get_text_for_image_embedding(self, text):
+        return self._embed("clip_text", text)
+
+    def stats(self):
+        """{lane: {"requests", "batches", "mean_batch", "largest_batch", "mean_wait_ms", "max_wait_ms"}}"""
+        return {name: lane.stats() for name, lane in self._lanes.items()}
@@ -0,0 +1,136 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+
+import metrics
+
+
+class LRUCache:
+    """线程安全的内存 LRU 缓存，带命中统计"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._data),
+        }
+
+
+class SqliteDataVersion:
+    """SQLite 文件的数据版本：其他连接 (包括其他进程) 每提交一次写入，PRAGMA data_version 就会变化
+
+    只是读一个计数器，不扫描任何表，可以在每次命中缓存前调用。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self._conn is None:
+                if not os.path.exists(self.path):
+                    return None
+                self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+class CachedCollection:
+    """包装 Chroma collection：缓存 query 结果，写操作时整体失效
+
+    经由本对象的写入直接清空缓存；version 为可调用对象时 (返回库的数据版本)，每次查询前比较版本，
+    其他进程 (命令行导入、另一个 Web 界面) 写库后同样清空。
+    """
+
+    def __init__(self, collection, maxsize=512, name=None, version=None):
+        self._collection = collection
+        # 计时指标的阶段名前缀，如 papers.query / papers.upsert
+        self.name = name or getattr(collection, "name", "collection")
+        self.result_cache = LRUCache(maxsize)
+        self._version = version
+        self._seen_version = version() if version is not None else None
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def _key(self, query_embeddings, n_results, kwargs):
+        vecs = np.asarray(query_embeddings, dtype=np.float32)
+        extra = json.dumps(kwargs, sort_keys=True, default=str)
+        return (vecs.shape, vecs.tobytes(), n_results, extra)
+
+    def query(self, query_embeddings=None, n_results=10, **kwargs):
+        if query_embeddings is None or len(query_embeddings) > 1:
+            # 文本查询和批量查询不走缓存 (批量结果大且几乎不会重复)
+            with metrics.timer(f"{self.name}.query", len(query_embeddings) if query_embeddings is not None else None):
+                return self._collection.query(query_embeddings=query_embeddings, n_results=n_results, **kwargs)
+        if self._version is not None:
+            version = self._version()
+            if version != self._seen_version:
+                self.result_cache.clear()
+                self._seen_version = version
+        key = self._key(query_embeddings, n_results, kwargs)
+        results = self.result_cache.get(key)
+        if results is None:
+            # 只统计真正落到 Chroma 的查询，缓存命中不计入
+            with metrics.timer(f"{self.name}.query", len(query_embeddings)):
+                results = self._collection.query(query_embeddings=query_embeddings, n_results=n_results, **kwargs)
+            self.result_cache.put(key, results)
+        return results
+
+    def upsert(self, *args, **kwargs):
+        try:
+            with metrics.timer(f"{self.name}.upsert", len(kwargs.get("ids") or ())):
+                return self._collection.upsert(*args, **kwargs)
+        finally:
+            self.result_cache.clear()
+
+    def add(self, *args, **kwargs):
+        try:
+            return self._collection.add(*args, **kwargs)
+        finally:
+            self.result_cache.clear()
+
+    def update(self, *args, **kwargs):
+        try:
+            return self._collection.update(*args, **kwargs)
+        finally:
+            self.result_cache.clear()
+
+    def delete(self, *args, **kwargs):
+        try:
+            return self._collection.delete(*args, **kwargs)
+        finally:
+            self.result_cache.clear()
@@ -0,0 +1,144 @@
+import os
+
+from paper_registry import page_id
+
+
+def parse_pages(text):
+    """页码范围："5"、"3-10"、"3-" 或 "-10"，返回 (起始页, 结束页)，未指定的一端为 None"""
+    text = (text or "").strip()
+    if not text:
+        return None, None
+    if "-" not in text:
+        page = int(text)
+        return page, page
+    low, high = (part.strip() for part in text.split("-", 1))
+    return (int(low) if low else None), (int(high) if high else None)
+
+
+def _split(text):
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = text.split(",")
+    return [item.strip() for item in text if item and item.strip()]
+
+
+class PageFilter:
+    """论文检索的过滤条件：分类、路径 (文件或目录) 与页码范围，转换成向量库的 where
+
+    - 分类与页码直接对应页面 metadata 的 topic / page；
+    - 路径由文件登记表 (PaperRegistry) 展开成具体的论文路径 (目录取其下全部论文)，
+      再以 path $in 下推到向量库，只有匹配的行参与排序；
+    - BM25 索引没有 metadata，按登记表解析出的 doc_id 集合和页面 id 中的页码过滤。
+    """
+
+    def __init__(self, topics=None, paths=None, page_min=None, page_max=None):
+        self.topics = _split(topics)
+        self.paths = _split(paths)
+        self.page_min = page_min
+        self.page_max = page_max
+        # resolve 之后：{doc_id: (path, 页数, 最后一页)}；None 表示不按论文限制
+        self.papers = None
+
+    @classmethod
+    def from_args(cls, topic=None, path=None, pages=None):
+        """由命令行 / 界面的文本输入构造：topic 与 path 可用逗号分隔多个，pages 见 parse_pages"""
+        return cls(topic, path, *parse_pages(pages))
+
+    @property
+    def empty(self):
+        return not (self.topics or self.paths or self.page_min is not None or self.page_max is not None)
+
+    def resolve(self, registry):
+        """用文件登记表把分类 / 路径条件展开成具体论文；返回匹配的论文数 (不按论文限制时为 None)"""
+        if self.topics or self.paths:
+            self.papers = registry.select(self.topics or None, self.paths or None)
+            return len(self.papers)
+        return None
+
+    @property
+    def no_match(self):
+        """分类 / 路径条件没有匹配任何论文，检索可以直接返回空结果"""
+        return self.papers is not None and not self.papers
+
+    def _paper_conditions(self):
+        conditions = []
+        if self.topics:
+            conditions.append({"topic": self.topics[0]} if len(self.topics) == 1 else {"topic": {"$in": self.topics}})
+        if self.paths and self.papers is not None:
+            paths = sorted({path for path, _, _ in self.papers.values()})
+            conditions.append({"path": paths[0]} if len(paths) == 1 else {"path": {"$in": paths}})
+        return conditions
+
+    @staticmethod
+    def _combine(conditions):
+        if not conditions:
+            return None
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+    def paper_where(self):
+        """论文级向量 (两阶段检索第一阶段) 的 where：只含分类与路径"""
+        return self._combine(self._paper_conditions())
+
+    def where(self):
+        """页面行的 where"""
+        conditions = self._paper_conditions()
+        if self.page_min is not None:
+            conditions.append({"page": {"$gte": self.page_min}})
+        if self.page_max is not None:
+            conditions.append({"page": {"$lte": self.page_max}})
+        return self._combine(conditions)
+
+    def page_ids(self, limit):
+        """按论文过滤时直接构造候选页面 id (论文 × 页码范围，空白页的 id 不存在也无妨)
+
+        候选数超过 limit，或有论文缺少最后一页的页码 (旧版登记) 时返回 None，由向量库按 where 过滤。
+        """
+        if self.papers is None:
+            return None
+        ids = []
+        low = max(self.page_min or 1, 1)
+        for doc_id, (_, _, last_page) in self.papers.items():
+            if last_page is None:
+                return None
+            high = last_page if self.page_max is None else min(last_page, self.page_max)
+            ids.extend(page_id(doc_id, page) for page in range(low, high + 1))
+            if len(ids) > limit:
+                return None
+        return ids
+
+    def accepts(self, row_id):
+        """BM25 结果的过滤：按页面 id ({doc_id}_p{页码}) 判断"""
+        doc_id, _, page = row_id.rpartition("_p")
+        if self.papers is not None and doc_id not in self.papers:
+            return False
+        if self.page_min is not None or self.page_max is not None:
+            page = int(page) if page.isdigit() else None
+            if page is None:
+                return False
+            if self.page_min is not None and page < self.page_min:
+                return False
+            if self.page_max is not None and page > self.page_max:
+                return False
+        return True
+
+    def describe(self):
+        parts = []
+        if self.topics:
+            parts.append("topic=" + ",".join(self.topics))
+        if self.paths:
+            parts.append("path=" + ",".join(os.path.normpath(p) for p in self.paths))
+        if self.page_min is not None or self.page_max is not None:
+            parts.append(f"pages={self.page_min or ''}-{self.page_max or ''}")
+        return " ".join(parts)
+
+
+def format_facets(facets, limit=20):
+    """各分类 / 目录的论文数与页数的 Markdown 表格 (两个 Web 界面共用)"""
+    if not facets["topics"]:
+        return "暂无已导入的论文"
+    lines = ["| 分类 | 论文数 | 页数 |", "|---|---|---|"]
+    lines += [f"| {topic} | {papers} | {pages} |" for topic, papers, pages in facets["topics"][:limit]]
+    lines += ["", "| 目录 | 论文数 | 页数 |", "|---|---|---|"]
+    lines += [f"| {folder} | {papers} | {pages} |" for folder, papers, pages in facets["folders"][:limit]]
+    return "\n".join(lines)
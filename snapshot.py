@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+from paper_summary import SUMMARY_COLLECTION
+
+SNAPSHOT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+# 图片清单 (路径、大小、mtime、内容哈希、dHash 分组)，新节点据此识别已编码的图片
+IMAGE_MANIFEST_NAME = "image_manifest.json"
+# 每个分片的行数：导入时一次只载入一个分片，决定峰值内存
+DEFAULT_SHARD_ROWS = 10000
+# 快照包含的 collection 及其向量来自哪个模型 (text / clip)
+SNAPSHOT_COLLECTIONS = {"papers": "text", "images": "clip", SUMMARY_COLLECTION: "text"}
+
+
+def _sha256(path, chunk=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _pack_strings(values):
+    """字符串列按列存储：UTF-8 字节拼接 + 每行长度，None 记为长度 -1 (比定长 unicode 数组小得多)"""
+    encoded = [v.encode("utf-8") if v is not None else None for v in values]
+    lengths = np.array([len(b) if b is not None else -1 for b in encoded], dtype=np.int64)
+    data = np.frombuffer(b"".join(b for b in encoded if b), dtype=np.uint8)
+    return lengths, data
+
+
+def _unpack_strings(lengths, data):
+    raw = data.tobytes()
+    out, pos = [], 0
+    for n in lengths.tolist():
+        if n < 0:
+            out.append(None)
+            continue
+        out.append(raw[pos:pos + n].decode("utf-8"))
+        pos += n
+    return out
+
+
+def _write_shard(path, rows, dtype, compress):
+    ids_len, ids_data = _pack_strings(rows["ids"])
+    docs = rows.get("documents") or [None] * len(rows["ids"])
+    doc_len, doc_data = _pack_strings(docs)
+    metas = [json.dumps(m, ensure_ascii=False) if m is not None else None
+             for m in (rows.get("metadatas") or [None] * len(rows["ids"]))]
+    meta_len, meta_data = _pack_strings(metas)
+    arrays = {
+        "embeddings": np.asarray(rows["embeddings"], dtype=np.float32).astype(dtype),
+        "ids_len": ids_len, "ids_data": ids_data,
+        "documents_len": doc_len, "documents_data": doc_data,
+        "metadatas_len": meta_len, "metadatas_data": meta_data,
+    }
+    # 先写临时文件再改名，中断时不会留下半个分片
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        (np.savez_compressed if compress else np.savez)(f, **arrays)
+    os.replace(tmp, path)
+
+
+def read_shard(path):
+    """读取一个分片，返回与 collection.get 相同结构的 dict (embeddings 为 float32)"""
+    with np.load(path, allow_pickle=False) as z:
+        docs = _unpack_strings(z["documents_len"], z["documents_data"])
+        return {
+            "ids": _unpack_strings(z["ids_len"], z["ids_data"]),
+            "embeddings": z["embeddings"].astype(np.float32),
+            "documents": docs if any(d is not None for d in docs) else None,
+            "metadatas": [json.loads(m) if m is not None else None
+                          for m in _unpack_strings(z["metadatas_len"], z["metadatas_data"])],
+        }
+
+
+def read_manifest(snapshot_dir):
+    path = os.path.join(snapshot_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        raise ValueError(f"{snapshot_dir} is not a complete snapshot (missing {MANIFEST_NAME})")
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version: {manifest.get('version')}")
+    return manifest
+
+
+def export_snapshot(snapshot_dir, collections, model_ids, shard_rows=DEFAULT_SHARD_ROWS,
+                    compress=True, dtype="float32", image_manifest=None, log=print):
+    """把各 collection 分页读出，逐个分片写入 snapshot_dir，最后写 manifest.json
+
+    collections: {name: collection}；model_ids: {"text": id, "clip": id}；
+    image_manifest: ImageIndexer.manifest_rows() 的结果，写入 image_manifest.json。
+    每个分片写完即释放，内存占用与库大小无关；manifest 最后写入，存在即表示快照完整。
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    manifest = {"version": SNAPSHOT_VERSION, "created": time.time(), "compressed": compress,
+                "dtype": dtype, "collections": {}}
+    for name, collection in collections.items():
+        entry = {"model_id": model_ids[SNAPSHOT_COLLECTIONS[name]], "dim": None, "rows": 0, "shards": []}
+        offset = 0
+        while True:
+            rows = collection.get(limit=shard_rows, offset=offset,
+                                  include=["embeddings", "documents", "metadatas"])
+            if not len(rows["ids"]):
+                break
+            file = f"{name}-{len(entry['shards']):05d}.npz"
+            path = os.path.join(snapshot_dir, file)
+            _write_shard(path, rows, dtype, compress)
+            entry["dim"] = int(np.asarray(rows["embeddings"]).shape[1])
+            entry["rows"] += len(rows["ids"])
+            entry["shards"].append({"file": file, "rows": len(rows["ids"]),
+                                    "bytes": os.path.getsize(path), "sha256": _sha256(path)})
+            offset += len(rows["ids"])
+            log(f"Exported {entry['rows']} rows of '{name}'...")
+        manifest["collections"][name] = entry
+    if image_manifest is not None:
+        path = os.path.join(snapshot_dir, IMAGE_MANIFEST_NAME)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(image_manifest, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+        manifest["image_manifest"] = {"file": IMAGE_MANIFEST_NAME, "rows": len(image_manifest),
+                                      "sha256": _sha256(path)}
+    tmp = os.path.join(snapshot_dir, MANIFEST_NAME + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(snapshot_dir, MANIFEST_NAME))
+    return manifest
+
+
+def check_model_ids(manifest, model_ids):
+    """返回模型不一致的 collection 列表 [(name, 快照中的模型, 当前模型)]"""
+    return [(name, entry["model_id"], model_ids[SNAPSHOT_COLLECTIONS[name]])
+            for name, entry in manifest["collections"].items()
+            if name in SNAPSHOT_COLLECTIONS and entry["model_id"] != model_ids[SNAPSHOT_COLLECTIONS[name]]]
+
+
+def import_snapshot(snapshot_dir, collections, keyword_index=None, batch=5000, verify=True, log=print):
+    """逐个分片校验 sha256 后读入并分批 upsert，papers 的文本同时写入 BM25 索引；返回各 collection 的行数
+
+    模型一致性由调用方先用 check_model_ids 检查。同一时刻只有一个分片在内存中。
+    """
+    manifest = read_manifest(snapshot_dir)
+    imported = {}
+    for name, entry in manifest["collections"].items():
+        if name not in collections:
+            continue
+        collection = collections[name]
+        imported[name] = 0
+        for shard in entry["shards"]:
+            path = os.path.join(snapshot_dir, shard["file"])
+            if verify and _sha256(path) != shard["sha256"]:
+                raise ValueError(f"Checksum mismatch in {shard['file']}; the snapshot is corrupt or incomplete")
+            rows = read_shard(path)
+            for start in range(0, len(rows["ids"]), batch):
+                ids = rows["ids"][start:start + batch]
+                docs = rows["documents"][start:start + batch] if rows["documents"] is not None else None
+                collection.upsert(ids=ids, embeddings=rows["embeddings"][start:start + batch],
+                                  documents=docs, metadatas=rows["metadatas"][start:start + batch])
+                if name == "papers" and keyword_index is not None and docs is not None:
+                    keyword_index.add(ids, [doc or "" for doc in docs])
+            imported[name] += len(rows["ids"])
+            log(f"Imported {imported[name]}/{entry['rows']} rows of '{name}'...")
+    return imported
+
+
+def read_image_manifest(snapshot_dir, verify=True):
+    """读取快照中的图片清单行；旧快照没有清单时返回空列表"""
+    entry = read_manifest(snapshot_dir).get("image_manifest")
+    if entry is None:
+        return []
+    path = os.path.join(snapshot_dir, entry["file"])
+    if verify and _sha256(path) != entry["sha256"]:
+        raise ValueError(f"Checksum mismatch in {entry['file']}; the snapshot is corrupt or incomplete")
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
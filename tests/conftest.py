@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_loader import StubEmbeddingModel  # noqa: E402
+from paper_registry import PaperRegistry, page_id  # noqa: E402
+from vector_store import MmapCollection  # noqa: E402
+
+
+@pytest.fixture
+def model():
+    return StubEmbeddingModel()
+
+
+@pytest.fixture
+def collection(tmp_path):
+    return MmapCollection(str(tmp_path / "store" / "papers"), dtype="float16")
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return PaperRegistry(str(tmp_path / "db" / "paper_registry.sqlite3"))
+
+
+def add_pages(collection, model, doc_id, path, topic, texts):
+    """按导入流程的格式写入一篇论文的页面行 ({doc_id}_p{页码})"""
+    vecs = model.get_text_embeddings(texts)
+    collection.upsert(
+        ids=[page_id(doc_id, page) for page in range(1, len(texts) + 1)],
+        embeddings=np.asarray(vecs).tolist(),
+        documents=list(texts),
+        metadatas=[{"path": path, "topic": topic, "page": page} for page in range(1, len(texts) + 1)],
+    )
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    """在临时目录中运行 main 的命令 (./db、data/ 都在 tmp_path 下)，使用 mmap 后端和替身编码器"""
+    import db
+    import main
+    monkeypatch.chdir(tmp_path)
+    for name in ("_clients", "_collections", "_keyword_indexes", "_registries"):
+        monkeypatch.setattr(db, name, {})
+    monkeypatch.setattr(db, "VECTOR_STORE", "mmap")
+    monkeypatch.setattr(main, "_model_handler", StubEmbeddingModel())
+    return main
+
+
+def write_pdf(path, pages):
+    from bench import write_pdf as _write_pdf
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    _write_pdf(str(path), pages)
+    return str(path)
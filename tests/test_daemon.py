@@ -0,0 +1,58 @@
+import threading
+import time
+
+import daemon
+
+
+def _start(tmp_path, handlers):
+    path = str(tmp_path / "agent.sock")
+    server = daemon.AgentDaemon(path, handlers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, path
+
+
+def test_search_not_blocked_by_running_ingest(tmp_path):
+    started, release = threading.Event(), threading.Event()
+
+    def add_paper(file_path):
+        print(f"Ingesting {file_path}")
+        started.set()
+        release.wait(10)
+        print("done")
+
+    def search_paper(query):
+        print(f"results for {query}")
+
+    server, path = _start(tmp_path, {"add_paper": add_paper, "search_paper": search_paper})
+    try:
+        slow = {}
+        writer = threading.Thread(target=lambda: slow.update(daemon.request("add_paper", {"file_path": "a.pdf"}, path)))
+        writer.start()
+        assert started.wait(5)
+
+        start = time.perf_counter()
+        resp = daemon.request("search_paper", {"query": "resnet"}, path, timeout=2)
+        assert time.perf_counter() - start < 1
+        # 各请求的输出互不混入
+        assert resp == {"ok": True, "output": "results for resnet\n"}
+
+        release.set()
+        writer.join(5)
+        assert slow == {"ok": True, "output": "Ingesting a.pdf\ndone\n"}
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+
+
+def test_request_times_out_and_falls_back(tmp_path):
+    release = threading.Event()
+    server, path = _start(tmp_path, {"search_paper": lambda query: release.wait(10)})
+    try:
+        start = time.perf_counter()
+        assert daemon.request("search_paper", {"query": "x"}, path, timeout=0.2) is None
+        assert time.perf_counter() - start < 2
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
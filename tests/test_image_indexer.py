@@ -0,0 +1,120 @@
+import os
+import random
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from bench import write_image
+from image_indexer import HASH_BYTES, HashIndex, ImageIndexer, dhash, duplicate_counts, image_id
+from vector_store import MmapCollection
+
+
+def _flip(h, bits):
+    arr = np.frombuffer(h, dtype=np.uint8).copy()
+    for bit in bits:
+        arr[bit // 8] ^= 1 << (bit % 8)
+    return arr.tobytes()
+
+
+def test_hash_index_nearest():
+    rng = np.random.default_rng(0)
+    hashes = [rng.integers(0, 256, HASH_BYTES, dtype=np.uint8).tobytes() for _ in range(50)]
+    index = HashIndex()
+    for i, h in enumerate(hashes):
+        index.add(h, f"g{i}")
+    assert index.nearest(hashes[7], 4) == ("g7", 0)
+    assert index.nearest(_flip(hashes[7], [1, 40, 100]), 4) == ("g7", 3)
+    assert index.nearest(_flip(hashes[7], range(0, 60, 10)), 4) == (None, None)
+    # 阈值不小于段数时走全量比较
+    assert index.nearest(_flip(hashes[7], range(0, 100, 10)), 12) == ("g7", 10)
+
+
+@pytest.fixture
+def images(tmp_path):
+    """a.jpg 与其缩小重存的副本 a_copy.jpg 互为近似重复，b.jpg 是另一张图"""
+    folder = tmp_path / "images"
+    folder.mkdir()
+    rng = random.Random(3)
+    write_image(str(folder / "a.jpg"), rng, (640, 480))
+    Image.open(folder / "a.jpg").resize((320, 240)).save(folder / "a_copy.jpg", quality=80)
+    write_image(str(folder / "b.jpg"), rng, (640, 480))
+    assert dhash(Image.open(folder / "a.jpg")) != dhash(Image.open(folder / "b.jpg"))
+    return folder
+
+
+def _indexer(tmp_path, model):
+    return ImageIndexer(MmapCollection(str(tmp_path / "store" / "images")), model,
+                        manifest_path=str(tmp_path / "manifest.sqlite3"))
+
+
+def _rows(indexer):
+    rows = indexer.collection.get(include=["embeddings", "metadatas"])
+    return {row_id: (np.asarray(vec), meta["path"]) for row_id, vec, meta in
+            zip(rows["ids"], rows["embeddings"], rows["metadatas"])}
+
+
+def _groups(indexer):
+    return dict(indexer._conn.execute("SELECT abspath, group_id FROM manifest").fetchall())
+
+
+def test_near_duplicates_share_one_row(tmp_path, model, images):
+    indexer = _indexer(tmp_path, model)
+    stats = indexer.sync(str(images))
+    assert (stats["added"], stats["embedded"], stats["duplicates"]) == (3, 2, 1)
+    assert stats["images_per_sec"] > 0
+    rows = _rows(indexer)
+    assert len(rows) == 2
+    groups = _groups(indexer)
+    a, copy = str(images / "a.jpg"), str(images / "a_copy.jpg")
+    assert groups[a] == groups[copy] != groups[str(images / "b.jpg")]
+    assert duplicate_counts(list(rows), str(tmp_path / "manifest.sqlite3")) == {groups[a]: 1}
+
+    again = indexer.sync(str(images))
+    assert (again["unchanged"], again["embedded"]) == (3, 0)
+
+
+def test_deleting_representative_promotes_heir(tmp_path, model, images):
+    indexer = _indexer(tmp_path, model)
+    indexer.sync(str(images))
+    groups = _groups(indexer)
+    pair = [str(images / "a.jpg"), str(images / "a_copy.jpg")]
+    rep, heir = sorted(pair, key=lambda path: image_id(path) != groups[path])
+    rep_vec = _rows(indexer)[image_id(rep)][0]
+
+    os.remove(rep)
+    stats = indexer.sync(str(images))
+    assert (stats["removed"], stats["embedded"]) == (1, 0)
+    rows = _rows(indexer)
+    assert image_id(rep) not in rows
+    # 接替者沿用原向量，不重新编码
+    vec, path = rows[image_id(heir)]
+    np.testing.assert_allclose(vec, rep_vec)
+    assert os.path.abspath(path) == heir
+    assert _groups(indexer)[heir] == image_id(heir)
+
+    os.remove(heir)
+    indexer.sync(str(images))
+    assert list(_rows(indexer)) == [image_id(str(images / "b.jpg"))]
+
+
+def test_deleting_member_keeps_representative(tmp_path, model, images):
+    indexer = _indexer(tmp_path, model)
+    indexer.sync(str(images))
+    groups = _groups(indexer)
+    member = next(path for path, group in groups.items() if image_id(path) != group)
+    before = _rows(indexer)
+    os.remove(member)
+    assert indexer.sync(str(images))["removed"] == 1
+    assert _rows(indexer).keys() == before.keys()
+
+
+def test_search_image_prints_paths_and_honours_top_k(agent, images, capsys):
+    agent.add_image(str(images))
+    capsys.readouterr()
+    agent.search_image("red shapes", top_k=1)
+    lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith("[")]
+    assert len(lines) == 1
+    assert lines[0].split(" (Path: ")[0][4:] in {"a.jpg", "a_copy.jpg", "b.jpg"}
+    agent.search_image("red shapes", top_k=5)
+    assert len([line for line in capsys.readouterr().out.splitlines() if line.startswith("[")]) == 2
@@ -0,0 +1,75 @@
+import multiprocessing
+import subprocess
+import sys
+import time
+
+from ingest_jobs import JobQueue
+
+
+def _queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.sqlite3"), str(tmp_path / "uploads"))
+
+
+def _submit(queue, tmp_path, n):
+    ids = []
+    for i in range(n):
+        src = tmp_path / f"paper{i}.pdf"
+        src.write_bytes(f"%PDF-1.4 paper {i}".encode())
+        ids.append(queue.submit(str(src), src.name))
+    return ids
+
+
+def _claim_all(tmp_path, out):
+    queue = _queue(tmp_path)
+    claimed = []
+    while True:
+        job = queue.claim()
+        if job is None:
+            break
+        claimed.append(job["id"])
+    out.put(claimed)
+
+
+def test_submit_dedupes_same_file(tmp_path):
+    queue = _queue(tmp_path)
+    first = _submit(queue, tmp_path, 1)[0]
+    assert queue.submit(str(tmp_path / "paper0.pdf"), "paper0.pdf") == first
+
+
+def test_claim_is_exclusive_across_processes(tmp_path):
+    ids = _submit(_queue(tmp_path), tmp_path, 200)
+    out = multiprocessing.get_context("fork").Queue()
+    workers = [multiprocessing.get_context("fork").Process(target=_claim_all, args=(tmp_path, out))
+               for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    claimed = [job_id for _ in workers for job_id in out.get(timeout=60)]
+    for worker in workers:
+        worker.join()
+    assert sorted(claimed) == ids
+
+
+def test_requeue_only_jobs_of_exited_owners(tmp_path):
+    ours, other = _queue(tmp_path), _queue(tmp_path)
+    job_ids = _submit(ours, tmp_path, 3)
+    assert [ours.claim()["id"], other.claim()["id"]] == job_ids[:2]
+
+    # 另一个仍在运行的进程 (这里是同一进程中的另一个队列实例) 的任务不动
+    assert ours.requeue_stale() == 0
+    assert other.get(job_ids[1])["status"] == "running"
+
+    # 领取者进程已退出
+    dead = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                          capture_output=True, text=True).stdout.strip()
+    host = ours.owner.split(":")[0]
+    third = ours.claim()["id"]
+    ours.update(third, owner=f"{host}:{dead}:deadbeef")
+    assert other.requeue_stale() == 1
+    assert ours.get(third)["status"] == "queued"
+
+    # 长时间没有进度的任务视为失联
+    ours._conn.execute("UPDATE jobs SET updated=0 WHERE id=?", (job_ids[1],))
+    ours._conn.commit()
+    assert ours.requeue_stale() == 1
+    assert ours.get(job_ids[0])["status"] == "running"
+    assert time.time() - ours.get(job_ids[1])["updated"] < 60
@@ -0,0 +1,67 @@
+import math
+
+import pytest
+
+from keyword_index import KeywordIndex, query_mode, tokenize
+
+
+@pytest.mark.parametrize("query, mode", [
+    ("ResNet-50", "lexical"),
+    ("arXiv:1706.03762", "lexical"),
+    ("ViT-B/32", "lexical"),
+    ('"attention is all you need"', "lexical"),
+    ("Vision Transformer", "hybrid"),
+    ("Graph Neural Networks", "hybrid"),
+    ("Deep Reinforcement Learning", "hybrid"),
+    ("Yann LeCun", "hybrid"),
+    ("How does BERT work?", "hybrid"),
+    ("What is the ResNet-50 accuracy on ImageNet", "hybrid"),
+    ("what is self-attention", "dense"),
+])
+def test_query_mode(query, mode):
+    assert query_mode(query) == mode
+
+
+def test_tokenize_identifier_parts():
+    assert tokenize("ResNet-50") == ["resnet-50", "resnet", "50"]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = KeywordIndex(str(tmp_path / "bm25.sqlite3"))
+    texts = {
+        "a.pdf_p1": "the resnet-50 accuracy on imagenet is high",
+        "a.pdf_p2": "the model is trained on the dataset",
+        "b.pdf_p1": "the transformer uses attention",
+        "b.pdf_p2": "resnet-50 and the transformer on imagenet",
+    }
+    index.add(list(texts), list(texts.values()))
+    return index
+
+
+def _bm25(index, doc_len, avgdl, n_docs, term_stats):
+    score = 0.0
+    for tf, df in term_stats:
+        idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        score += idf * tf * (index.k1 + 1) / (tf + index.k1 * (1 - index.b + index.b * doc_len / avgdl))
+    return score
+
+
+def test_search_scores_and_stopwords(index):
+    results = index.search("What is the ResNet-50 accuracy on ImageNet", k=10)
+    assert [doc_id for doc_id, _ in results] == ["a.pdf_p1", "b.pdf_p2"]
+    # 停用词不参与打分：与只用内容词检索的结果完全一致
+    assert results == index.search("ResNet-50 accuracy ImageNet", k=10)
+    avgdl = (9 + 7 + 4 + 8) / 4
+    # a.pdf_p1 命中 resnet-50 / resnet / 50 / accuracy / imagenet
+    expected = _bm25(index, 9, avgdl, 4, [(1, 2), (1, 2), (1, 2), (1, 1), (1, 2)])
+    assert results[0][1] == pytest.approx(expected)
+
+
+def test_search_only_stopwords_and_filters(index):
+    assert {doc_id for doc_id, _ in index.search("the", k=10)} == {"a.pdf_p1", "a.pdf_p2", "b.pdf_p1", "b.pdf_p2"}
+    results = index.search("resnet-50 imagenet", k=10, accept=lambda doc_id: doc_id.startswith("b.pdf"))
+    assert [doc_id for doc_id, _ in results] == ["b.pdf_p2"]
+    index.remove(["b.pdf_p2"])
+    assert index.search("resnet-50 imagenet", k=10, accept=lambda doc_id: doc_id.startswith("b.pdf")) == []
+    assert index.count() == 3
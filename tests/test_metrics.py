@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import metrics
+
+
+def test_sub_millisecond_percentiles():
+    registry = metrics.Registry(enabled=True)
+    samples = np.random.default_rng(0).gamma(4.0, 0.00027, 500)
+    for value in samples:
+        registry.observe("papers.query", float(value))
+    stats = registry.snapshot()["papers.query"]
+    assert stats["p50"] == pytest.approx(np.percentile(samples, 50))
+    assert stats["p95"] == pytest.approx(np.percentile(samples, 95))
+    assert stats["p50"] < stats["p95"] < stats["max"]
+
+
+def test_reservoir_is_bounded():
+    hist = metrics.Histogram(metrics.LATENCY_BUCKETS, reservoir=100)
+    for value in range(10000):
+        hist.observe(value / 10000)
+    assert len(hist.samples) == 100
+    assert hist.count == 10000
+    assert 0.3 < hist.quantile(0.5) < 0.7
+
+
+def test_prometheus_buckets_cumulative():
+    registry = metrics.Registry(enabled=True)
+    for value in (0.0002, 0.0004, 0.003):
+        registry.observe("bm25.search", value)
+    text = registry.render_prometheus()
+    assert 'agent_stage_seconds_bucket{stage="bm25.search",le="0.00025"} 1' in text
+    assert 'agent_stage_seconds_bucket{stage="bm25.search",le="0.0005"} 2' in text
+    assert 'agent_stage_seconds_bucket{stage="bm25.search",le="+Inf"} 3' in text
@@ -0,0 +1,53 @@
+import numpy as np
+
+from model_loader import EmbeddingModel
+from query_batcher import QueryBatcher
+
+
+class FakeSentenceTransformer:
+    def __init__(self, dim=4):
+        self.dim = dim
+        self.calls = []
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, inputs, batch_size=32, convert_to_numpy=True, show_progress_bar=False):
+        self.calls.append(list(inputs))
+        return np.stack([np.full(self.dim, len(text), dtype=np.float32) for text in inputs])
+
+
+def _model(tmp_path):
+    model = EmbeddingModel(cache_path=str(tmp_path / "embeddings.sqlite3"))
+    model._device = "cpu"
+    return model
+
+
+def test_empty_input_does_not_load_model(tmp_path):
+    model = _model(tmp_path)
+    assert model.get_text_embeddings([]).shape[0] == 0
+    assert model._text_model is None
+    model._text_model = FakeSentenceTransformer()
+    assert model.get_text_embeddings([]).shape == (0, 4)
+
+
+def test_queries_skip_persistent_cache(tmp_path):
+    model = _model(tmp_path)
+    model._text_model = fake = FakeSentenceTransformer()
+    model._clip_model = FakeSentenceTransformer()
+    model.get_text_embeddings(["page one", "page two"])
+    assert model.cache.stats()["entries"] == 2
+
+    assert model.get_text_embedding("what is attention") == [17.0] * 4
+    model.get_text_for_image_embedding("a cat")
+    batcher = QueryBatcher(model)
+    batcher.get_text_embedding("graph neural networks")
+    model.get_text_embeddings(["batch query"], persist=False)
+    assert model.cache.stats()["entries"] == 2
+
+    # 内存中的 query_cache 仍然生效
+    model.get_text_embedding("what is attention")
+    assert fake.calls.count(["what is attention"]) == 1
+    # 导入时的页面编码命中持久化缓存
+    model.get_text_embeddings(["page one"])
+    assert ["page one"] not in fake.calls[1:]
@@ -0,0 +1,115 @@
+import os
+import shutil
+
+import paper_registry
+from conftest import write_pdf
+from paper_registry import PaperRegistry
+
+# 页面文本需超过 utils.MIN_PAGE_CHARS 才会被提取
+PAGES = [" ".join([words] * 4) for words in ("attention is all you need transformer",
+                                             "multi head attention layers and encoders",
+                                             "results on translation benchmarks")]
+OTHER = [" ".join([words] * 4) for words in ("graph neural networks for molecules", "message passing layers")]
+
+
+def _page_rows(agent):
+    rows = agent.get_collection("papers").get(include=["metadatas"])
+    return dict(zip(rows["ids"], rows["metadatas"]))
+
+
+def test_assign_doc_id_same_name_different_content(tmp_path):
+    registry = PaperRegistry(str(tmp_path / "registry.sqlite3"))
+    assert registry.assign_doc_id("a" * 64, "paper.pdf") == "paper.pdf"
+    assert registry.assign_doc_id("b" * 64, "paper.pdf") == "paper.pdf#bbbbbbbb"
+    # 同一内容 (中断后续传) 沿用已分配的 id
+    assert registry.assign_doc_id("a" * 64, "renamed.pdf") == "paper.pdf"
+
+
+def test_find_fast_path_skips_hashing(tmp_path, monkeypatch):
+    registry = PaperRegistry(str(tmp_path / "registry.sqlite3"))
+    path = write_pdf(tmp_path / "a.pdf", PAGES)
+    key, known = registry.find(path)
+    assert known is None
+    registry.assign_doc_id(key, "a.pdf")
+    registry.record(key, path, "NLP", 3, 3)
+
+    monkeypatch.setattr(paper_registry, "file_hash", lambda p: (_ for _ in ()).throw(AssertionError("hashed")))
+    found_key, rec = registry.find(path)
+    assert found_key == key and rec["doc_id"] == "a.pdf" and rec["pages"] == 3
+
+
+def test_reingest_same_file_is_skipped(agent, tmp_path, monkeypatch, capsys):
+    path = write_pdf(tmp_path / "papers" / "a.pdf", PAGES)
+    agent.add_paper(path)
+    assert sorted(_page_rows(agent)) == ["a.pdf_p1", "a.pdf_p2", "a.pdf_p3"]
+
+    monkeypatch.setattr(agent, "index_pdf", lambda *a, **k: (_ for _ in ()).throw(AssertionError("re-indexed")))
+    agent.add_paper(path)
+    assert "Already indexed" in capsys.readouterr().out
+    agent.add_papers(str(tmp_path / "papers"))
+    assert len(_page_rows(agent)) == 3
+
+
+def test_moved_file_updates_path_only(agent, tmp_path, monkeypatch):
+    path = write_pdf(tmp_path / "inbox" / "a.pdf", PAGES)
+    agent.add_paper(path)
+    new_path = str(tmp_path / "archive" / "a.pdf")
+    os.makedirs(os.path.dirname(new_path))
+    shutil.move(path, new_path)
+
+    monkeypatch.setattr(agent, "index_pdf", lambda *a, **k: (_ for _ in ()).throw(AssertionError("re-indexed")))
+    agent.add_paper(new_path)
+    rows = _page_rows(agent)
+    assert sorted(rows) == ["a.pdf_p1", "a.pdf_p2", "a.pdf_p3"]
+    assert {meta["path"] for meta in rows.values()} == {new_path}
+    assert agent.get_paper_registry().select(paths=[new_path]) == {"a.pdf": (new_path, 3, 3)}
+
+
+def test_identical_copy_is_skipped(agent, tmp_path, capsys):
+    path = write_pdf(tmp_path / "inbox" / "a.pdf", PAGES)
+    agent.add_paper(path)
+    copy = str(tmp_path / "other" / "copy.pdf")
+    os.makedirs(os.path.dirname(copy))
+    shutil.copy(path, copy)
+    agent.add_paper(copy)
+    assert "identical to already indexed" in capsys.readouterr().out
+    assert {meta["path"] for meta in _page_rows(agent).values()} == {path}
+
+
+def test_same_name_different_content_gets_distinct_ids(agent, tmp_path):
+    first = write_pdf(tmp_path / "x" / "paper.pdf", PAGES)
+    second = write_pdf(tmp_path / "y" / "paper.pdf", OTHER)
+    agent.add_paper(first)
+    agent.add_paper(second)
+    rows = _page_rows(agent)
+    key = paper_registry.file_hash(second)
+    assert sorted(rows) == ["paper.pdf#" + key[:8] + "_p1", "paper.pdf#" + key[:8] + "_p2",
+                            "paper.pdf_p1", "paper.pdf_p2", "paper.pdf_p3"]
+    assert rows["paper.pdf_p1"]["path"] == first
+    assert rows[f"paper.pdf#{key[:8]}_p1"]["path"] == second
+
+
+def test_modified_file_drops_stale_pages(agent, tmp_path):
+    path = write_pdf(tmp_path / "papers" / "a.pdf", PAGES)
+    agent.add_paper(path)
+    write_pdf(path, OTHER[:1])
+    agent.add_paper(path)
+    rows = _page_rows(agent)
+    assert len(rows) == 1
+    (meta,) = rows.values()
+    assert meta["path"] == path
+    assert agent.get_keyword_index().count() == 1
+    assert agent.get_paper_registry().count() == 1
+
+
+def test_backfill_registers_existing_rows(agent, tmp_path, model, collection, registry):
+    from conftest import add_pages
+    present = write_pdf(tmp_path / "old" / "kept.pdf", PAGES)
+    add_pages(collection, model, "kept.pdf", present, "NLP", PAGES)
+    add_pages(collection, model, "gone.pdf", str(tmp_path / "old" / "gone.pdf"), "CV", OTHER)
+    assert registry.backfill(collection, log=lambda *_: None) == 2
+    _, rec = registry.find(present)
+    assert rec["doc_id"] == "kept.pdf" and rec["pages"] == 3 and rec["last_page"] == 3
+    # 已不在磁盘上的论文只占用 doc_id：同名新文件不会覆盖它的行
+    assert registry.assign_doc_id("c" * 64, "gone.pdf") == "gone.pdf#cccccccc"
+    assert registry.backfill(collection, log=lambda *_: None) == 0
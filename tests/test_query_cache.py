@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+from query_cache import CachedCollection, SqliteDataVersion
+from vector_store import MmapCollection
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_write_by_other_process_invalidates(tmp_path):
+    store = str(tmp_path / "papers")
+    raw = MmapCollection(store)
+    raw.upsert(ids=["a"], embeddings=[[1.0, 0.0]], documents=["a"], metadatas=[{"path": "a"}])
+    cached = CachedCollection(raw, version=SqliteDataVersion(os.path.join(store, "meta.sqlite3")))
+    query = [[0.0, 1.0]]
+    assert cached.query(query_embeddings=query, n_results=2)["ids"] == [["a"]]
+    assert cached.query(query_embeddings=query, n_results=2)["ids"] == [["a"]]
+    assert cached.result_cache.hits == 1
+
+    subprocess.run([sys.executable, "-c", (
+        f"import sys; sys.path.insert(0, {ROOT!r}); from vector_store import MmapCollection; "
+        f"MmapCollection({store!r}).upsert(ids=['b'], embeddings=[[0.0, 1.0]], documents=['b'])"
+    )], check=True)
+    assert cached.query(query_embeddings=query, n_results=2)["ids"] == [["b", "a"]]
+    assert cached.result_cache.hits == 1
+
+
+def test_write_through_wrapper_invalidates(tmp_path):
+    cached = CachedCollection(MmapCollection(str(tmp_path / "papers")))
+    cached.upsert(ids=["a"], embeddings=[[1.0, 0.0]])
+    assert cached.query(query_embeddings=[[1.0, 0.0]], n_results=1)["ids"] == [["a"]]
+    cached.delete(ids=["a"])
+    assert cached.query(query_embeddings=[[1.0, 0.0]], n_results=1)["ids"] == [[]]
@@ -0,0 +1,37 @@
+from conftest import add_pages
+from keyword_index import dense_query
+from paper_ingest import reclassify_library
+from search_filter import PageFilter, parse_pages
+
+
+def test_parse_pages():
+    assert parse_pages("5") == (5, 5)
+    assert parse_pages("3-10") == (3, 10)
+    assert parse_pages("3-") == (3, None)
+    assert parse_pages("-10") == (None, 10)
+    assert parse_pages("") == (None, None)
+
+
+def test_topic_filter_after_reclassify_without_files(tmp_path, model, collection, registry):
+    # 只导入了快照的节点：页面行指向的 PDF 都不在磁盘上
+    add_pages(collection, model, "a.pdf", str(tmp_path / "Bio" / "a.pdf"), "Bio", ["alpha alpha graph", "alpha"])
+    add_pages(collection, model, "b.pdf", str(tmp_path / "Chem" / "b.pdf"), "Chem", ["beta beta token", "beta"])
+    assert registry.backfill(collection, log=lambda *_: None) == 2
+
+    stats = reclassify_library(collection, model, ["alpha", "beta"], move=True, summary_pages=2,
+                               log=lambda *_: None, registry=registry)
+    assert stats["changed"] == 2 and stats["moved"] == 0
+
+    assert [topic for topic, _, _ in registry.facets()["topics"]] == ["alpha", "beta"]
+    filters = PageFilter.from_args(topic="alpha,beta")
+    assert filters.resolve(registry) == 2
+    assert not filters.no_match
+    query = model.get_text_embeddings(["alpha"])
+    hits = dense_query(collection, query, 10, filters, include=["metadatas"])
+    assert {meta["topic"] for meta in hits["metadatas"][0]} == {"alpha", "beta"}
+    assert len(hits["ids"][0]) == 4
+
+    only_beta = PageFilter.from_args(topic="beta", pages="2")
+    only_beta.resolve(registry)
+    hits = dense_query(collection, query, 10, only_beta, include=["metadatas"])
+    assert hits["ids"][0] == ["b.pdf_p2"]
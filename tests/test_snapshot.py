@@ -0,0 +1,57 @@
+import os
+import random
+import shutil
+
+import pytest
+from PIL import Image
+
+import db
+from bench import write_image
+from conftest import add_pages
+from image_indexer import ImageIndexer, duplicate_counts, image_id
+
+
+def _fresh_node(monkeypatch, root):
+    """切换到另一个 (空库的) 项目目录，模拟新节点"""
+    monkeypatch.chdir(root)
+    for name in ("_clients", "_collections", "_keyword_indexes", "_registries"):
+        monkeypatch.setattr(db, name, {})
+
+
+@pytest.mark.parametrize("moved", [False, True])
+def test_import_restores_image_manifest(agent, tmp_path, monkeypatch, model, moved):
+    folder = tmp_path / "data" / "images"
+    folder.mkdir(parents=True)
+    rng = random.Random(5)
+    for i in range(4):
+        write_image(str(folder / f"img{i}.jpg"), rng, (320, 240))
+    Image.open(folder / "img0.jpg").resize((160, 120)).save(folder / "img0_copy.jpg", quality=80)
+    add_pages(db.get_collection("papers"), model, "paper.pdf", "data/paper.pdf", "CV",
+              ["a page about convolutional networks"])
+    agent.add_image("data/images")
+    exported = ImageIndexer(db.get_collection("images"), model).manifest_rows()
+    assert len(exported) == 5
+    agent.export_index(str(tmp_path / "snapshot"))
+
+    if moved:
+        # 项目目录整体搬到另一个位置，图片的绝对路径随之改变
+        node = tmp_path / "node"
+        shutil.copytree(tmp_path / "data", node / "data")
+    else:
+        node = tmp_path
+        shutil.rmtree(tmp_path / "db")
+    _fresh_node(monkeypatch, node)
+    agent.import_index(str(tmp_path / "snapshot"))
+
+    images = db.get_collection("images")
+    assert images.count() == 4
+    indexer = ImageIndexer(images, model)
+    stats = indexer.sync("data/images")
+    assert stats["embedded"] == 0
+    assert (stats["unchanged"], stats["added"], stats["removed"]) == (5, 0, 0)
+    assert images.count() == 4
+    rows = images.get(include=["metadatas"])
+    # 行 id 与 path 都指向本节点上的文件
+    assert all(os.path.exists(meta["path"]) and row_id == image_id(meta["path"])
+               for row_id, meta in zip(rows["ids"], rows["metadatas"]))
+    assert sorted(duplicate_counts(rows["ids"]).values()) == [1]
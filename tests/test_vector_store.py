@@ -0,0 +1,45 @@
+import multiprocessing
+
+import numpy as np
+
+from vector_store import MmapCollection
+
+
+def _write(path, worker, n, batch):
+    collection = MmapCollection(path)
+    for start in range(0, n, batch):
+        ids = [f"w{worker}_{i}" for i in range(start, start + batch)]
+        vecs = [[worker + 1.0, float(i), 1.0] for i in range(start, start + batch)]
+        collection.upsert(ids=ids, embeddings=vecs, metadatas=[{"worker": worker, "i": i}
+                                                               for i in range(start, start + batch)])
+
+
+def test_concurrent_writers_keep_every_row(tmp_path):
+    path = str(tmp_path / "papers")
+    MmapCollection(path)
+    ctx = multiprocessing.get_context("fork")
+    # 每个进程写 2000 行，跨过多次扩容 (初始容量 1024)
+    workers = [ctx.Process(target=_write, args=(path, w, 2000, 50)) for w in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    collection = MmapCollection(path)
+    assert collection.count() == 8000
+    rows = collection.get(include=["embeddings", "metadatas"])
+    assert len(rows["ids"]) == 8000
+    for vec, meta in zip(rows["embeddings"], rows["metadatas"]):
+        np.testing.assert_allclose(vec, [meta["worker"] + 1.0, meta["i"], 1.0], rtol=1e-3)
+
+
+def test_upsert_query_delete(tmp_path):
+    collection = MmapCollection(str(tmp_path / "papers"))
+    collection.upsert(ids=["a", "b"], embeddings=[[1.0, 0.0], [0.0, 1.0]],
+                      metadatas=[{"topic": "CV", "page": 1}, {"topic": "NLP", "page": 2}])
+    hits = collection.query(query_embeddings=[[0.9, 0.1]], n_results=2)
+    assert hits["ids"] == [["a", "b"]]
+    assert collection.query(query_embeddings=[[0.9, 0.1]], n_results=2, where={"topic": "NLP"})["ids"] == [["b"]]
+    collection.delete(ids=["a"])
+    assert collection.query(query_embeddings=[[0.9, 0.1]], n_results=2)["ids"] == [["b"]]
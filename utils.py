@@ -1,29 +1,76 @@
+import hashlib
 import os
 import shutil
 from pypdf import PdfReader
 
+import metrics
+
+MIN_PAGE_CHARS = 50
+
+def iter_pages(pdf_path, start_page=0, reopen_every=256):
+    """逐页解析 PDF 并立即产出 {"text", "page"}，不在内存中保留整本文档
+
+    start_page 为已处理的页数 (0-based 起点)，用于断点续传。pypdf 会缓存已解析的对象，
+    每处理 reopen_every 页重新打开一次文件，使内存占用与文档长度无关。
+    """
+    reader = PdfReader(pdf_path)
+    total = len(reader.pages)
+    for page_num in range(start_page, total):
+        if reopen_every and page_num > start_page and (page_num - start_page) % reopen_every == 0:
+            reader = PdfReader(pdf_path)
+        text = reader.pages[page_num].extract_text()
+        if not text or len(text.strip()) < MIN_PAGE_CHARS: continue
+        yield {
+            "text": text.strip(),
+            "page": page_num + 1
+        }
+
+@metrics.instrument("pdf.extract", batch="result")
 def extract_text_with_page_numbers(pdf_path):
     """读取 PDF，按页提取文本，返回列表"""
     chunks = []
     try:
-        reader = PdfReader(pdf_path)
-        for page_num, page in enumerate(reader.pages):
-            text = page.extract_text()
-            if not text or len(text.strip()) < 50: continue
-            chunks.append({
-                "text": text.strip(),
-                "page": page_num + 1
-            })
+        for chunk in iter_pages(pdf_path):
+            chunks.append(chunk)
     except Exception as e:
         print(f"Error reading {pdf_path}: {e}")
     return chunks
 
-def move_file_to_category(file_path, category):
-    """文件移动逻辑"""
-    target_dir = os.path.join(os.path.dirname(file_path), category)
-    os.makedirs(target_dir, exist_ok=True)
-    filename = os.path.basename(file_path)
-    target_path = os.path.join(target_dir, filename)
+def file_hash(path, chunk_size=1 << 20):
+    """文件内容的 sha1，用于识别同一文件"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def unique_path(path):
+    """path 已被其他文件占用时在文件名后加序号，避免同名论文互相覆盖"""
+    if not os.path.exists(path):
+        return path
+    stem, ext = os.path.splitext(path)
+    n = 2
+    while os.path.exists(f"{stem}_{n}{ext}"):
+        n += 1
+    return f"{stem}_{n}{ext}"
+
+def category_path(file_path, category, base_dir=None):
+    """move_file_to_category 会把文件放到的位置"""
+    if base_dir is None:
+        # 已位于对应分类目录下（例如重复批量导入），不再嵌套移动
+        if os.path.basename(os.path.dirname(os.path.abspath(file_path))) == category:
+            return file_path
+        base_dir = os.path.dirname(file_path)
+    target_path = os.path.join(base_dir, category, os.path.basename(file_path))
+    if os.path.abspath(target_path) == os.path.abspath(file_path):
+        return target_path
+    return unique_path(target_path)
+
+@metrics.instrument("file.move")
+def move_file_to_category(file_path, category, base_dir=None):
+    """文件移动逻辑；base_dir 指定分类目录所在的父目录，默认为文件当前所在目录"""
+    target_path = category_path(file_path, category, base_dir)
+    os.makedirs(os.path.dirname(target_path) or ".", exist_ok=True)
     if os.path.abspath(file_path) != os.path.abspath(target_path):
         shutil.move(file_path, target_path)
-    return target_path
\ No newline at end of file
+    return target_path
@@ -0,0 +1,406 @@
+import fcntl
+import json
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+# 与 Chroma collection 相同的默认 include
+QUERY_INCLUDE = ["metadatas", "documents", "distances"]
+GET_INCLUDE = ["metadatas", "documents"]
+# 扫描时每块的行数：块内转成 float32 的临时副本约 1.5 MB (384 维)，可留在 CPU 缓存中
+SCAN_BLOCK_ROWS = 1024
+INITIAL_CAPACITY = 1024
+
+_OPS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+_FIELD_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+# 建表达式索引的 metadata 字段：按论文 / 分类 / 页码过滤的检索只读取匹配的行，不扫描整张表
+INDEXED_FIELDS = ("path", "topic", "page")
+
+
+def _field(key):
+    """metadata 字段的 SQL 表达式；字段名直接写入 SQL (与表达式索引的写法一致才能用上索引)"""
+    if not _FIELD_RE.match(key):
+        raise ValueError(f"Unsupported metadata field in where: {key!r}")
+    return f"json_extract(metadata, '$.{key}')"
+
+
+def _where_sql(where):
+    """把 Chroma 风格的 where (字段相等、$in/$nin、比较运算、$and/$or) 转成 SQL 条件"""
+    if not where:
+        return "1", []
+    clauses, params = [], []
+    for key, cond in where.items():
+        if key in ("$and", "$or"):
+            parts = [_where_sql(sub) for sub in cond]
+            joiner = " AND " if key == "$and" else " OR "
+            clauses.append("(" + joiner.join(sql for sql, _ in parts) + ")")
+            for _, p in parts:
+                params.extend(p)
+            continue
+        field = _field(key)
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+        for op, value in cond.items():
+            if op in ("$in", "$nin"):
+                if not value:
+                    clauses.append("0" if op == "$in" else "1")
+                    continue
+                marks = ",".join("?" * len(value))
+                clauses.append(f"{field} {'IN' if op == '$in' else 'NOT IN'} ({marks})")
+                params.extend(value)
+            elif op in _OPS:
+                clauses.append(f"{field} {_OPS[op]} ?")
+                params.append(value)
+            else:
+                raise ValueError(f"Unsupported where operator: {op}")
+    return " AND ".join(clauses) or "1", params
+
+
+class MmapCollection:
+    """内存映射的扁平向量库，接口与 Chroma collection 的常用子集一致 (upsert/get/query/update/delete/count)
+
+    向量按行存于 float16 (或每行一个缩放系数的 int8) 的 mmap 文件，id / 文本 / metadata 存于旁边的
+    SQLite 表，行号即矩阵下标。查询对全部行做精确的向量化点积并用 argpartition 取 top-k，
+    距离与 Chroma 默认的 l2 一致 (欧氏距离的平方)。多个进程打开同一目录时共享页缓存中的同一份向量。
+    多个进程可以同时写入：每次写入持有库目录下 write.lock 的排他 flock，先读取最新的行数与容量再分配行号；
+    其他进程通过 version 计数发现新增的行。删除只做标记，不回收行。
+    """
+
+    # 带 where 的 query 走 metadata 表达式索引，只对匹配的行做点积，窄条件下很快
+    fast_where = True
+
+    def __init__(self, path, name=None, dtype="float16"):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.name = name or os.path.basename(path)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(path, "meta.sqlite3"), check_same_thread=False)
+        self._conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "CREATE TABLE IF NOT EXISTS rows ("
+            " row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, document TEXT, metadata TEXT);"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            + "".join(f"CREATE INDEX IF NOT EXISTS rows_{f} ON rows ({_field(f)});" for f in INDEXED_FIELDS)
+        )
+        stored = dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+        # 已有的库沿用建库时的精度
+        self.dtype = stored.get("dtype", dtype)
+        if self.dtype not in ("float16", "int8"):
+            raise ValueError(f"Unsupported dtype: {self.dtype}")
+        self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('dtype', ?)", (self.dtype,))
+        self._conn.commit()
+        self._version = None
+        self._dim = None
+        self._rows = 0
+        self._vectors = self._sq_norms = self._scales = None
+        self._lock_file = open(os.path.join(path, "write.lock"), "a")
+
+    # --- 文件与版本 ---
+
+    def _meta(self):
+        return dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+
+    def _open_arrays(self, dim, capacity, create=False):
+        mode = "w+" if create else "r+"
+        vec_dtype = np.float16 if self.dtype == "float16" else np.int8
+        self._vectors = np.memmap(os.path.join(self.path, f"vectors.{self.dtype}"), dtype=vec_dtype,
+                                  mode=mode, shape=(capacity, dim))
+        # 每行存储值的平方范数 (删除的行为 inf)，算 l2 距离时不必再读整行
+        self._sq_norms = np.memmap(os.path.join(self.path, "sq_norms.float32"), dtype=np.float32,
+                                   mode=mode, shape=(capacity,))
+        if self.dtype == "int8":
+            self._scales = np.memmap(os.path.join(self.path, "scales.float32"), dtype=np.float32,
+                                     mode=mode, shape=(capacity,))
+
+    def _refresh(self):
+        """其他进程写入后 version 变化：重新映射文件并读取行数"""
+        meta = self._meta()
+        version = meta.get("version")
+        if version == self._version and self._vectors is not None:
+            return
+        self._version = version
+        if "dim" not in meta:
+            return
+        self._dim = int(meta["dim"])
+        self._rows = int(meta["rows"])
+        capacity = int(meta["capacity"])
+        if self._vectors is None or self._vectors.shape[0] != capacity:
+            self._open_arrays(self._dim, capacity)
+
+    @contextmanager
+    def _writing(self):
+        """写入临界区：线程锁 + 跨进程的文件锁，进入后刷新到其他进程写入后的最新状态"""
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _ensure_capacity(self, dim, needed):
+        if self._dim is None:
+            capacity = max(INITIAL_CAPACITY, needed)
+            self._dim = dim
+            self._open_arrays(dim, capacity, create=True)
+            self._sq_norms[:] = np.inf
+            self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                   [("dim", str(dim)), ("capacity", str(capacity)), ("rows", "0")])
+            return
+        if dim != self._dim:
+            raise ValueError(f"Embedding dimension {dim} does not match collection dimension {self._dim}")
+        capacity = self._vectors.shape[0]
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2)
+        for array in (self._vectors, self._sq_norms, self._scales):
+            if array is not None:
+                array.flush()
+        old_capacity = capacity
+        self._vectors = self._sq_norms = self._scales = None
+        # 扩容：截断到更大的尺寸后重新映射
+        vec_bytes = 2 if self.dtype == "float16" else 1
+        files = [(f"vectors.{self.dtype}", dim * vec_bytes), ("sq_norms.float32", 4)]
+        if self.dtype == "int8":
+            files.append(("scales.float32", 4))
+        for file, row_bytes in files:
+            with open(os.path.join(self.path, file), "r+b") as f:
+                f.truncate(new_capacity * row_bytes)
+        self._open_arrays(dim, new_capacity)
+        self._sq_norms[old_capacity:] = np.inf
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('capacity', ?)", (str(new_capacity),))
+
+    def _encode_rows(self, rows, embeddings):
+        emb = np.asarray(embeddings, dtype=np.float32)
+        if self.dtype == "float16":
+            stored = emb.astype(np.float16)
+            self._vectors[rows] = stored
+            approx = stored.astype(np.float32)
+        else:
+            scales = np.abs(emb).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            stored = np.clip(np.rint(emb / scales[:, None]), -127, 127).astype(np.int8)
+            self._vectors[rows] = stored
+            self._scales[rows] = scales
+            approx = stored.astype(np.float32) * scales[:, None]
+        self._sq_norms[rows] = (approx * approx).sum(axis=1)
+
+    def _bump_version(self):
+        for array in (self._vectors, self._sq_norms, self._scales):
+            if array is not None:
+                array.flush()
+        version = str(int(self._meta().get("version", "0")) + 1)
+        self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                               [("version", version), ("rows", str(self._rows))])
+        self._conn.commit()
+        self._version = version
+
+    # --- 写入 ---
+
+    def _rows_for_ids(self, ids):
+        found = {}
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            marks = ",".join("?" * len(part))
+            found.update(self._conn.execute(f"SELECT id, row FROM rows WHERE id IN ({marks})", part).fetchall())
+        return found
+
+    def upsert(self, ids, embeddings=None, documents=None, metadatas=None):
+        if embeddings is None:
+            raise ValueError("MmapCollection.upsert requires embeddings")
+        ids = list(ids)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        # 同一批中重复的 id 只保留最后一次出现
+        last = {row_id: i for i, row_id in enumerate(ids)}
+        if len(last) != len(ids):
+            keep = sorted(last.values())
+            ids = [ids[i] for i in keep]
+            embeddings = embeddings[keep]
+            documents = [documents[i] for i in keep] if documents is not None else None
+            metadatas = [metadatas[i] for i in keep] if metadatas is not None else None
+        if not ids:
+            return
+        with self._writing():
+            existing = self._rows_for_ids(ids)
+            rows, next_row = [], self._rows
+            for row_id in ids:
+                if row_id in existing:
+                    rows.append(existing[row_id])
+                else:
+                    rows.append(next_row)
+                    next_row += 1
+            self._ensure_capacity(embeddings.shape[1], next_row)
+            self._encode_rows(np.asarray(rows), embeddings)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO rows (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                [(row, row_id,
+                  documents[i] if documents is not None else None,
+                  json.dumps(metadatas[i], ensure_ascii=False) if metadatas is not None else None)
+                 for i, (row, row_id) in enumerate(zip(rows, ids))]
+            )
+            self._rows = next_row
+            self._bump_version()
+
+    add = upsert
+
+    def update(self, ids, embeddings=None, documents=None, metadatas=None):
+        ids = list(ids)
+        with self._writing():
+            existing = self._rows_for_ids(ids)
+            present = [i for i, row_id in enumerate(ids) if row_id in existing]
+            if not present:
+                return
+            if embeddings is not None:
+                emb = np.asarray(embeddings, dtype=np.float32)[present]
+                self._encode_rows(np.asarray([existing[ids[i]] for i in present]), emb)
+            if documents is not None:
+                self._conn.executemany("UPDATE rows SET document=? WHERE id=?",
+                                       [(documents[i], ids[i]) for i in present])
+            if metadatas is not None:
+                self._conn.executemany("UPDATE rows SET metadata=? WHERE id=?",
+                                       [(json.dumps(metadatas[i], ensure_ascii=False), ids[i]) for i in present])
+            self._bump_version()
+
+    def delete(self, ids=None, where=None):
+        with self._writing():
+            if ids is not None:
+                rows = list(self._rows_for_ids(list(ids)).values())
+            else:
+                sql, params = _where_sql(where)
+                rows = [r for (r,) in self._conn.execute(f"SELECT row FROM rows WHERE {sql}", params)]
+            if not rows:
+                return
+            self._sq_norms[np.asarray(rows)] = np.inf
+            for start in range(0, len(rows), 500):
+                part = rows[start:start + 500]
+                self._conn.execute(f"DELETE FROM rows WHERE row IN ({','.join('?' * len(part))})", part)
+            self._bump_version()
+
+    # --- 读取 ---
+
+    def count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+
+    def _embeddings(self, rows):
+        vecs = self._vectors[rows].astype(np.float32)
+        if self.dtype == "int8":
+            vecs *= self._scales[rows][:, None]
+        return vecs
+
+    def _format_rows(self, records, include, extra=None):
+        """records: [(row, id, document, metadata_json)]，按 include 组装 Chroma 风格的列表"""
+        out = {"ids": [r[1] for r in records], "embeddings": None, "documents": None, "metadatas": None}
+        if "documents" in include:
+            out["documents"] = [r[2] for r in records]
+        if "metadatas" in include:
+            out["metadatas"] = [json.loads(r[3]) if r[3] else None for r in records]
+        if "embeddings" in include:
+            out["embeddings"] = self._embeddings(np.asarray([r[0] for r in records], dtype=np.int64)) \
+                if records else np.zeros((0, self._dim or 0), dtype=np.float32)
+        return out
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=GET_INCLUDE):
+        with self._lock:
+            self._refresh()
+            sql, params = _where_sql(where)
+            if ids is not None:
+                ids = list(ids)
+                records = []
+                for start in range(0, len(ids), 500):
+                    part = ids[start:start + 500]
+                    marks = ",".join("?" * len(part))
+                    records.extend(self._conn.execute(
+                        f"SELECT row, id, document, metadata FROM rows WHERE id IN ({marks}) AND {sql}",
+                        [*part, *params]
+                    ).fetchall())
+                order = {row_id: i for i, row_id in enumerate(ids)}
+                records.sort(key=lambda r: order[r[1]])
+                records = records[offset or 0:][:limit] if limit is not None else records[offset or 0:]
+            else:
+                page = f" LIMIT {int(limit)} OFFSET {int(offset or 0)}" if limit is not None else \
+                    (f" LIMIT -1 OFFSET {int(offset)}" if offset else "")
+                records = self._conn.execute(
+                    f"SELECT row, id, document, metadata FROM rows WHERE {sql} ORDER BY row{page}", params
+                ).fetchall()
+            return self._format_rows(records, include)
+
+    def _top_k(self, queries, k, rows=None):
+        """返回每个查询的 (行号数组, 距离数组)，按距离升序
+
+        分块把存储值转成 float32 并与查询矩阵相乘 (块小到能留在 CPU 缓存中)，距离写入一个
+        (行数, 查询数) 的数组，最后每个查询做一次 argpartition。int8 的缩放系数乘在点积结果上。
+        """
+        n = self._rows if rows is None else len(rows)
+        dist = np.empty((n, len(queries)), dtype=np.float32)
+        queries_t = np.ascontiguousarray(queries.T)
+        for start in range(0, n, SCAN_BLOCK_ROWS):
+            stop = min(start + SCAN_BLOCK_ROWS, n)
+            block_rows = slice(start, stop) if rows is None else rows[start:stop]
+            dots = self._vectors[block_rows].astype(np.float32) @ queries_t
+            if self.dtype == "int8":
+                dots *= self._scales[block_rows][:, None]
+            dots *= -2.0
+            dots += self._sq_norms[block_rows][:, None]
+            dist[start:stop] = dots
+        dist += (queries * queries).sum(axis=1)[None, :]
+
+        results = []
+        kk = min(k, n)
+        for qi in range(len(queries)):
+            column = dist[:, qi]
+            top = np.argpartition(column, kk - 1)[:kk] if kk < n else np.arange(n)
+            top = top[np.argsort(column[top], kind="stable")]
+            # 已删除的行平方范数为 inf
+            top = top[np.isfinite(column[top])]
+            found = top if rows is None else rows[top]
+            results.append((found, np.maximum(column[top], 0.0)))
+        return results
+
+    def query(self, query_embeddings=None, n_results=10, where=None, include=QUERY_INCLUDE, **kwargs):
+        if query_embeddings is None:
+            raise ValueError("MmapCollection.query requires query_embeddings")
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        with self._lock:
+            self._refresh()
+            empty = {"ids": [[] for _ in queries], "embeddings": None, "documents": None, "metadatas": None,
+                     "distances": [[] for _ in queries]}
+            if self._dim is None or not self._rows:
+                return empty
+            rows = None
+            if where:
+                sql, params = _where_sql(where)
+                rows = np.asarray([r for (r,) in self._conn.execute(
+                    f"SELECT row FROM rows WHERE {sql} ORDER BY row", params)], dtype=np.int64)
+                if not len(rows):
+                    return empty
+            hits = self._top_k(queries, n_results, rows)
+
+            # 一次取回所有命中行的 id / 文本 / metadata
+            wanted = sorted({int(r) for rows_q, _ in hits for r in rows_q})
+            records = {}
+            for start in range(0, len(wanted), 500):
+                part = wanted[start:start + 500]
+                marks = ",".join("?" * len(part))
+                for rec in self._conn.execute(
+                    f"SELECT row, id, document, metadata FROM rows WHERE row IN ({marks})", part
+                ):
+                    records[rec[0]] = rec
+
+            out = {"ids": [], "embeddings": [] if "embeddings" in include else None,
+                   "documents": [] if "documents" in include else None,
+                   "metadatas": [] if "metadatas" in include else None,
+                   "distances": [] if "distances" in include else None}
+            for rows_q, dist_q in hits:
+                # 其他进程刚删除的行可能已不在表中
+                pairs = [(records[int(r)], float(d)) for r, d in zip(rows_q, dist_q) if int(r) in records]
+                formatted = self._format_rows([rec for rec, _ in pairs], include)
+                out["ids"].append(formatted["ids"])
+                for key in ("embeddings", "documents", "metadatas"):
+                    if out[key] is not None:
+                        out[key].append(formatted[key])
+                if out["distances"] is not None:
+                    out["distances"].append([d for _, d in pairs])
+            return out